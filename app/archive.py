@@ -0,0 +1,99 @@
+from pathlib import Path
+from queue import Queue
+from threading import Lock
+
+import pyzipper
+from pandas import DataFrame
+
+from app import manifest
+from app.compression import Policy
+from app.vars import ARCHIVE_DIR, ARCHIVE_WORKERS, BACKUP_NAME, TIMESTAMP, VOLUME_SIZE
+from utils.thread import ExceptionalThread, join_all
+
+
+# Columns of the archive manifest, it maps every archived file to its volume
+ARCHIVE_COLUMNS = ["Member", "Volume", "Size"]
+
+
+class Archiver:
+    """Archive stage of the backup session. Files are queued as soon as they land in the delta dir and written into AES encrypted zip volumes by a pool of workers, each worker filling its own volume, so compression & encryption run on all cores while files are still being pulled. A volume is closed once it reaches the volume size, members are never split across volumes.
+    """
+    def __init__(self, policy: Policy, directory: Path = ARCHIVE_DIR, volume_size: int = VOLUME_SIZE, workers: int = ARCHIVE_WORKERS) -> None:
+        """Initializes the queue & starts the archive workers
+
+        Args:
+            policy (Policy): Compression policy, only members of compressible types are deflated
+            directory (Path, optional): Directory of the volumes. Defaults to ARCHIVE_DIR.
+            volume_size (int, optional): Max size of a volume, unless a single member is larger. Defaults to VOLUME_SIZE.
+            workers (int, optional): Volumes written at the same time. Defaults to ARCHIVE_WORKERS.
+        """
+        self.policy = policy
+        self.directory = directory
+        self.volume_size = volume_size
+        self.queue: Queue[tuple[Path, str, str] | None] = Queue()
+        self.lock = Lock()
+        self.volumes = 0
+        self.members: list[tuple[str, str, int]] = []
+        self.threads = [ExceptionalThread(target=self.worker) for _ in range(workers)]
+        [thread.start() for thread in self.threads]
+
+    def add(self, file: Path, name: str, kind: str) -> None:
+        """Function that queues a file to be archived
+
+        Args:
+            file (Path): Local file path
+            name (str): Member name within the archive
+            kind (str): File type (suffix)
+        """
+        self.queue.put((file, name, kind))
+
+    def next_volume(self) -> tuple[pyzipper.AESZipFile, str]:
+        """Function that opens the next volume
+
+        Returns:
+            tuple[pyzipper.AESZipFile, str]: Volume & its file name
+        """
+        with self.lock:
+            self.volumes += 1
+            name = f"{BACKUP_NAME}-{TIMESTAMP}.{self.volumes:03}.zip"
+        self.directory.mkdir(parents=True, exist_ok=True)
+        volume = pyzipper.AESZipFile(self.directory/name, "w", compression=pyzipper.ZIP_DEFLATED, encryption=pyzipper.WZ_AES)
+        # password is decoded on first use, commands that never archive don't need it
+        from app.vars import MYPASS
+        volume.setpassword(MYPASS.encode())
+        return volume, name
+
+    def worker(self) -> None:
+        """Function that runs on each archive worker thread. Keeps writing queued files into its volume until the queue is closed.
+        """
+        volume: pyzipper.AESZipFile | None = None
+        name = ""
+        written = 0
+        try:
+            while (item := self.queue.get()) is not None:
+                file, member, kind = item
+                size = file.stat().st_size
+                if volume is None or (written and written + size > self.volume_size):
+                    if volume is not None:
+                        volume.close()
+                    volume, name = self.next_volume()
+                    written = 0
+                # incompressible types are stored, they are only encrypted
+                compress_type = pyzipper.ZIP_DEFLATED if self.policy.compressible(kind) else pyzipper.ZIP_STORED
+                volume.write(file, member, compress_type=compress_type)
+                written = volume.fp.tell() if volume.fp is not None else written + size
+                with self.lock:
+                    self.members.append((member, name, size))
+        finally:
+            if volume is not None:
+                volume.close()
+
+    def close(self) -> None:
+        """Function that waits for the queued files to be archived and saves the manifest of the archive
+        """
+        [self.queue.put(None) for _ in self.threads]
+        join_all(self.threads)
+        if not self.members:
+            return
+        dst_file = self.directory/f"{BACKUP_NAME}-{TIMESTAMP}.parquet"
+        manifest.save(DataFrame(self.members, columns=ARCHIVE_COLUMNS), dst_file)
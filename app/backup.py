@@ -1,31 +1,104 @@
+from contextlib import AbstractContextManager, ExitStack, nullcontext
+from os import replace
 from pathlib import Path, PurePosixPath
-from shutil import move
-from time import sleep
-from typing import cast
+from shutil import copyfile, move
+from time import monotonic, sleep
+from typing import Any, cast
 
-from pandas import read_csv
-
-from app.delta import DeltaNamedTuple
+from rich.filesize import decimal
+from app import manifest
+from app.archive import Archiver
+from app import snapshot
+from app.catalog import BACKUP, DELTA, VERSION, Catalog
+from app.compression import Policy
+from app.delta import DeltaNamedTuple, save_totals
+from app.journal import Journal
 from app.render import Render
-from app.vars import BACKUP_DIR, DELTA_DATAFRAME, DELTA_DIR, DEVICE_ROOT, RECYCLE_BIN
+from app.scheduler import Scheduler, Tuning
+from app.transfer import FsyncBatch, part_of, pull_batch, pull_compressed, pull_ranged, pull_stream
+from app.vars import (
+    ARCHIVE,
+    BACKUP_DIR,
+    BLOCK_DIFF_SIZE,
+    BLOCK_SIZE,
+    COMPRESSION,
+    DELTA_DATAFRAME,
+    DELTA_DIR,
+    DEVICE_ROOT,
+    FSYNC_FILES,
+    MERGE_SIZE,
+    PROGRESS_INTERVAL,
+    PULL_WORKERS_MAX,
+    RANGE_HASH_CHECK,
+    RANGE_RETRIES,
+    RANGE_SIZE,
+    RANGE_STREAMS,
+    RANGED_FILE_SIZE,
+)
 from utils import log
-from utils.android import device
-from utils.thread import ExceptionalThread
+from utils import android
+from utils.thread import ExceptionalThread, join_all
 
 
 class session(Render):
     """Actual session of backup with live rendering of progress
     """
-    def __init__(self) -> None:
+    def __init__(self, live: bool = True, gate: AbstractContextManager | None = None, headless: bool = False) -> None:
         """Initializes all important variables both from parent `Render` class and current session variables like `deltaframe` & `progress bar tasks`
+
+        Args:
+            live (bool, optional): Render live on the terminal. Defaults to True.
+            gate (AbstractContextManager | None, optional): Held around every pull, a semaphore shared by the sessions of all devices bounds the writes to host disk. Defaults to None.
+            headless (bool, optional): Print JSON lines of progress instead of the live render. Defaults to False.
         """
-        super().__init__()
+        super().__init__(live, headless)
+        self.gate = gate if gate is not None else nullcontext()
         log.stage("Backup\n")
-        self.deltaframe = read_csv(DELTA_DATAFRAME)
+        self.deltaframe = manifest.load(DELTA_DATAFRAME)
         self.total_size = sum(self.deltaframe["Size"])
         self.main_progress_task = self.main_progress_bar.add_task("main", total=self.total_size)
         self.panel_total = len(self.deltaframe)
         self.update_files_panel_title()
+        # Transfer tunables learned for this device: files <= small_size are pulled in tar batches of batch_size, files > large_size get an alt progress bar
+        self.tuning = Tuning()
+        # Files > ranged_size are pulled as ranges of range_size over range_streams parallel streams
+        self.ranged_size = RANGED_FILE_SIZE
+        self.range_size = RANGE_SIZE
+        self.range_streams = RANGE_STREAMS
+        # Modified files >= block_diff_size are patched: only blocks of block_size that differ from the previous copy are pulled
+        self.block_diff_size = BLOCK_DIFF_SIZE
+        self.block_size = BLOCK_SIZE
+        self.bytes_saved = 0
+        # Compressible types are pulled gzip compressed, policy adapts to the ratio measured for each type
+        self.compression = Policy(enabled=COMPRESSION)
+        # Catalog is updated in place as each file is pulled or recycled
+        self.catalog = Catalog()
+        # Journal of handled rows, rows done by an interrupted session are skipped
+        self.journal = Journal()
+        # Pulled files are archived into encrypted volumes as soon as they land, if the delta dir gets archived after the session
+        self.archiver = self.start_archive()
+        # Pulled files are synced to disk in batches of fsync_files before the journal marks them done
+        self.durable = FsyncBatch(self.journal.complete, FSYNC_FILES)
+        # Running files & bytes handled for each kind, saved alongside the deltaframe
+        self.kinds = {kind: [0, 0] for kind in ("add", "modify", "remove", "move")}
+
+    def start_archive(self) -> Archiver | None:
+        """Function that starts the archive stage only if the delta dir reaches MERGE_SIZE with the files pulled by this session, a smaller delta dir is neither archived nor merged after the session. Files left in the delta dir by earlier sessions were never archived, so they are queued right away.
+
+        Returns:
+            Archiver | None: Archive stage or None if the delta dir isn't archived
+        """
+        if not ARCHIVE:
+            return None
+        # rows handled by an interrupted session are already in the catalog
+        pending = {str(row.Path): int(row.Size) for row in self.deltaframe.itertuples() if row.Kind in ("add", "modify") and not self.journal.is_done(cast(DeltaNamedTuple, row))}
+        if self.catalog.totals(DELTA)[1] + sum(pending.values()) < MERGE_SIZE:
+            return None
+        archiver = Archiver(self.compression)
+        for path in sorted(set(self.catalog.paths(DELTA)).difference(pending)):
+            relative = PurePosixPath(path).relative_to(DEVICE_ROOT)
+            archiver.add(DELTA_DIR/relative, str(relative), PurePosixPath(path).suffix)
+        return archiver
 
     def run_mock(self) -> None:
         """Function that mocks/simulates the process of pulling files. This is to develop/debug live render without actually pulling files.
@@ -58,28 +131,61 @@ class session(Render):
                 self.alt_progress_bar.remove_task(alt_task)
                 self.update_alt_progress_title()
 
-    def run(self, mock: bool = False) -> None:
+    def run(self, mock: bool = False, workers: int = PULL_WORKERS_MAX) -> None:
         """Start the backup session.
 
         Args:
             mock (bool, optional): Invokes run_mock() function instead of actual backup. Defaults to False.
+            workers (int, optional): Max number of files pulled at the same time, the scheduler tunes how many of them are active. Defaults to PULL_WORKERS_MAX.
         """
         if mock:
             self.run_mock()
             return
-        # Initialize alt variables for thread pulls and progress bars
-        self.alt_total = 0
-        self.alt_size = 100_000_000 # alt size set to 100MB
-        # Iterate over all files/rows
+        # Iterate over all files/rows, removals are local moves so they are handled right away
+        pulls = []
         for row in self.deltaframe.itertuples():
             # Casting row [PandasNamedTuple] in `DeltaNamedTuple` to enable type hints
             row = cast(DeltaNamedTuple, row)
-            if row.Kind in ("add", "modify"):
-                # if file is of kind add/modify pull the file from device
-                self.fetch_file(row)
-            elif row.Kind in ("remove"):
+            if self.journal.is_done(row):
+                # if row was handled by an interrupted session, skip it
+                self.main_progress_bar.update(self.main_progress_task, advance=row.Size)
+                self.count(row)
+                self.advance_files_panel_title()
+            elif row.Kind in ("add", "modify"):
+                # if file is of kind add/modify queue it to be pulled from device
+                pulls.append(row)
+            elif row.Kind == "remove":
                 # elif file is of kind remove move it to backup recycle bin folder
                 self.recycle_file(row)
+            elif row.Kind == "move":
+                # elif file is moved on device, rename its copy within backup dir
+                self.move_file(row)
+        # Pull all queued files with a pool of workers, the scheduler adapts to the throughput of the main progress bar
+        main_task = self.main_progress_bar.tasks[0]
+        self.scheduler = Scheduler(pulls, self.tuning, workers, progress=lambda: main_task.completed, adaptive=True)
+        threads = [ExceptionalThread(target=self.worker, args=(lane,)) for lane in self.scheduler.lanes_for(workers)]
+        [thread.start() for thread in threads]
+        join_all(threads)
+
+    def worker(self, lane: str) -> None:
+        """Function that runs on each pull worker thread. Keeps fetching rows from the scheduler until it's drained.
+
+        Args:
+            lane (str): Scheduler lane this worker is bound to
+        """
+        try:
+            while (job := self.scheduler.next(lane)) is not None:
+                with self.gate:
+                    start = monotonic()
+                    if isinstance(job, list):
+                        self.fetch_batch(job)
+                    else:
+                        self.fetch_file(job)
+                    self.scheduler.done(job, monotonic() - start, lane)
+        except BaseException:
+            # stop the other workers too, the exception is raised on join
+            self.scheduler.stop()
+            raise
 
     def fetch_file(self, row: DeltaNamedTuple) -> None:
         """Function that fetches file in a given row from the dataframe
@@ -92,18 +198,88 @@ class session(Render):
         # calculate file paths for source and destination
         src_file = PurePosixPath(row.Path)
         dst_file = DELTA_DIR/src_file.relative_to(DEVICE_ROOT)
+        # File is pulled into a temp file and renamed into place once complete
+        part_file = part_of(dst_file)
         # Create destination folder is not exists
         dst_file.parent.mkdir(parents=True, exist_ok=True)
-        if dst_file.exists() and dst_file.stat().st_size == row.Size:
-            # if dst file already exists and file sizes matches, skip it
-            self.main_progress_bar.update(self.main_progress_task, advance=row.Size)
-        elif row.Size <= self.alt_size:
-            # elif file size is less than alt_size [100mb] fetch the file [simple mode]
-            self.fetch_file_simple(str(src_file), str(dst_file), row.Size)
+        # Previous copy of a large modified file, if any
+        base_file = self.base_of(row, dst_file)
+        kind = row.Type if isinstance(row.Type, str) else ""
+        # large_size is tuned between sessions, so a file started in streamed mode stays streamed to be resumed
+        simple = row.Size <= self.tuning.large_size and base_file is None and not self.journal.is_started(row)
+        if simple and self.compression.worth(kind):
+            # if file size is less than large_size [100mb by default] and its type compresses well, fetch the file [compressed mode]
+            self.fetch_file_compressed(str(src_file), str(part_file), row.Size)
+        elif simple:
+            # elif file size is less than large_size [100mb by default] fetch the file [simple mode]
+            self.fetch_file_simple(str(src_file), str(part_file), row.Size)
         else:
-            # else fecth the file in [threaded mode] with alt progress bar
-            self.fetch_file_threaded(str(src_file), str(dst_file), row.Size)
-        self.update_files_panel_title(row.Index+1)
+            # else fecth the file in [streamed mode] with alt progress bar, resuming the temp file of an interrupted session. Files > ranged_size are fetched in [ranged mode].
+            offset = 0
+            if self.journal.is_started(row) and part_file.exists() and (base_file is not None or part_file.stat().st_size <= row.Size):
+                offset = part_file.stat().st_size
+            else:
+                self.journal.start(row)
+                if base_file is not None:
+                    # modified file starts from its previous copy, blocks that still match are kept [patched mode]
+                    copyfile(base_file, part_file)
+                    offset = base_file.stat().st_size
+            ranged = row.Size > self.ranged_size or base_file is not None
+            range_size = self.block_size if base_file is not None else self.range_size
+            pulled = self.fetch_file_streamed(str(src_file), str(part_file), row.Size, offset, ranged, range_size)
+            if base_file is not None:
+                with self.lock:
+                    self.bytes_saved += row.Size - pulled
+        replace(part_file, dst_file)
+        self.compression.sample(kind, dst_file)
+        self.record_pull(row)
+        self.advance_files_panel_title()
+
+    def base_of(self, row: DeltaNamedTuple, dst_file: Path) -> Path | None:
+        """Function that finds the previous copy of a modified file for block level delta transfer. Copy in delta dir (pulled but not yet merged) is newer than the one in backup dir.
+
+        Args:
+            row (DeltaNamedTuple): Row from Delta frame itertuple
+            dst_file (Path): Destination file in delta dir
+
+        Returns:
+            Path | None: Previous copy or None if the row is not patched
+        """
+        if row.Kind != "modify" or row.Size < self.block_diff_size:
+            return None
+        for base_file in (dst_file, BACKUP_DIR/dst_file.relative_to(DELTA_DIR)):
+            if base_file.exists():
+                return base_file
+        return None
+
+    def fetch_batch(self, rows: list[DeltaNamedTuple]) -> None:
+        """Function that fetches a batch of small files in given rows as a single tar stream
+
+        Args:
+            rows (list[DeltaNamedTuple]): Rows from Delta frame itertuple
+        """
+        pending = {row.Path: row for row in rows}
+        kinds = {row.Path: row.Type if isinstance(row.Type, str) else "" for row in rows}
+        # Files of compressible types are streamed as a separate compressed tar
+        compressed = [path for path in pending if self.compression.worth(kinds[path])]
+        plain = [path for path in pending if not self.compression.worth(kinds[path])]
+        for files, compress in ((plain, False), (compressed, True)):
+            raw = 0
+            wire: list[int] = []
+            # Stream the batch and update the panel for each file as soon as it's unpacked
+            for path, size in pull_batch(files, DELTA_DIR, DEVICE_ROOT, compress, wire.append):
+                row = pending.pop(path)
+                self.insert_into_files_panel(row.Path, row.Kind)
+                self.main_progress_bar.update(self.main_progress_task, advance=size)
+                self.compression.sample(kinds[path], DELTA_DIR/PurePosixPath(path).relative_to(DEVICE_ROOT))
+                self.record_pull(row)
+                self.advance_files_panel_title()
+                raw += size
+            if compress:
+                self.compression.transferred(raw, sum(wire))
+        # Files missing from the tar stream are retried one by one, so any error is surfaced by the sync pull
+        for row in pending.values():
+            self.fetch_file(row)
 
     def fetch_file_simple(self, src_file: str, dst_file: str, progress: int) -> None:
         """Function that pulls file from device in simple mode.
@@ -113,56 +289,166 @@ class session(Render):
             dst_file (str): output/destination file path
             progress (int): file size to update the main progress bar
         """
-        device.pull(src_file, dst_file)
+        android.pull(src_file, Path(dst_file), progress)
         self.main_progress_bar.update(self.main_progress_task, advance=progress)
 
-    def fetch_file_threaded(self, src_file: str, dst_file: str, progress: int) -> None:
-        """Function that pulls file from device in a separate thread. Function especially for large files whose size > alt_size [100MB], so that an alt_progress bar can be displayed for this single file.
+    def fetch_file_compressed(self, src_file: str, dst_file: str, progress: int) -> None:
+        """Function that pulls file from device gzip compressed, it's decompressed while it arrives.
 
         Args:
             src_file (str): input/source file path
             dst_file (str): output/destination file path
             progress (int): file size to update the main progress bar
         """
-        # Set alt title and create a task for alt_progress bar
-        self.update_alt_progress_title(src_file)
+        raw, wire = pull_compressed(src_file, Path(dst_file))
+        self.compression.transferred(raw, wire)
+        self.main_progress_bar.update(self.main_progress_task, advance=progress)
+
+    def fetch_file_streamed(self, src_file: str, dst_file: str, progress: int, offset: int = 0, ranged: bool = False, range_size: int = RANGE_SIZE) -> int:
+        """Function that pulls file from device as a stream. Function especially for large files whose size > large_size [100MB by default], so that an alt_progress bar can be displayed for this single file. Progress is reported by the stream itself at a fixed rate instead of polling the destination file.
+
+        Args:
+            src_file (str): input/source file path
+            dst_file (str): output/destination file path
+            progress (int): file size to update the main progress bar
+            offset (int, optional): bytes already present in dst_file, pull resumes from there. Defaults to 0.
+            ranged (bool, optional): pull the file as parallel byte ranges, alt progress bar shows the total of all ranges. Defaults to False.
+            range_size (int, optional): size of each range in ranged mode. Defaults to RANGE_SIZE.
+
+        Returns:
+            int: bytes pulled from device
+        """
+        # Add alt title and create a task for alt_progress bar
+        self.add_alt_file(src_file)
         alt_task = self.alt_progress_bar.add_task(src_file, total=progress)
-        # Create a thread for pulling the file and start it
-        thread = ExceptionalThread(target=device.pull, args=(src_file, dst_file))
-        thread.start()
-        file = Path(dst_file)
-        # Store current progress value to update it at last
-        current_total = self.main_progress_bar.tasks[self.main_progress_task].completed
-        # Wait until a file placeholder is created at destination dir
-        while True:
-            if file.exists():
-                break
-        # While the thread is still active > fetch the file size and update alt_progress bar
-        while thread.is_alive():
-            alt_total = file.stat().st_size
-            self.alt_progress_bar.update(alt_task, completed=alt_total)
-            self.main_progress_bar.update(self.main_progress_task, completed=(current_total+alt_total))
-        # Join the thread once done & reset alt_progress bar and title
-        thread.join()
-        self.alt_progress_bar.remove_task(alt_task)
-        self.update_alt_progress_title()
+        # Main progress bar is advanced by deltas, as other workers are updating it too
+        alt_total = 0
+
+        def update(current: int) -> None:
+            """Helper function that is called by the stream with the bytes received so far
+
+            Args:
+                current (int): total bytes received
+            """
+            nonlocal alt_total
+            self.alt_progress_bar.update(alt_task, completed=current)
+            self.main_progress_bar.update(self.main_progress_task, advance=(current-alt_total))
+            alt_total = current
+
+        try:
+            if ranged:
+                # a resumed or patched ranged pull keeps the ranges of dst_file that pass the md5 check, consecutive blocks that differ are pulled upto range_size at once
+                resume = offset > 0
+                merge = max(1, self.range_size // range_size)
+                pulled = pull_ranged(src_file, Path(dst_file), progress, update, PROGRESS_INTERVAL, self.range_streams, range_size, RANGE_RETRIES, RANGE_HASH_CHECK or resume, resume, merge)
+            else:
+                pulled = pull_stream(src_file, Path(dst_file), update, PROGRESS_INTERVAL, offset) - offset
+        finally:
+            # Reset alt_progress bar and title
+            self.alt_progress_bar.remove_task(alt_task)
+            self.remove_alt_file(src_file)
         # Update main progress bar
-        self.main_progress_bar.update(self.main_progress_task, completed=(current_total+progress))
+        self.main_progress_bar.update(self.main_progress_task, advance=(progress-alt_total))
+        return pulled
 
     def recycle_file(self, row: DeltaNamedTuple) -> None:
-        """Function that handles the rows of kind `remove`. It moves the file to a custom `Recycle Bin` folder within the backup dir.
+        """Function that handles the rows of kind `remove`. Its version is closed in the catalog and the file is moved into the versions dir of this session, so snapshots taken before still have it.
 
         Args:
             row (DeltaNamedTuple): Row from Delta frame itertuple
         """
         self.insert_into_files_panel(row.Path, row.Kind)
+        # Close the version, then move the file and update the progress bars
+        self.catalog.remove(row.Path, BACKUP, "recycle", VERSION)
+        snapshot.keep(self.catalog, row.Path)
+        self.journal.complete(row)
+        self.count(row)
+        self.main_progress_bar.update(self.main_progress_task, advance=row.Size)
+        self.advance_files_panel_title()
+
+    def move_file(self, row: DeltaNamedTuple) -> None:
+        """Function that handles the rows of kind `move`. The backed up copy is renamed to its new path within the backup dir, without any device transfer.
+
+        Args:
+            row (DeltaNamedTuple): Row from Delta frame itertuple
+        """
         # Calculate all file paths
-        src_file = PurePosixPath(row.Path)
-        dst_file = BACKUP_DIR/src_file.relative_to(DEVICE_ROOT)
-        del_file = RECYCLE_BIN/dst_file.relative_to(BACKUP_DIR)
-        # Create a dir in `Recycle Bin` for the file if not exists
-        del_file.parent.mkdir(parents=True, exist_ok=True)
-        # Move the file and update the progress bars
-        move(dst_file, del_file)
+        src_file = BACKUP_DIR/PurePosixPath(row.Path_old).relative_to(DEVICE_ROOT)
+        dst_file = BACKUP_DIR/PurePosixPath(row.Path).relative_to(DEVICE_ROOT)
+        if not src_file.exists():
+            # backed up copy is missing, so pull the file like an addition
+            self.catalog.remove(row.Path_old, BACKUP, "missing", VERSION)
+            self.catalog.relocate(BACKUP, row.Path_old, None)
+            self.fetch_file(row)
+            return
+        self.insert_into_files_panel(row.Path, row.Kind)
+        dst_file.parent.mkdir(parents=True, exist_ok=True)
+        move(src_file, dst_file)
+        self.catalog.remove(row.Path_old, BACKUP, "move", BACKUP)
+        kind = row.Type if isinstance(row.Type, str) else ""
+        self.catalog.record(row.Path, row.File, kind, int(row.Size), int(row.Date), BACKUP, "move")
+        # past versions of the old path share the moved content
+        self.catalog.relocate(BACKUP, row.Path_old, BACKUP, row.Path)
+        self.journal.complete(row)
+        self.count(row)
         self.main_progress_bar.update(self.main_progress_task, advance=row.Size)
-        self.update_files_panel_title(row.Index)
+        self.advance_files_panel_title()
+
+    def record_pull(self, row: DeltaNamedTuple) -> None:
+        """Function that records a pulled file of given row in the catalog as a `delta` file, queues it to be archived and records it in the journal as done
+
+        Args:
+            row (DeltaNamedTuple): Row from Delta frame itertuple
+        """
+        kind = row.Type if isinstance(row.Type, str) else ""
+        self.catalog.record(row.Path, row.File, kind, int(row.Size), int(row.Date), DELTA, "pull")
+        if self.archiver is not None:
+            relative = PurePosixPath(row.Path).relative_to(DEVICE_ROOT)
+            self.archiver.add(DELTA_DIR/relative, str(relative), kind)
+        # journal marks the row done once the file is synced to disk
+        self.durable.add(DELTA_DIR/PurePosixPath(row.Path).relative_to(DEVICE_ROOT), row)
+        self.count(row)
+
+    def count(self, row: DeltaNamedTuple) -> None:
+        """Function that adds a handled row to the running totals of its kind
+
+        Args:
+            row (DeltaNamedTuple): Row from Delta frame itertuple
+        """
+        with self.lock:
+            totals = self.kinds[str(row.Kind)]
+            totals[0] += 1
+            totals[1] += int(row.Size)
+
+    def __exit__(self, exc_type: type, exc_val: Any, exc_tb: Any) -> None:
+        """Function to use the session with context. Syncs the pending files, saves the running totals, records the snapshot of a completed session, closes the journal & waits for the archive before stopping the live render, then reports the bytes saved by block level delta transfer & compression. Every close runs even if an earlier one fails, and the live render is always stopped.
+
+        Args:
+            exc_type (_type_): exception type
+            exc_val (_type_): exception message
+            exc_tb (_type_): exception traceback
+        """
+        try:
+            with ExitStack() as closing:
+                # callbacks run last in first out: catalog, pending files, journal, stats & archive
+                if self.archiver is not None:
+                    closing.callback(self.archiver.close)
+                closing.callback(self.tuning.save)
+                closing.callback(self.compression.save)
+                closing.callback(self.journal.close)
+                closing.callback(self.durable.flush)
+                closing.callback(self.catalog.close)
+                save_totals(self.kinds, *self.catalog.totals(DELTA))
+                if exc_type is None:
+                    # a failed session left a partial tree, it's no point in time to restore
+                    self.catalog.snapshot()
+        finally:
+            super().__exit__(exc_type, exc_val, exc_tb)
+        if self.archiver is not None and self.archiver.members:
+            log.info(f"Archive volumes created    > {self.archiver.volumes} [{len(self.archiver.members)} files]")
+        if self.bytes_saved:
+            log.info(f"Block diff saved           > {decimal(self.bytes_saved)}")
+        if self.compression.wire:
+            raw, wire = self.compression.raw, self.compression.wire
+            log.info(f"Compression saved          > {decimal(raw - wire)} [{raw / wire:.1f}x]")
+        log.info(f"Transfer tuning            > {self.tuning.workers} workers, batched <= {decimal(self.tuning.small_size)}, large > {decimal(self.tuning.large_size)}")
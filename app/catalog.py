@@ -0,0 +1,354 @@
+import sqlite3
+from pathlib import Path
+from threading import Lock
+from typing import TYPE_CHECKING, Any, Self
+
+from app.vars import CATALOG, DELTA_COLUMNS, TIMESTAMP
+
+if TYPE_CHECKING:
+    from pandas import DataFrame
+
+
+# Locations of a file in the catalog
+BACKUP = "backup"
+DELTA = "delta"
+RECYCLE = "recycle"
+VERSION = "version"
+# Pending changes are committed once every COMMIT_EVERY updates, so an interrupted session loses little
+COMMIT_EVERY = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path     TEXT NOT NULL,
+    location TEXT NOT NULL,
+    file     TEXT NOT NULL,
+    type     TEXT NOT NULL,
+    size     INTEGER NOT NULL,
+    mtime    INTEGER NOT NULL,
+    updated  TEXT NOT NULL,
+    PRIMARY KEY (path, location)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS history (
+    path      TEXT NOT NULL,
+    event     TEXT NOT NULL,
+    location  TEXT NOT NULL,
+    size      INTEGER NOT NULL,
+    mtime     INTEGER NOT NULL,
+    timestamp TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS history_path ON history (path);
+CREATE TABLE IF NOT EXISTS hashes (
+    path   TEXT PRIMARY KEY,
+    size   INTEGER NOT NULL,
+    mtime  INTEGER NOT NULL,
+    digest TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS versions (
+    path       TEXT NOT NULL,
+    size       INTEGER NOT NULL,
+    mtime      INTEGER NOT NULL,
+    location   TEXT NOT NULL,
+    stored     TEXT NOT NULL,
+    valid_from TEXT NOT NULL,
+    valid_to   TEXT
+);
+CREATE INDEX IF NOT EXISTS versions_path ON versions (path, valid_to);
+CREATE INDEX IF NOT EXISTS versions_stored ON versions (location, stored);
+CREATE INDEX IF NOT EXISTS versions_time ON versions (valid_from, valid_to);
+CREATE TABLE IF NOT EXISTS snapshots (
+    timestamp TEXT PRIMARY KEY,
+    files     INTEGER NOT NULL,
+    bytes     INTEGER NOT NULL
+) WITHOUT ROWID;
+"""
+
+DELTA_QUERY = f"""
+SELECT s.file, s.type, s.size, NULL, s.mtime, NULL, s.path, NULL, 'add' FROM scan s
+    WHERE NOT EXISTS (SELECT 1 FROM files f WHERE f.path = s.path AND f.location = '{BACKUP}')
+UNION ALL
+SELECT f.file, f.type, f.size, NULL, f.mtime, NULL, f.path, NULL, 'remove' FROM files f
+    WHERE f.location = '{BACKUP}' AND NOT EXISTS (SELECT 1 FROM scan s WHERE s.path = f.path)
+UNION ALL
+SELECT s.file, s.type, s.size, f.size, s.mtime, f.mtime, s.path, NULL, 'modify' FROM scan s
+    JOIN files f ON f.path = s.path AND f.location = '{BACKUP}'
+    WHERE s.size != f.size OR s.mtime != f.mtime
+"""
+
+
+class Catalog:
+    """Persistent SQLite catalog of the backup state of a device. Every file is recorded with its location (`backup` for the merged backup dir, `delta` for pulled but not yet merged files) and every change is appended to `history`. Content hashes of local files are cached in `hashes`.
+
+    Every version of a file is kept in `versions` with the time range it was on the device (`valid_from` inclusive, `valid_to` exclusive) and where its content is stored: `location` & `stored` are either a device path in backup or delta dir, or a path within versions dir for superseded & removed files. A snapshot is the set of versions valid at its timestamp.
+    """
+    def __init__(self, file: Path = CATALOG) -> None:
+        """Opens the catalog `file`, creates the schema if required
+
+        Args:
+            file (Path, optional): Catalog database file. Defaults to CATALOG.
+        """
+        file.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(file, check_same_thread=False)
+        self.connection.executescript(SCHEMA)
+        # Lock that serializes updates coming from multiple pull workers
+        self.lock = Lock()
+        self.pending = 0
+        self.seed_versions()
+
+    def seed_versions(self) -> None:
+        """Function that records the current files as the first versions, for catalogs created before versions
+        """
+        with self.lock:
+            if self.connection.execute("SELECT 1 FROM versions LIMIT 1").fetchone() is None:
+                self.connection.execute("INSERT INTO versions SELECT path, size, mtime, location, path, ?, NULL FROM files", (TIMESTAMP,))
+                self.connection.commit()
+
+    def is_empty(self) -> bool:
+        """Function that checks whether the catalog has any file recorded
+
+        Returns:
+            bool: True if empty
+        """
+        return self.connection.execute("SELECT 1 FROM files LIMIT 1").fetchone() is None
+
+    def load(self, dataframe: "DataFrame", location: str = BACKUP) -> None:
+        """Function that bulk loads a manifest `dataframe` into the catalog. Used to migrate the device dataframe of backups taken before the catalog.
+
+        Args:
+            dataframe (DataFrame): Manifest dataframe
+            location (str, optional): Location of the files. Defaults to BACKUP.
+        """
+        rows = zip(dataframe["Path"], dataframe["File"], dataframe["Type"].fillna(""), dataframe["Size"], dataframe["Date"])
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                ((path, location, file, kind, int(size), int(mtime), TIMESTAMP) for path, file, kind, size, mtime in rows),
+            )
+            self.connection.commit()
+        self.seed_versions()
+
+    def delta(self, dataframe: "DataFrame") -> "DataFrame":
+        """Function that calculates the delta between the scanned manifest `dataframe` and the backup state with indexed queries
+
+        Args:
+            dataframe (DataFrame): Manifest dataframe of current scan
+
+        Returns:
+            DataFrame: Delta dataframe with DELTA_COLUMNS
+        """
+        rows = zip(dataframe["Path"], dataframe["File"], dataframe["Type"].fillna(""), dataframe["Size"], dataframe["Date"])
+        with self.lock:
+            self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS scan (path TEXT PRIMARY KEY, file TEXT, type TEXT, size INTEGER, mtime INTEGER) WITHOUT ROWID")
+            self.connection.execute("DELETE FROM scan")
+            self.connection.executemany("INSERT INTO scan VALUES (?, ?, ?, ?, ?)", ((path, file, kind, int(size), int(mtime)) for path, file, kind, size, mtime in rows))
+            records = self.connection.execute(DELTA_QUERY).fetchall()
+            self.connection.execute("DROP TABLE scan")
+        from pandas import DataFrame
+        return DataFrame(records, columns=DELTA_COLUMNS)
+
+    def record(self, path: str, file: str, kind: str, size: int, mtime: int, location: str, event: str) -> None:
+        """Function that records a file at `location` and appends the `event` to history
+
+        Args:
+            path (str): Device path of the file
+            file (str): File name
+            kind (str): File type (suffix)
+            size (int): File size
+            mtime (int): Modified time in epoch seconds
+            location (str): Location of the file
+            event (str): History event name
+        """
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)", (path, location, file, kind, size, mtime, TIMESTAMP))
+            self.connection.execute("INSERT INTO history VALUES (?, ?, ?, ?, ?, ?)", (path, event, location, size, mtime, TIMESTAMP))
+            # an unmerged version is overwritten by the new pull, so it's dropped instead of closed
+            self.connection.execute(f"DELETE FROM versions WHERE path = ? AND valid_to IS NULL AND location = '{DELTA}'", (path,))
+            self.connection.execute("UPDATE versions SET valid_to = ? WHERE path = ? AND valid_to IS NULL", (TIMESTAMP, path))
+            self.connection.execute("INSERT INTO versions VALUES (?, ?, ?, ?, ?, ?, NULL)", (path, size, mtime, location, path, TIMESTAMP))
+            self.changed()
+
+    def remove(self, path: str, location: str, event: str, new_location: str) -> None:
+        """Function that removes a file from `location` and appends the `event` to history with the `new_location` of the file
+
+        Args:
+            path (str): Device path of the file
+            location (str): Current location of the file
+            event (str): History event name
+            new_location (str): Location the file is moved to
+        """
+        with self.lock:
+            row = self.connection.execute("SELECT size, mtime FROM files WHERE path = ? AND location = ?", (path, location)).fetchone()
+            if row is None:
+                return
+            self.connection.execute("DELETE FROM files WHERE path = ? AND location = ?", (path, location))
+            self.connection.execute("INSERT INTO history VALUES (?, ?, ?, ?, ?, ?)", (path, event, new_location, *row, TIMESTAMP))
+            self.connection.execute("UPDATE versions SET valid_to = ? WHERE path = ? AND valid_to IS NULL", (TIMESTAMP, path))
+            self.changed()
+
+    def relocate(self, location: str, stored: str, new_location: str | None, new_stored: str | None = None) -> None:
+        """Function that updates the versions whose content is moved from `stored` at `location`. With `new_location` None the content is lost, so its closed versions are dropped.
+
+        Args:
+            location (str): Current location of the content
+            stored (str): Current path of the content
+            new_location (str | None): New location of the content
+            new_stored (str | None, optional): New path of the content. Defaults to None.
+        """
+        with self.lock:
+            if new_location is None:
+                self.connection.execute("DELETE FROM versions WHERE location = ? AND stored = ? AND valid_to IS NOT NULL", (location, stored))
+            else:
+                self.connection.execute("UPDATE versions SET location = ?, stored = ? WHERE location = ? AND stored = ?", (new_location, new_stored, location, stored))
+            self.changed()
+
+    def superseded(self, path: str) -> bool:
+        """Function that checks whether a closed version is stored as the backed up copy of `path`
+
+        Args:
+            path (str): Device path
+
+        Returns:
+            bool: True if the copy belongs to a past version
+        """
+        with self.lock:
+            return self.connection.execute(f"SELECT 1 FROM versions WHERE location = '{BACKUP}' AND stored = ? AND valid_to IS NOT NULL LIMIT 1", (path,)).fetchone() is not None
+
+    def snapshot(self) -> tuple[int, int]:
+        """Function that records a snapshot of the device at TIMESTAMP, it's the set of open versions
+
+        Returns:
+            tuple[int, int]: Total files & bytes of the snapshot
+        """
+        with self.lock:
+            files, size = self.connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM versions WHERE valid_to IS NULL").fetchone()
+            self.connection.execute("INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?)", (TIMESTAMP, files, size))
+            self.connection.commit()
+        return files, size
+
+    def snapshots(self) -> list[tuple[str, int, int]]:
+        """Function that lists the recorded snapshots
+
+        Returns:
+            list[tuple[str, int, int]]: Timestamp, total files & bytes of each snapshot
+        """
+        with self.lock:
+            return self.connection.execute("SELECT timestamp, files, bytes FROM snapshots ORDER BY timestamp").fetchall()
+
+    def versions_at(self, timestamp: str) -> list[tuple[str, int, int, str, str]]:
+        """Function that lists the versions valid at `timestamp`
+
+        Args:
+            timestamp (str): Snapshot timestamp
+
+        Returns:
+            list[tuple[str, int, int, str, str]]: Path, size, mtime, location & stored path of each version
+        """
+        with self.lock:
+            return self.connection.execute(
+                "SELECT path, size, mtime, location, stored FROM versions WHERE valid_from <= ? AND (valid_to IS NULL OR valid_to > ?)",
+                (timestamp, timestamp),
+            ).fetchall()
+
+    def expire(self, cutoff: str) -> list[str]:
+        """Function that drops the versions that ended & the snapshots taken before `cutoff`
+
+        Args:
+            cutoff (str): Oldest timestamp to be kept
+
+        Returns:
+            list[str]: Stored paths within versions dir that no version refers to anymore
+        """
+        with self.lock:
+            expired = self.connection.execute(f"SELECT DISTINCT stored FROM versions WHERE valid_to < ? AND location = '{VERSION}'", (cutoff,)).fetchall()
+            self.connection.execute("DELETE FROM versions WHERE valid_to < ?", (cutoff,))
+            # the latest snapshot is always kept
+            self.connection.execute("DELETE FROM snapshots WHERE timestamp < ? AND timestamp < (SELECT MAX(timestamp) FROM snapshots)", (cutoff,))
+            orphans = [stored for stored, in expired if self.connection.execute(f"SELECT 1 FROM versions WHERE location = '{VERSION}' AND stored = ? LIMIT 1", (stored,)).fetchone() is None]
+            self.connection.commit()
+        return orphans
+
+    def paths(self, location: str) -> list[str]:
+        """Function that lists the paths of every file at `location`
+
+        Args:
+            location (str): Location of the files
+
+        Returns:
+            list[str]: Device paths
+        """
+        with self.lock:
+            return [path for path, in self.connection.execute("SELECT path FROM files WHERE location = ?", (location,))]
+
+    def totals(self, location: str) -> tuple[int, int]:
+        """Function that counts the files at `location` and their total size
+
+        Args:
+            location (str): Location of the files
+
+        Returns:
+            tuple[int, int]: Total files & bytes
+        """
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM files WHERE location = ?", (location,)).fetchone()
+
+    def digest(self, path: str, size: int, mtime: int) -> str | None:
+        """Function that looks up the cached content hash of a local file, valid only while its size & mtime are unchanged
+
+        Args:
+            path (str): Path of the file relative to backup dir
+            size (int): File size
+            mtime (int): Modified time in nanoseconds
+
+        Returns:
+            str | None: Hex digest or None if not cached
+        """
+        with self.lock:
+            row = self.connection.execute("SELECT digest FROM hashes WHERE path = ? AND size = ? AND mtime = ?", (path, size, mtime)).fetchone()
+        return row[0] if row else None
+
+    def record_digest(self, path: str, size: int, mtime: int, digest: str) -> None:
+        """Function that caches the content hash of a local file
+
+        Args:
+            path (str): Path of the file relative to backup dir
+            size (int): File size
+            mtime (int): Modified time in nanoseconds
+            digest (str): Hex digest
+        """
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?)", (path, size, mtime, digest))
+            self.changed()
+
+    def promote(self) -> int:
+        """Function that marks every `delta` file as `backup`, used once the delta dir is merged into backup dir
+
+        Returns:
+            int: Total files promoted
+        """
+        with self.lock:
+            self.connection.execute(f"INSERT INTO history SELECT path, 'merge', '{BACKUP}', size, mtime, ? FROM files WHERE location = '{DELTA}'", (TIMESTAMP,))
+            self.connection.execute(f"INSERT OR REPLACE INTO files SELECT path, '{BACKUP}', file, type, size, mtime, ? FROM files WHERE location = '{DELTA}'", (TIMESTAMP,))
+            total = self.connection.execute(f"DELETE FROM files WHERE location = '{DELTA}'").rowcount
+            self.connection.execute(f"UPDATE versions SET location = '{BACKUP}' WHERE location = '{DELTA}'")
+            self.connection.commit()
+        return total
+
+    def changed(self) -> None:
+        """Function that counts a pending change and commits once COMMIT_EVERY changes are pending. Caller must hold the lock.
+        """
+        self.pending += 1
+        if self.pending >= COMMIT_EVERY:
+            self.connection.commit()
+            self.pending = 0
+
+    def close(self) -> None:
+        """Function that commits pending changes and closes the catalog
+        """
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, exc_type: type, exc_val: Any, exc_tb: Any) -> None:
+        self.close()
@@ -0,0 +1,108 @@
+import json
+import zlib
+from pathlib import Path
+from threading import Lock
+
+from app.vars import COMPRESS_RATIO, COMPRESS_SAMPLE, COMPRESS_STATS, COMPRESS_WINDOW
+from utils import UTF_8
+from utils.android import shell
+
+
+# Device side compressor, output is a gzip stream decompressed by the host while it arrives
+COMPRESS_COMMAND = "gzip -1 -c"
+# zlib wbits that accept a gzip header & trailer
+GZIP_WBITS = 31
+
+
+def available() -> bool:
+    """Function that checks whether the device has a working gzip
+
+    Returns:
+        bool: True if available
+    """
+    output = shell(f"echo 0 | {COMPRESS_COMMAND} | wc -c").strip()
+    return output.isdigit() and int(output) > 0
+
+
+class Policy:
+    """Adaptive compression policy. A sample of every pulled file is compressed on the host to measure the ratio of its type, types whose ratio stays below COMPRESS_RATIO are pulled raw & stored without compression in archives. Ratios are persisted, so the policy keeps adapting across sessions.
+    """
+    def __init__(self, file: Path = COMPRESS_STATS, enabled: bool = True) -> None:
+        """Loads the ratio stats from `file` and checks the device for gzip
+
+        Args:
+            file (Path, optional): Stats file. Defaults to COMPRESS_STATS.
+            enabled (bool, optional): Whether compressed transfers are allowed at all, ratios are measured either way. Defaults to True.
+        """
+        self.file = file
+        # Sampled raw & compressed bytes of each type
+        self.stats: dict[str, list[int]] = {}
+        if file.exists():
+            with open(file, "r", encoding=UTF_8) as fr:
+                self.stats = json.load(fr)
+        self.enabled = enabled and available()
+        # Raw & on the wire bytes of the compressed transfers of this session
+        self.raw = 0
+        self.wire = 0
+        self.lock = Lock()
+
+    def worth(self, kind: str) -> bool:
+        """Function that decides whether files of a type are pulled compressed. Types without enough samples are compressed, so their ratio gets measured.
+
+        Args:
+            kind (str): File type (suffix)
+
+        Returns:
+            bool: True if compression is worth it
+        """
+        return self.enabled and self.compressible(kind)
+
+    def compressible(self, kind: str) -> bool:
+        """Function that checks whether the measured ratio of a type is at least COMPRESS_RATIO. Types without enough samples are treated as compressible.
+
+        Args:
+            kind (str): File type (suffix)
+
+        Returns:
+            bool: True if compressible
+        """
+        raw, packed = self.stats.get(kind, (0, 0))
+        return raw < COMPRESS_SAMPLE or raw >= packed * COMPRESS_RATIO
+
+    def sample(self, kind: str, file: Path) -> None:
+        """Function that measures the ratio of a pulled `file` by compressing its first COMPRESS_SAMPLE bytes with the same level as the device. Stats of a type are halved once they exceed COMPRESS_WINDOW, so recent files outweigh old ones.
+
+        Args:
+            kind (str): File type (suffix)
+            file (Path): Local file path
+        """
+        with open(file, "rb") as fr:
+            data = fr.read(COMPRESS_SAMPLE)
+        if not data:
+            return
+        packed = len(zlib.compress(data, 1))
+        with self.lock:
+            stats = self.stats.setdefault(kind, [0, 0])
+            stats[0] += len(data)
+            stats[1] += packed
+            if stats[0] > COMPRESS_WINDOW:
+                stats[0] //= 2
+                stats[1] //= 2
+
+    def transferred(self, raw: int, wire: int) -> None:
+        """Function that counts a compressed transfer
+
+        Args:
+            raw (int): Decompressed bytes
+            wire (int): Bytes on the wire
+        """
+        with self.lock:
+            self.raw += raw
+            self.wire += wire
+
+    def save(self) -> None:
+        """Function that persists the ratio stats
+        """
+        self.file.parent.mkdir(parents=True, exist_ok=True)
+        with self.lock, open(self.file, "w", encoding=UTF_8) as fw:
+            json.dump(self.stats, fw, indent=2, sort_keys=True)
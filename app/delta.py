@@ -1,32 +1,48 @@
-from pathlib import Path
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import file_digest
+from pathlib import Path, PurePosixPath
+from shlex import quote
 from shutil import copy2, move
-from subprocess import run
 from typing import NamedTuple
 
 from colorama import Fore
-from pandas import DataFrame, concat, read_csv
+from pandas import DataFrame, concat
+from rich.filesize import decimal
 from send2trash import send2trash
 
+from app import manifest, snapshot
+from app.catalog import DELTA, Catalog
+from app.store import ObjectStore
+from app.transfer import part_of
 from app.vars import (
+    ARCHIVE_DIR,
     BACKUP_DIR,
-    BACKUP_ROOT,
-    CLEANED_METADATA,
-    DATA_DIR,
+    BACKUP_NAME,
+    CATALOG,
     DATAFRAME,
+    DEDUP,
     DELTA_COLUMNS,
     DELTA_DATAFRAME,
     DELTA_DIR,
+    DELTA_TOTALS,
     DEVICE_DATAFRAME,
-    MYPASS,
-    RAR_EXECUTABLE,
-    RAW_METADATA,
+    DEVICE_ROOT,
+    JOURNAL,
+    MERGE_WORKERS,
+    MOVE_HASH_CHECK,
     TIMESTAMP,
 )
-from utils import UTF_8_SIG, log
-from utils.android import DEVICE_MODEL
+from utils import UTF_8, log
+from utils.android import shell
 from utils.terminal import colorize, previous_line
 
 
+# Device paths hashed by a single md5sum command
+MD5SUM_BATCH = 64
+
+
 class DeltaNamedTuple(NamedTuple):
     """A named tuple to enable typing hints for Deltaframe itertuples.
     """
@@ -35,9 +51,10 @@ class DeltaNamedTuple(NamedTuple):
     Type: str
     Size: int
     Size_old: int
-    Date: str
-    Date_old: str
+    Date: int
+    Date_old: int
     Path: str
+    Path_old: str
     Kind: str
 
     
@@ -51,67 +68,176 @@ def calculate() -> None:
     src_file = DATAFRAME
     dst_file = DELTA_DATAFRAME
     cmp_file = DEVICE_DATAFRAME
-    # read both dataframes
-    current_df = read_csv(src_file, encoding=UTF_8_SIG)
-    if cmp_file.exists():
-        backed_up_df = read_csv(cmp_file, encoding=UTF_8_SIG)
-    else:
-        backed_up_df = DataFrame(columns=current_df.columns)
-    # calculate delta as additions, deletions and modifications
-    additions = current_df[~current_df["Path"].isin(backed_up_df["Path"])].copy()
-    deletions = backed_up_df[~backed_up_df["Path"].isin(current_df["Path"])].copy()
-    merged = current_df.merge(backed_up_df, on="Path", suffixes=("", "_old"))
-    modifications = merged[(merged['Size'] != merged['Size_old']) | (merged['Date'] != merged['Date_old'])].copy()
-    # add operation tag as kind
-    additions["Kind"] = "add"
-    deletions["Kind"] = "remove"
-    modifications['Kind'] = "modify"
-    # concat into single delta frame and save
-    delta_df = concat([additions, deletions, modifications])[DELTA_COLUMNS]
-    delta_df.to_csv(dst_file, index=False, encoding=UTF_8_SIG)
+    # read current dataframe
+    current_df = manifest.load(src_file)
+    with Catalog() as catalog:
+        if catalog.is_empty() and manifest.exists(cmp_file):
+            # backups taken before the catalog only have the device dataframe
+            log.info(f"Importing device dataframe into catalog > {CATALOG}")
+            catalog.load(manifest.load(cmp_file))
+        # calculate delta as additions, deletions and modifications with indexed queries
+        delta_df = catalog.delta(current_df)
+    # pair deletions with additions of the same file as moves
+    delta_df = detect_moves(delta_df)
+    manifest.save(delta_df, dst_file)
+    kinds = delta_df["Kind"].value_counts()
     log.info(f"Delta DataFrame saved as   > {dst_file}")
     # print stats
     log.info(
         f"Total operations:          > "
         f"{colorize(len(delta_df), Fore.BLUE)} ["
-        f"{colorize(f"+{len(additions)}", Fore.GREEN)}, "
-        f"{colorize(f"~{len(modifications)}", Fore.YELLOW)}, "
-        f"{colorize(f"-{len(deletions)}", Fore.RED)}]"
+        f"{colorize(f"+{kinds.get("add", 0)}", Fore.GREEN)}, "
+        f"{colorize(f"~{kinds.get("modify", 0)}", Fore.YELLOW)}, "
+        f"{colorize(f"-{kinds.get("remove", 0)}", Fore.RED)}, "
+        f"{colorize(f"»{kinds.get("move", 0)}", Fore.MAGENTA)}]"
     )
+
+
+def detect_moves(delta_df: DataFrame) -> DataFrame:
+    """Function that pairs `remove` rows with `add` rows of a file that matches on name, size & mtime, and replaces each pair with a single `move` row. Moves are applied as local renames within the backup dir, so the file is never pulled again. With MOVE_HASH_CHECK, the content of each pair is verified with md5 hashes too.
+
+    Args:
+        delta_df (DataFrame): Delta dataframe
+
+    Returns:
+        DataFrame: Delta dataframe with move rows
+    """
+    keys = ["File", "Size", "Date"]
+    additions = delta_df[delta_df["Kind"] == "add"]
+    deletions = delta_df[delta_df["Kind"] == "remove"]
+    # n-th addition of a key is paired with the n-th deletion of the same key
+    additions = additions.assign(Pair=additions.groupby(keys).cumcount()).reset_index()
+    deletions = deletions.assign(Pair=deletions.groupby(keys).cumcount()).reset_index()
+    columns = ["index", "Path", "Pair", *keys]
+    pairs = additions[columns].merge(deletions[columns], on=[*keys, "Pair"], suffixes=("", "_old"))
+    if MOVE_HASH_CHECK and len(pairs):
+        pairs = pairs[same_content(list(pairs["Path"]), list(pairs["Path_old"]))]
+    moves = delta_df.loc[pairs["index"]].copy()
+    moves["Path_old"] = pairs["Path_old"].values
+    moves["Kind"] = "move"
+    rest = delta_df.drop(index=[*pairs["index"], *pairs["index_old"]])
+    return concat([rest, moves], ignore_index=True)[DELTA_COLUMNS]
+
+
+def same_content(paths: list[str], old_paths: list[str]) -> list[bool]:
+    """Function that compares md5 hashes of device `paths` with the hashes of backed up `old_paths`
+
+    Args:
+        paths (list[str]): Device file paths
+        old_paths (list[str]): Device file paths of backed up copies
+
+    Returns:
+        list[bool]: True for each pair with the same content
+    """
+    log.info(f"Verifying {len(paths)} moves with content hashes")
+    device_hashes = md5sums(paths)
+    return [device_hashes.get(path) == file_md5(BACKUP_DIR/PurePosixPath(old_path).relative_to(DEVICE_ROOT)) for path, old_path in zip(paths, old_paths)]
+
+
+def md5sums(paths: list[str]) -> dict[str, str]:
+    """Function that hashes device files with `md5sum` on the device itself
+
+    Args:
+        paths (list[str]): Device file paths relative to `/`
+
+    Returns:
+        dict[str, str]: md5 hex digest of each path
+    """
+    hashes = {}
+    for index in range(0, len(paths), MD5SUM_BATCH):
+        output = shell(f"cd / && md5sum {" ".join(map(quote, paths[index:index+MD5SUM_BATCH]))} 2>/dev/null")
+        for line in output.splitlines():
+            digest, _, path = line.partition("  ")
+            hashes[path] = digest
+    return hashes
+
+
+def file_md5(file: Path) -> str | None:
+    """Function that hashes a local file with md5
+
+    Args:
+        file (Path): Local file path
+
+    Returns:
+        str | None: md5 hex digest, None if the file doesn't exist
+    """
+    if not file.exists():
+        return None
+    with open(file, "rb") as fr:
+        return file_digest(fr, "md5").hexdigest()
+
     
-def size() -> int:
-    """Function that calculates the size of delta backup. Used to determine whether the delta is big enough to archive and merge with main backup dir or not.
+def size(verify: bool = False) -> int:
+    """Function that returns the size of delta backup. Used to determine whether the delta is big enough to archive and merge with main backup dir or not. Size is read from the totals saved by the backup session, the delta dir is walked only if totals are missing or to `verify` them.
+
+    Args:
+        verify (bool, optional): Cross check the totals against the files on disk. Defaults to False.
 
     Returns:
         int: Size of delta dir
     """
+    totals = load_totals()
+    if totals is not None and not verify:
+        return totals["delta"]["bytes"]
     # Recursively calculate the size of DELTA_DIR
     total_delta_size = sum([file.stat().st_size for file in DELTA_DIR.rglob("*") if file.is_file()])
+    if totals is not None and totals["delta"]["bytes"] != total_delta_size:
+        log.info(f"Delta totals mismatch      > {totals["delta"]["bytes"]} saved, {total_delta_size} on disk")
     return total_delta_size
 
+
+def save_totals(kinds: dict[str, list[int]], files: int, size: int) -> None:
+    """Function that saves the totals of a backup session alongside the deltaframe
+
+    Args:
+        kinds (dict[str, list[int]]): Files & bytes handled by the session for each kind
+        files (int): Total files in delta dir
+        size (int): Total bytes in delta dir
+    """
+    totals = {
+        "kinds": {kind: {"files": count, "bytes": total} for kind, (count, total) in kinds.items()},
+        "delta": {"files": files, "bytes": size},
+        "timestamp": TIMESTAMP,
+    }
+    DELTA_TOTALS.parent.mkdir(parents=True, exist_ok=True)
+    with open(DELTA_TOTALS, "w", encoding=UTF_8) as fw:
+        json.dump(totals, fw, indent=2)
+
+
+def load_totals() -> dict | None:
+    """Function that loads the totals saved by the last backup session
+
+    Returns:
+        dict | None: Totals or None if not saved yet
+    """
+    if not DELTA_TOTALS.exists():
+        return None
+    with open(DELTA_TOTALS, "r", encoding=UTF_8) as fr:
+        return json.load(fr)
+
+
+def summary() -> None:
+    """Function that prints the summary of the last backup session from its totals
+    """
+    totals = load_totals()
+    if totals is None:
+        return
+    for kind, color in (("add", Fore.GREEN), ("modify", Fore.YELLOW), ("remove", Fore.RED), ("move", Fore.MAGENTA)):
+        kind_totals = totals["kinds"].get(kind, {"files": 0, "bytes": 0})
+        log.info(f"{kind.capitalize():<27}> {colorize(kind_totals["files"], color)} files [{decimal(kind_totals["bytes"])}]")
+    log.info(f"Delta dir                  > {totals["delta"]["files"]} files [{decimal(totals["delta"]["bytes"])}]")
+
+
 def archive() -> None:
-    """Function that creates password protected rar archives of 1GB each for online backup.
+    """Function that completes the archive for online backup. Pulled files are already archived into encrypted volumes by the backup session, only the dataframes are copied next to them.
     """
-    # Copying Dataframes into delta dir
+    # Copying Dataframes into archive dir
     previous_line()
-    # skip if rar exe is not available
-    if not RAR_EXECUTABLE.exists():
-        return
-    copy2(DATAFRAME, BACKUP_ROOT/f"dataframe-{TIMESTAMP}.csv")
-    copy2(DELTA_DATAFRAME, BACKUP_ROOT/f"deltaframe-{TIMESTAMP}.csv")
+    ARCHIVE_DIR.mkdir(parents=True, exist_ok=True)
+    copy2(DATAFRAME, ARCHIVE_DIR/f"{BACKUP_NAME}-{DATAFRAME.stem}-{TIMESTAMP}{DATAFRAME.suffix}")
+    copy2(DELTA_DATAFRAME, ARCHIVE_DIR/f"{BACKUP_NAME}-{DELTA_DATAFRAME.stem}-{TIMESTAMP}{DELTA_DATAFRAME.suffix}")
     cleanup()
-    # current date as time stamp for delta archives
-    rar_name = f"{DEVICE_MODEL}-{TIMESTAMP}.rar"
-    rar_path = BACKUP_ROOT/rar_name
-    # Subprocess args with all required flags to create rar archives
-    args = [RAR_EXECUTABLE, "a", "-m0", "-v1024m", f"-hp{MYPASS}", "-ep1", rar_path, DELTA_DIR]
-    log.info(f"Archiving delta for online backup | Timestamp: {TIMESTAMP}")
-    resp = run(args, shell=True)
-    if resp.returncode != 0:
-        # If archive process is interrupted exit program without merge
-        log.error("Delta archiving is interrupted")
-    total_rars = len(list(filter(lambda x: x.suffix == ".rar", BACKUP_ROOT.iterdir())))
-    log.info(f"Archive complete. Total archives created: {total_rars}")
+    log.info(f"Archive complete. Timestamp: {TIMESTAMP}")
 
 
 def cleanup(delete_df=False) -> None:
@@ -120,7 +246,6 @@ def cleanup(delete_df=False) -> None:
     Args:
         delete_df (bool, optional): Flag that decides whether to delete main df or move it to delta_dir. Defaults to False.
     """
-    send2trash([DATA_DIR/RAW_METADATA, CLEANED_METADATA])
     replace(DELTA_DATAFRAME, DELTA_DIR)
     if delete_df:
         send2trash(DATAFRAME)
@@ -141,21 +266,81 @@ def replace(src: Path, dst: Path) -> None:
         return
 
 
-def merge() -> None:
-    """Function that finally merges delta into one single device backup
+def merge(workers: int = MERGE_WORKERS) -> None:
+    """Function that finally merges delta into one single device backup. Files to be merged are taken from the deltaframe & the `delta` files of catalog instead of walking the delta dir, their destination dirs are created once and files are renamed in place. Files of a delta dir on another volume are moved by a pool of `workers`. Backed up copies replaced by the merge are moved into the versions dir first. An interrupted merge can be run again, files that are already merged are skipped.
+
+    Args:
+        workers (int, optional): Parallel moves when delta & backup dirs are on different volumes. Defaults to MERGE_WORKERS.
     """
     # Create backup dir for device if not exists
     BACKUP_DIR.mkdir(parents=True, exist_ok=True)
-    # Move everything in delta dir to backup dir
-    # [move(x, BACKUP_DIR) for x in DELTA_DIR.iterdir()]
-    for src_file in DELTA_DIR.rglob("*"):
-        if src_file.is_file():
-            dst_file = BACKUP_DIR/src_file.relative_to(DELTA_DIR)
-            dst_file.parent.mkdir(parents=True, exist_ok=True)
-            move(src_file, dst_file)
-    # delete Delta dir
-    send2trash(BACKUP_ROOT/"Delta")
+    with Catalog() as catalog:
+        # Plan all moves: pulled rows of the deltaframe (moved into delta dir by `cleanup`) & files left by earlier unmerged sessions
+        paths = set(catalog.paths(DELTA))
+        for delta_file in (DELTA_DATAFRAME, DELTA_DIR/DELTA_DATAFRAME.name):
+            if manifest.exists(delta_file):
+                delta_df = manifest.load(delta_file, columns=["Path", "Kind"])
+                paths.update(delta_df.loc[delta_df["Kind"] != "remove", "Path"])
+                break
+        plan = {DELTA_DIR/relative: BACKUP_DIR/relative for relative in (PurePosixPath(path).relative_to(DEVICE_ROOT) for path in paths)}
+        device_files = list(plan.values())
+        # Manifests copied into delta dir are merged too, the dataframe becomes the device dataframe
+        if DELTA_DIR.exists():
+            plan.update({src_file: BACKUP_DIR/src_file.name for src_file in DELTA_DIR.iterdir() if src_file.is_file()})
+        # Backed up copies replaced by a pulled copy are kept as past versions, moved files have no pulled copy & stay in place
+        kept = sum(snapshot.keep(catalog, path) for path in paths if (DELTA_DIR/PurePosixPath(path).relative_to(DEVICE_ROOT)).exists())
+        # Create every destination dir once
+        for dir_path in sorted({dst_file.parent for dst_file in plan.values()}):
+            dir_path.mkdir(parents=True, exist_ok=True)
+        # Move everything in delta dir to backup dir, a rename if both are on the same volume
+        if DELTA_DIR.exists() and DELTA_DIR.stat().st_dev == BACKUP_DIR.stat().st_dev:
+            merged = sum(map(merge_file, plan, plan.values()))
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                merged = sum(pool.map(merge_file, plan, plan.values(), [False] * len(plan)))
+        if DEDUP:
+            # link merged files to the object store, objects of replaced files are deleted
+            store = ObjectStore(catalog)
+            log.info(f"Deduplicated merged files  > {decimal(store.add_all(device_files))} saved [{store.gc()} objects deleted]")
+        # mark merged files as backed up in catalog
+        catalog.promote()
+    # drop the versions past retention
+    expired = snapshot.gc()
+    # delete Delta dir of the device, journal of the pulls into it is no longer required. Delta dirs of other devices may still be in use.
+    if DELTA_DIR.exists():
+        send2trash(DELTA_DIR)
+    try:
+        DELTA_DIR.parent.rmdir()
+    except OSError:
+        # not empty, another device is merging or pulling, or already removed
+        pass
+    JOURNAL.unlink(missing_ok=True)
+    DELTA_TOTALS.unlink(missing_ok=True)
     # log updates and exit
-    log.info("Delta merged with Device backup folder")
+    log.info(f"Delta merged with Device backup folder [{merged} files]")
+    log.info(f"Versions kept              > {kept} [{expired} expired]")
     log.info("Backup complete!")
-    
\ No newline at end of file
+
+
+def merge_file(src_file: Path, dst_file: Path, same_volume: bool = True) -> bool:
+    """Function that merges a single file of delta dir into backup dir. On the same volume it's an atomic rename, otherwise it's copied into a temp file that's renamed into place before the source is removed.
+
+    Args:
+        src_file (Path): File in delta dir
+        dst_file (Path): File in backup dir
+        same_volume (bool, optional): Both files are on the same volume. Defaults to True.
+
+    Returns:
+        bool: True if merged, False if the source doesn't exist (already merged or never pulled)
+    """
+    try:
+        if same_volume:
+            os.replace(src_file, dst_file)
+        else:
+            part_file = part_of(dst_file)
+            copy2(src_file, part_file)
+            os.replace(part_file, dst_file)
+            src_file.unlink()
+    except FileNotFoundError:
+        return False
+    return True
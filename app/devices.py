@@ -0,0 +1,204 @@
+import os
+import sys
+import traceback
+from collections import Counter
+from contextlib import AbstractContextManager, contextmanager
+from multiprocessing import get_context
+from multiprocessing.queues import Queue
+from pathlib import Path
+from queue import Empty
+from threading import Event
+from typing import TYPE_CHECKING, Callable, Iterator
+
+from app.render import DevicesRender
+from app.vars import DATA_DIR, HOST_WRITERS, MERGE_SIZE, PROGRESS_INTERVAL
+from utils import UTF_8, log
+from utils.android import connect, device_serials
+from utils.thread import ExceptionalThread
+
+if TYPE_CHECKING:
+    from app import backup
+
+
+# Stages reported by a device worker once it's finished
+DONE = "Done"
+FAILED = "Failed"
+# Seconds between two progress reports of a device worker
+REPORT_INTERVAL = PROGRESS_INTERVAL * 5
+
+# Callback that receives the stage, bytes handled & total bytes of a backup
+Report = Callable[[str, int, int], None]
+
+
+def run(full_scan: bool = False, verify: bool = False, live: bool = True, gate: AbstractContextManager | None = None, report: Report | None = None, headless: bool = False) -> None:
+    """Function that runs the whole backup pipeline (scan, delta, pull & merge) of the connected device
+
+    Args:
+        full_scan (bool, optional): Ignore the scan cache and list every directory. Defaults to False.
+        verify (bool, optional): Cross check the delta totals against the files on disk. Defaults to False.
+        live (bool, optional): Render the backup session live on the terminal. Defaults to True.
+        gate (AbstractContextManager | None, optional): Semaphore held around every pull. Defaults to None.
+        report (Report | None, optional): Progress callback, polled from the backup session. Defaults to None.
+        headless (bool, optional): Print JSON lines of progress instead of the live render. Defaults to False.
+    """
+    # Modules of the pipeline resolve the paths of the device on import, so they are imported once the device is known
+    from app import backup, delta, metadata
+    report = report or (lambda stage, completed, total: None)
+    # Fetch raw metadata from device & create a datatframe
+    report("Metadata", 0, 0)
+    metadata.fetch(full_scan=full_scan)
+    # Calculate delta dataframe for minimal operations
+    report("Delta", 0, 0)
+    delta.calculate()
+    # Backup session context to handle live render enter and exit
+    with backup.session(live, gate, headless) as bkp:
+        stopped = Event()
+        watcher = ExceptionalThread(target=watch, args=(bkp, report, stopped))
+        watcher.start()
+        try:
+            # Run the backup
+            bkp.run(mock=False)
+        finally:
+            stopped.set()
+            watcher.join()
+    # Print the totals of the session
+    delta.summary()
+    # Check if delta size exceed MERGE_SIZE [1.0 GB by default]
+    if delta.size(verify=verify) >= MERGE_SIZE:
+        # if yes, create archive for online backup and merge delta with main backup dir
+        report("Merge", int(bkp.total_size), int(bkp.total_size))
+        delta.archive()
+        delta.merge()
+    else:
+        # else simply clean up the data dir of the repository
+        delta.cleanup(delete_df=True)
+
+
+def watch(bkp: "backup.session", report: Report, stopped: Event) -> None:
+    """Function that reports the progress of a backup session every REPORT_INTERVAL seconds until it's stopped
+
+    Args:
+        bkp (backup.session): Running backup session
+        report (Report): Progress callback
+        stopped (Event): Set once the session is over
+    """
+    task = bkp.main_progress_bar.tasks[0]
+    while not stopped.wait(REPORT_INTERVAL):
+        report("Backup", int(task.completed), int(task.total or 0))
+    report("Backup", int(task.completed), int(task.total or 0))
+
+
+def names_of(serials: list[str]) -> dict[str, str]:
+    """Function that names the backup of each device after its model. Devices of the same model get their serial appended, so they never share a backup dir.
+
+    Args:
+        serials (list[str]): Device serials
+
+    Returns:
+        dict[str, str]: Backup name of each serial
+    """
+    from adbutils import adb
+    models = {serial: str(adb.device(serial).prop.model or "Unknown") for serial in serials}
+    counts = Counter(models.values())
+    return {serial: model if counts[model] == 1 else f"{model}-{serial}" for serial, model in models.items()}
+
+
+def log_of(name: str) -> Path:
+    """Function that returns the log file of a device worker, it's kept within the state dir of the device
+
+    Args:
+        name (str): Backup name of the device
+
+    Returns:
+        Path: Log file path
+    """
+    return DATA_DIR/"devices"/name/"backup.log"
+
+
+@contextmanager
+def redirected(file: Path) -> Iterator[None]:
+    """Context manager that points stdout & stderr file descriptors to `file`, so the output of a device worker never mixes with the live render.
+
+    Args:
+        file (Path): Log file, appended to
+
+    Yields:
+        Iterator[None]: Nothing
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = [os.dup(1), os.dup(2)]
+    file.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        with open(file, "a", encoding=UTF_8) as fw:
+            os.dup2(fw.fileno(), 1)
+            os.dup2(fw.fileno(), 2)
+        yield
+    finally:
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        [os.close(fd) for fd in saved]
+
+
+def worker(name: str, serial: str, queue: Queue, gate: AbstractContextManager, full_scan: bool, verify: bool) -> None:
+    """Function that runs in the process of each device. Device & its paths are bound by the environment set here & the device is connected before any module of the pipeline is imported, progress is sent to the parent over `queue` & the output goes to the log of the device.
+
+    Args:
+        name (str): Backup name of the device
+        serial (str): Device serial
+        queue (Queue): Reports of all device workers
+        gate (AbstractContextManager): Semaphore shared by all device workers, bounds the writes to host disk
+        full_scan (bool): Ignore the scan cache and list every directory
+        verify (bool): Cross check the delta totals against the files on disk
+    """
+    def report(stage: str, completed: int, total: int) -> None:
+        queue.put((name, stage, completed, total))
+
+    os.environ.update(ANDROID_SERIAL=serial, BACKUP_NAME=name)
+    with redirected(log_of(name)):
+        try:
+            # the device record is written before any path of the device is resolved, so a new device gets its state dir
+            connect()
+            run(full_scan, verify, live=False, gate=gate, report=report)
+        except BaseException:
+            report(FAILED, 0, 0)
+            # the traceback is kept in the log, the process only exits with an error code
+            traceback.print_exc()
+            raise SystemExit(1)
+        report(DONE, 0, 0)
+
+
+def backup_all(full_scan: bool = False, verify: bool = False, writers: int = HOST_WRITERS, headless: bool = False) -> None:
+    """Function that backs up every connected device at the same time. Each device runs the whole pipeline in its own process with its own backup, delta & state dirs, while a single render shows a progress row per device.
+
+    Args:
+        full_scan (bool, optional): Ignore the scan cache and list every directory. Defaults to False.
+        verify (bool, optional): Cross check the delta totals against the files on disk. Defaults to False.
+        writers (int, optional): Pulls running at the same time across all devices. Defaults to HOST_WRITERS.
+        headless (bool, optional): Print JSON lines of progress instead of the live render. Defaults to False.
+    """
+    log.stage("Devices")
+    names = names_of(device_serials())
+    log.info(f"Devices connected          > {len(names)} [{", ".join(names.values())}]")
+    # Device paths are bound once resolved, so every worker is a fresh process that sets up its own environment
+    context = get_context("spawn")
+    queue = context.Queue()
+    gate = context.BoundedSemaphore(writers)
+    processes = {}
+    for serial, name in names.items():
+        processes[name] = context.Process(target=worker, args=(name, serial, queue, gate, full_scan, verify), name=name)
+        processes[name].start()
+    with DevicesRender(headless) as view:
+        [view.add_device(name) for name in processes]
+        while any(process.is_alive() for process in processes.values()) or not queue.empty():
+            try:
+                name, stage, completed, total = queue.get(timeout=REPORT_INTERVAL)
+            except Empty:
+                continue
+            view.update_device(name, stage, completed, total)
+            if stage in (DONE, FAILED):
+                view.advance_files_panel_title()
+    [process.join() for process in processes.values()]
+    for name, process in processes.items():
+        status = "complete" if process.exitcode == 0 else f"failed [exit code {process.exitcode}]"
+        log.info(f"Backup of {name} {status} > {log_of(name)}")
@@ -0,0 +1,119 @@
+import json
+from pathlib import Path
+from threading import Lock
+from typing import Any, Self
+
+from app.delta import DeltaNamedTuple
+from app.vars import JOURNAL
+from utils import UTF_8
+
+
+# Journal events: a large file whose pull has started (and can be resumed) & a row that's completely handled
+START = "start"
+DONE = "done"
+
+
+def key_of(row: DeltaNamedTuple) -> tuple[str, str, int, int]:
+    """Function that generates the journal key of a row. Size & mtime are part of the key, so a file changed on device after it was journaled is handled again.
+
+    Args:
+        row (DeltaNamedTuple): Row from Delta frame itertuple
+
+    Returns:
+        tuple[str, str, int, int]: Kind, path, size & mtime of the row
+    """
+    return str(row.Kind), str(row.Path), int(row.Size), int(row.Date)
+
+
+class Journal:
+    """Append-only journal of the backup session. Every handled row is appended as soon as it's done, so a restarted session skips it with a set lookup instead of checking the destination file.
+    """
+    def __init__(self, file: Path = JOURNAL) -> None:
+        """Replays the journal `file` if exists and opens it for appending
+
+        Args:
+            file (Path, optional): Journal file. Defaults to JOURNAL.
+        """
+        self.file = file
+        self.done: set[tuple[str, str, int, int]] = set()
+        self.started: set[tuple[str, str, int, int]] = set()
+        line = "\n"
+        if file.exists():
+            with open(file, "r", encoding=UTF_8) as fr:
+                for line in fr:
+                    try:
+                        event, *key = json.loads(line)
+                    except ValueError:
+                        # last line may be torn by a crash
+                        continue
+                    (self.done if event == DONE else self.started).add(tuple(key))
+        file.parent.mkdir(parents=True, exist_ok=True)
+        self.writer = open(file, "a", encoding=UTF_8)
+        if not line.endswith("\n"):
+            # terminate the torn line, so the next append starts on a new line
+            self.writer.write("\n")
+        # Lock that serializes appends coming from multiple pull workers
+        self.lock = Lock()
+
+    def is_done(self, row: DeltaNamedTuple) -> bool:
+        """Function that checks whether the row was handled by a previous session
+
+        Args:
+            row (DeltaNamedTuple): Row from Delta frame itertuple
+
+        Returns:
+            bool: True if done
+        """
+        return key_of(row) in self.done
+
+    def is_started(self, row: DeltaNamedTuple) -> bool:
+        """Function that checks whether the pull of the row was started by a previous session, i.e. its partial file can be resumed
+
+        Args:
+            row (DeltaNamedTuple): Row from Delta frame itertuple
+
+        Returns:
+            bool: True if started
+        """
+        return key_of(row) in self.started
+
+    def start(self, row: DeltaNamedTuple) -> None:
+        """Function that appends the start of a resumable pull
+
+        Args:
+            row (DeltaNamedTuple): Row from Delta frame itertuple
+        """
+        self.append(START, row)
+
+    def complete(self, row: DeltaNamedTuple) -> None:
+        """Function that appends a completely handled row
+
+        Args:
+            row (DeltaNamedTuple): Row from Delta frame itertuple
+        """
+        self.append(DONE, row)
+
+    def append(self, event: str, row: DeltaNamedTuple) -> None:
+        """Function that appends an `event` of the row and flushes it right away
+
+        Args:
+            event (str): Journal event
+            row (DeltaNamedTuple): Row from Delta frame itertuple
+        """
+        key = key_of(row)
+        with self.lock:
+            (self.done if event == DONE else self.started).add(key)
+            self.writer.write(json.dumps([event, *key]) + "\n")
+            self.writer.flush()
+
+    def close(self) -> None:
+        """Function that closes the journal
+        """
+        with self.lock:
+            self.writer.close()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, exc_type: type, exc_val: Any, exc_tb: Any) -> None:
+        self.close()
@@ -0,0 +1,165 @@
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Self
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pandas import DataFrame, Series, Timedelta, Timestamp, read_csv, to_datetime
+from send2trash import send2trash
+
+from utils import UTF_8_SIG, log
+
+
+# Arrow type of each known manifest column, any other column is inferred
+TYPES = {
+    "File": pa.string(),
+    "Type": pa.string(),
+    "Size": pa.int64(),
+    "Size_old": pa.int64(),
+    "Date": pa.int64(),
+    "Date_old": pa.int64(),
+    "Dir": pa.string(),
+    "Path_old": pa.string(),
+    "Kind": pa.string(),
+}
+# Columns with only a few distinct values, these are dictionary encoded on disk
+DICTIONARY_COLUMNS = ["Dir", "Type", "Kind"]
+COMPRESSION = "zstd"
+# Suffix of manifests saved before the binary format, these are migrated on first load
+LEGACY_SUFFIX = ".csv"
+
+
+def to_table(dataframe: DataFrame) -> pa.Table:
+    """Function that converts a manifest `dataframe` into a typed arrow table. `Path` column is stored as its `Dir` prefix only, since `File` already holds the name.
+
+    Args:
+        dataframe (DataFrame): Manifest dataframe
+
+    Returns:
+        pa.Table: Typed arrow table
+    """
+    arrays = {}
+    for name in dataframe.columns:
+        column = dataframe[name]
+        if name == "Path":
+            name, column = "Dir", column.astype(str).str.extract(r"^(.*/)", expand=False)
+        elif TYPES.get(name) == pa.int64():
+            column = column.astype("Int64")
+        arrays[name] = pa.array(column, type=TYPES.get(name), from_pandas=True)
+    return pa.table(arrays)
+
+
+def save(dataframe: DataFrame, file: Path) -> None:
+    """Function that saves a manifest `dataframe` into `file` as compressed parquet
+
+    Args:
+        dataframe (DataFrame): Manifest dataframe
+        file (Path): Destination file
+    """
+    with Writer(file) as writer:
+        writer.write(dataframe)
+
+
+def load(file: Path, columns: list[str] | None = None) -> DataFrame:
+    """Function that loads a manifest `file` using memory mapping. Legacy csv manifests are migrated first.
+
+    Args:
+        file (Path): Manifest file
+        columns (list[str] | None, optional): Columns to be loaded, rest are never read from disk. Defaults to None (all).
+
+    Returns:
+        DataFrame: Manifest dataframe
+    """
+    migrate(file)
+    read_columns = None
+    if columns is not None:
+        read_columns = [name for name in columns if name != "Path"]
+        if "Path" in columns:
+            read_columns += [name for name in ("Dir", "File") if name not in read_columns]
+    table = pq.read_table(file, columns=read_columns, memory_map=True)
+    dataframe = table.to_pandas()
+    if "Dir" in dataframe.columns and "File" in dataframe.columns:
+        # rebuild Path in place of Dir
+        dataframe["Dir"] = dataframe["Dir"] + dataframe["File"]
+        dataframe = dataframe.rename(columns={"Dir": "Path"})
+    if columns is not None:
+        dataframe = dataframe[columns]
+    return dataframe
+
+
+def exists(file: Path) -> bool:
+    """Function that checks whether a manifest `file` exists either in binary or legacy csv format
+
+    Args:
+        file (Path): Manifest file
+
+    Returns:
+        bool: True if exists
+    """
+    return file.exists() or file.with_suffix(LEGACY_SUFFIX).exists()
+
+
+def migrate(file: Path) -> None:
+    """Function that converts a legacy csv manifest to the binary format, if the binary `file` doesn't exist yet.
+
+    Args:
+        file (Path): Manifest file
+    """
+    legacy_file = file.with_suffix(LEGACY_SUFFIX)
+    if file.exists() or not legacy_file.exists():
+        return
+    dataframe = read_csv(legacy_file, encoding=UTF_8_SIG)
+    for name in ("Date", "Date_old"):
+        if name in dataframe.columns:
+            dataframe[name] = to_epoch(dataframe[name])
+    save(dataframe, file)
+    send2trash(legacy_file)
+    log.info(f"Manifest migrated to       > {file}")
+
+
+def to_epoch(dates: Series) -> Series:
+    """Function that converts `Date` column of a dataframe to epoch seconds. Dataframes saved before scanner backends stored dates as local datetime strings, those are converted assuming host & device share the timezone.
+
+    Args:
+        dates (Series): Date column
+
+    Returns:
+        Series: Date column as epoch seconds
+    """
+    if dates.dtype.kind in "iu" or dates.isna().all():
+        return dates.astype("Int64")
+    local = to_datetime(dates, format="ISO8601").dt.tz_localize(datetime.now().astimezone().tzinfo)
+    return ((local - Timestamp(0, tz="UTC")) // Timedelta(seconds=1)).astype("Int64")
+
+
+class Writer:
+    """Writer that appends dataframe chunks to a single parquet manifest as row groups, so large manifests never need to be in memory at once.
+    """
+    def __init__(self, file: Path) -> None:
+        """Initializes the writer for the given `file`
+
+        Args:
+            file (Path): Destination file
+        """
+        self.file = file
+        self.writer: pq.ParquetWriter | None = None
+
+    def write(self, dataframe: DataFrame) -> None:
+        """Function that appends `dataframe` to the manifest
+
+        Args:
+            dataframe (DataFrame): Manifest chunk
+        """
+        table = to_table(dataframe)
+        if self.writer is None:
+            dictionary = [name for name in DICTIONARY_COLUMNS if name in table.column_names]
+            self.file.parent.mkdir(parents=True, exist_ok=True)
+            self.writer = pq.ParquetWriter(self.file, table.schema, compression=COMPRESSION, use_dictionary=dictionary)
+        self.writer.write_table(table)
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, exc_type: type, exc_val: Any, exc_tb: Any) -> None:
+        if self.writer is not None:
+            self.writer.close()
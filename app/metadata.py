@@ -1,85 +1,40 @@
-from datetime import datetime
+from functools import cache
+from itertools import islice
 from pathlib import PurePosixPath
+from typing import Iterable, Iterator
 
-from pandas import DataFrame, concat
+from pandas import DataFrame, Timedelta, Timestamp, to_datetime
 
+from app import manifest, scanner
 from app.vars import (
     ANDROID_DIR,
     ANDROID_MEDIA_DIR,
-    CLEANED_METADATA,
-    DATA_DIR,
     DATAFRAME,
     DATAFRAME_COLUMNS,
-    DEVICE_ROOT,
     IGNORE_DIRS,
     IGNORE_TYPES,
-    RAW_METADATA,
     REQUIRED_PACKAGES,
 )
-from utils import UTF_8, UTF_8_SIG, log
-from utils.android import device
+from utils import log
 
 
-def fetch() -> None:
-    """Wrapper function to pull, clean & parse metadata dataframe in one go.
-    """
-    log.stage("Metadata")
-    pull()
-    clean()
-    parse()
+# Records are written to the manifest in chunks, this bounds the memory used by the scan
+CHUNK_SIZE = 100_000
 
 
-def pull() -> None:
-    """Function that generates the raw metadata report of all files in the device
-    """
-    # variables
-    src_file = f"{DEVICE_ROOT/RAW_METADATA}"
-    dst_file = f"{DATA_DIR/RAW_METADATA}"
-    # command to generate metadata file
-    command = f"ls -llR {DEVICE_ROOT}/ > {src_file}"
-    log.info(f"Executing: {command}")
-    # execute the command and pull the file
-    device.shell(command)
-    device.pull(src_file, dst_file)
-    # remove it's own entry from report
-    with open(dst_file, "r+", encoding=UTF_8) as frw:
-        lines = frw.readlines()
-        for index, line in enumerate(lines):
-            if RAW_METADATA.name in line:
-                del lines[index]
-        frw.seek(0)
-        frw.truncate()
-        frw.writelines(lines)
-    log.info(f"Raw metadata pulled into   > {dst_file}")
-
-
-def clean() -> None:
-    """Function to clean the raw metadata. Removes sub-directories and empty directories.
+def fetch(full_scan: bool = False) -> None:
+    """Wrapper function to scan, parse & save metadata dataframe in one go. The listing is streamed and parsed in chunks, so it's never held in memory or written to disk as a whole.
+
+    Args:
+        full_scan (bool, optional): Ignore the scan cache and list every directory. Defaults to False.
     """
-    # variables
-    src_file = f"{DATA_DIR/RAW_METADATA}"
-    dst_file = CLEANED_METADATA
-    # read raw metadata from src_file
-    with open(src_file, "r", encoding=UTF_8) as fr:
-        raw_data = fr.read().split("\n\n")
-    cleaned_data = []
-    # clean metadata for each dir iteratively
-    for raw_dir in raw_data:
-        lines = raw_dir.splitlines()
-        dir_name = lines[0].replace(":", "/")
-        if skip_this_dir(dir_name):
-            continue
-        files = list(filter(lambda line: line.startswith("-r"), lines[3:]))
-        if len(files) == 0:
-            continue
-        cleaned_dir = "\n".join([dir_name] + files)
-        cleaned_data.append(cleaned_dir)
-    # save cleaned metadata into dst_file
-    with open(dst_file, "w", encoding=UTF_8) as fw:
-        fw.write("\n\n".join(cleaned_data))
-    log.info(f"Raw metadata cleaned into  > {dst_file}")
+    log.stage("Metadata")
+    backend = scanner.detect()
+    log.info(f"Scanner backend detected   > {backend}")
+    save(parse(scanner.scan(backend, full_scan)))
 
 
+@cache
 def skip_this_dir(dir_name: str) -> bool:
     """Function that checks to skip Android folder directory or not
 
@@ -107,58 +62,65 @@ def skip_this_dir(dir_name: str) -> bool:
     return False
 
 
-def parse() -> None:
-    """Function that parses String metadata into Pandas DF
+def parse(entries: Iterable[tuple[str, str, int, int | str]]) -> Iterator[DataFrame]:
+    """Function that parses scanned entries into dataframes, CHUNK_SIZE entries at a time
+
+    Args:
+        entries (Iterable[tuple[str, str, int, int | str]]): Directory name, file name, size & mtime of each regular file
+
+    Yields:
+        Iterator[DataFrame]: Dataframe of each chunk
     """
-    # variables
-    src_file = CLEANED_METADATA
-    dst_file = DATAFRAME
-    # read cleaned metadata from src_file
-    with open(src_file, "r", encoding=UTF_8) as fr:
-        data = fr.read().split("\n\n")
-    # convert each dir string into frames
-    frames = map(to_frame, data)
-    # concat into single dataframe
-    dataframe = concat(frames, ignore_index=True)
-    # drop files of type ignore
-    ignore_mask = dataframe['Type'].apply(lambda x: str(x).removeprefix(".").upper() in IGNORE_TYPES)
-    dataframe = dataframe[~ignore_mask]
-    # export dataframe as csv
-    dataframe.to_csv(dst_file, index=False, encoding=UTF_8_SIG)
-    log.info(f"DataFrame exported as csv  > {dst_file}")
+    entries = iter(entries)
+    while chunk := list(islice(entries, CHUNK_SIZE)):
+        yield to_frame(chunk)
 
 
-def to_frame(dir_data: str) -> DataFrame:
-    """Generates a dataframe for a given dir string from metadata
+def to_frame(entries: list[tuple[str, str, int, int | str]]) -> DataFrame:
+    """Generates a dataframe for given scanned entries. Columnar buffers are filled once and every column is derived in bulk, files of ignored dirs & types are dropped with vectorized masks.
 
     Args:
-        dir_data (str): Data of a single dir in string
+        entries (list[tuple[str, str, int, int | str]]): Directory name, file name, size & mtime of each regular file. mtime is either epoch seconds or an ISO 8601 string with timezone (`ls` backend).
 
     Returns:
-        DataFrame: Dir string coverted into dataframe
+        DataFrame: Entries converted into dataframe
     """
-    def to_record(line: str) -> dict:
-        """Helper function that converts a given line string to dataframe record/row
-
-        Args:
-            line (str): input line as string
-
-        Returns:
-            dict: line converted to record/row as dict
-        """
-        parts = line.split()
-        record = {
-            "File": " ".join(parts[8:]),
-            "Type": PurePosixPath(parts[-1]).suffix,
-            "Size": int(parts[4]),
-            "Date": datetime.fromisoformat(" ".join(parts[5:7])),
-            "Path": PurePosixPath(f"{dir_name}/{line[line.index(parts[8]):]}")
-            # Line index is used for path to avoid issues with files having multiple spaces in their names
-        }
-        return record
-
-    # split blob string into lines & parse dataframe
-    lines = dir_data.splitlines()
-    dir_name = lines[0]
-    records = map(to_record, lines[1:])
-    return DataFrame(records, columns=DATAFRAME_COLUMNS)
+    columns = DataFrame.from_records(entries, columns=["Dir", "File", "Size", "Date"])
+    # skip decision is made once per unique dir instead of once per file
+    skipped = [dir_name for dir_name in columns["Dir"].unique() if skip_this_dir(dir_name)]
+    columns = columns[~columns["Dir"].isin(skipped)]
+    # suffix with the same rules as PurePosixPath.suffix: the last dot must neither lead nor end the name
+    head, _, tail = (columns["File"].str.rpartition(".")[index] for index in range(3))
+    types = ("." + tail).where((head.str.len() > 0) & (tail.str.len() > 0), "")
+    dates = columns["Date"]
+    if dates.dtype.kind not in "iu":
+        dates = (to_datetime(dates, format="ISO8601", utc=True) - Timestamp(0, tz="UTC")) // Timedelta(seconds=1)
+    dataframe = DataFrame({
+        "File": columns["File"],
+        "Type": types,
+        "Size": columns["Size"].astype("int64"),
+        "Date": dates.astype("int64"),
+        "Path": columns["Dir"] + columns["File"],
+    }, columns=DATAFRAME_COLUMNS)
+    # drop files of type ignore
+    ignore_mask = types.str.removeprefix(".").str.upper().isin(IGNORE_TYPES)
+    return dataframe[~ignore_mask].reset_index(drop=True)
+
+
+def save(frames: Iterable[DataFrame]) -> None:
+    """Function that appends the dataframe `frames` to the manifest as they are parsed
+
+    Args:
+        frames (Iterable[DataFrame]): Chunks of the dataframe
+    """
+    # variables
+    dst_file = DATAFRAME
+    total = 0
+    with manifest.Writer(dst_file) as writer:
+        # schema is always written, even for devices without any file
+        writer.write(DataFrame(columns=DATAFRAME_COLUMNS))
+        for frame in frames:
+            writer.write(frame)
+            total += len(frame)
+    log.info(f"DataFrame exported as      > {dst_file} [{total} files]")
+
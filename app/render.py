@@ -1,4 +1,7 @@
+import json
 from collections import deque
+from threading import Event, RLock, get_ident
+from time import time
 from typing import Any, Self
 
 from rich.console import Group
@@ -11,7 +14,9 @@ from rich.progress import (
     ProgressColumn,
     SpinnerColumn,
     Task,
+    TaskID,
     TaskProgressColumn,
+    TextColumn,
     TimeElapsedColumn,
     TimeRemainingColumn,
     TransferSpeedColumn,
@@ -20,6 +25,13 @@ from rich.text import Text
 
 from utils import log
 from utils.terminal import terminal_width
+from utils.thread import ExceptionalThread
+
+
+# Frames drawn per second by the render thread
+FRAME_RATE = 10
+# Seconds between two progress events of the headless mode
+EVENT_INTERVAL = 1.0
 
 
 class TimeColumn(ProgressColumn):
@@ -39,13 +51,17 @@ class TimeColumn(ProgressColumn):
         return Text(f"[{remaining}/{elapsed}]", style="cyan italic")
 
 
-def progress_bar() -> Progress:
+def progress_bar(label: bool = False) -> Progress:
     """Function that generates a rich Progress instance with fixed template
 
+    Args:
+        label (bool, optional): Prefix each row with its task description. Defaults to False.
+
     Returns:
         Progress: Progress bar instance
     """
     return Progress(
+            *([TextColumn("{task.description}")] if label else []),
             SpinnerColumn(),
             BarColumn(),
             TaskProgressColumn(style="bold"),
@@ -57,13 +73,28 @@ def progress_bar() -> Progress:
 
 class Render:
     """Class that actually renders the backup process in an eye-candy way using rich live rendering
+
+    Pull workers only publish what they did: files into a ring buffer & processed counts into counters of their own, neither takes a lock. Frames are drawn FRAME_RATE times a second by the single refresh thread of rich.live, which formats only what's visible. In headless mode nothing is drawn, a compact JSON line of progress is printed every EVENT_INTERVAL seconds instead.
     """
-    def __init__(self) -> None:
+    def __init__(self, live: bool = True, headless: bool = False) -> None:
+        """Initializes the renderables
+
+        Args:
+            live (bool, optional): Render live on the terminal, progress is only tracked when False. Defaults to True.
+            headless (bool, optional): Print JSON lines of progress instead of the live render, for cron & CI runs. Defaults to False.
+        """
+        self.live_enabled = live and not headless
+        self.headless = headless
+        # Lock that guards the alt files & renders, which change once per large file
+        self.lock = RLock()
         # File panel attributes
         self.max_line_length = terminal_width - 10
         self.panel_lines = 5
-        self.panel_queue = deque([""]*self.panel_lines, maxlen=self.panel_lines)
-        self.panel_processed = 0
+        # Ring buffer of the files published by workers, deque appends are atomic & older files are overwritten unseen
+        self.panel_queue: deque[tuple[str, str | None]] = deque([("", None)]*self.panel_lines, maxlen=self.panel_lines)
+        # Files processed by each publishing thread, every thread increments only its own count
+        self.panel_counts: dict[int, int] = {}
+        self.panel_base = 0
         self.panel_total = 0
         # self.files_panel = Panel("", title=f"Files processed: {self.panel_processed} | Total: {self.panel_total}", title_align="left", height=self.panel_lines+2, width=terminal_width-5, padding=(0,1))
         self.files_panel = Panel("", title=f"Files processed: {self.panel_processed} | Total: {self.panel_total}", title_align="left", width=terminal_width-5, padding=(0,1))
@@ -72,8 +103,9 @@ class Render:
         self.main_progress_bar = progress_bar()
         # Alt progress bar
         self.alt_progress_title = ""
+        self.alt_files: list[str] = []
         self.alt_progress_bar = progress_bar()
-        # Console Live object
+        # Console Live object, frames are built by the refresh thread
         self.renders = [
             self.files_panel,
             Text(),
@@ -83,14 +115,45 @@ class Render:
             self.alt_progress_title,
             self.alt_progress_bar
         ]
-        self.live = Live(Group(*self.renders), auto_refresh=True, refresh_per_second=10)
-    
+        self.group = Group(*self.renders)
+        self.renders_changed = False
+        self.live = Live(get_renderable=self.frame, auto_refresh=True, refresh_per_second=FRAME_RATE)
+        # Headless event thread & its stop signal
+        self.stopped = Event()
+        self.emitter: ExceptionalThread | None = None
+
+    @property
+    def panel_processed(self) -> int:
+        """Total files processed, the counts of all threads are summed when read
+
+        Returns:
+            int: Files processed
+        """
+        # list() copies the values in one step, so threads adding their count meanwhile can't break the sum
+        return self.panel_base + sum(list(self.panel_counts.values()))
+
     def insert_into_files_panel(self, file: str, kind: str) -> None:
-        """Function that insert an input `file`s string into files panel
+        """Function that publishes an input `file` to the files panel, it's formatted only if it's still visible when the next frame is drawn
+
+        Args:
+            file (str): input file string
+            kind (str): file kind, decides the indicator
+        """
+        self.panel_queue.append((file, kind))
+
+    @staticmethod
+    def panel_line(file: str, kind: str | None) -> str:
+        """Function that formats a `file` of the files panel with the indicator of its `kind`
 
         Args:
             file (str): input file string
+            kind (str | None): file kind, None for a blank line
+
+        Returns:
+            str: Panel line
         """
+        if kind is None:
+            return file
         # reset encoding to avoid terminal glitches
         file = file.encode("ascii", errors="replace").decode("ascii")
         match(kind):
@@ -100,21 +163,29 @@ class Render:
                 ind = "[bold yellow1]►[/]"
             case "remove":
                 ind = "[bold bright_red]▼[/]"
+            case "move":
+                ind = "[bold bright_magenta]»[/]"
             case _:
                 ind = "[bold bright_blue]◄[/]"
-        # insert file string into queue
-        self.panel_queue.append(f"{ind} {file}")
-        # update the panel render
-        self.files_panel.renderable = "\n".join(self.panel_queue)
+        return f"{ind} {file}"
 
     def update_files_panel_title(self, current: int = 0):
-        """Function used to update files panel title, processed by total count display
+        """Function used to set the processed count of files panel title, processed by total count display
 
         Args:
             current (int, optional): total files processed. Defaults to 0.
         """
-        self.panel_processed = current
-        self.files_panel.title = f"[bold]Files processed: [cyan]{current}[/cyan] | Total: [cyan]{self.panel_total}[/cyan]"
+        with self.lock:
+            self.panel_base += current - self.panel_processed
+
+    def advance_files_panel_title(self, advance: int = 1) -> None:
+        """Function that increments the processed count of files panel title. Safe to be called from multiple pull workers at once.
+
+        Args:
+            advance (int, optional): files processed since last update. Defaults to 1.
+        """
+        thread = get_ident()
+        self.panel_counts[thread] = self.panel_counts.get(thread, 0) + advance
 
     def update_alt_progress_title(self, file: str = "") -> None:
         """Function that updates the alt progress bar title with input `file` name. If no input is given function resets the title to be blank.
@@ -122,20 +193,93 @@ class Render:
         Args:
             file (str, optional): Input file name. Defaults to "".
         """
-        # update the variable first
-        self.alt_progress_title = file
-        # update the renders list
-        self.renders[5] = self.alt_progress_title
-        # update the live render
-        self.live.update(Group(*self.renders))
-    
+        with self.lock:
+            # update the variable first
+            self.alt_progress_title = file
+            # update the renders list, the group is rebuilt by the next frame
+            self.renders[5] = self.alt_progress_title
+            self.renders_changed = True
+
+    def add_alt_file(self, file: str) -> None:
+        """Function that adds a large `file` to the alt progress title. Used when multiple large files are pulled at the same time.
+
+        Args:
+            file (str): Input file name
+        """
+        with self.lock:
+            self.alt_files.append(file)
+            self.update_alt_progress_title("\n".join(self.alt_files))
+
+    def remove_alt_file(self, file: str) -> None:
+        """Function that removes a large `file` from the alt progress title once it's pulled.
+
+        Args:
+            file (str): Input file name
+        """
+        with self.lock:
+            self.alt_files.remove(file)
+            self.update_alt_progress_title("\n".join(self.alt_files))
+
+    def frame(self) -> Group:
+        """Function that builds a frame from the published progress, called by the refresh thread of rich.live
+
+        Returns:
+            Group: Renderables of the frame
+        """
+        # tuple() copies the ring in one step, workers keep appending meanwhile
+        self.files_panel.renderable = "\n".join(self.panel_line(file, kind) for file, kind in tuple(self.panel_queue))
+        self.files_panel.title = f"[bold]Files processed: [cyan]{self.panel_processed}[/cyan] | Total: [cyan]{self.panel_total}[/cyan]"
+        with self.lock:
+            if self.renders_changed:
+                self.group = Group(*self.renders)
+                self.renders_changed = False
+        return self.group
+
+    def event(self) -> dict[str, Any]:
+        """Function that describes the current progress as a headless event
+
+        Returns:
+            dict[str, Any]: Event fields
+        """
+        task = self.main_progress_bar.tasks[0] if self.main_progress_bar.tasks else None
+        with self.lock:
+            large = list(self.alt_files)
+        return {
+            "files": self.panel_processed,
+            "files_total": self.panel_total,
+            "bytes": int(task.completed) if task else 0,
+            "bytes_total": int(task.total or 0) if task else 0,
+            "speed": int(task.speed or 0) if task else 0,
+            "large": large,
+        }
+
+    def emit(self, name: str, **fields: Any) -> None:
+        """Function that prints a headless event as a compact JSON line on stdout, logs go to stderr in headless runs
+
+        Args:
+            name (str): Event name
+            fields (Any): Event fields
+        """
+        print(json.dumps({"event": name, "time": round(time(), 3), **fields}, separators=(",", ":")), flush=True)
+
+    def emit_progress(self) -> None:
+        """Function that emits a progress event every EVENT_INTERVAL seconds until the render is stopped
+        """
+        while not self.stopped.wait(EVENT_INTERVAL):
+            self.emit("progress", **self.event())
+
     def __enter__(self) -> Self:
-        """Function to use render class with context. Starts the rich.live rendering
+        """Function to use render class with context. Starts the rich.live rendering, or the headless events
 
         Returns:
             Self: return `self`
         """
-        self.live.start()
+        if self.live_enabled:
+            self.live.start()
+        if self.headless:
+            self.emit("start", **self.event())
+            self.emitter = ExceptionalThread(target=self.emit_progress)
+            self.emitter.start()
         return self
 
     def __exit__(self, exc_type: type, exc_val: Any, exc_tb: Any) -> None:
@@ -146,7 +290,66 @@ class Render:
             exc_val (_type_): exception message
             exc_tb (_type_): exception traceback
         """
-        self.live.stop()
+        if self.live_enabled:
+            self.live.stop()
+        if self.emitter is not None:
+            self.stopped.set()
+            self.emitter.join()
+            self.emit("failed" if exc_tb else "done", **self.event())
         if exc_tb:
             log.error(f"{exc_type.__name__} {exc_val}")
-            
\ No newline at end of file
+
+
+class DevicesRender(Render):
+    """Render of the multi-device mode. Main progress bar has one labelled row per device, files panel shows the stage changes of all devices.
+    """
+    def __init__(self, headless: bool = False) -> None:
+        """Initializes the renderables with a labelled main progress bar
+
+        Args:
+            headless (bool, optional): Print JSON lines of progress instead of the live render. Defaults to False.
+        """
+        super().__init__(headless=headless)
+        self.main_progress_title = "Devices"
+        self.main_progress_bar = progress_bar(label=True)
+        self.renders[2] = self.main_progress_title
+        self.renders[3] = self.main_progress_bar
+        self.group = Group(*self.renders)
+        self.devices: dict[str, TaskID] = {}
+        self.stages: dict[str, str] = {}
+
+    def add_device(self, name: str) -> None:
+        """Function that adds a progress row for a device
+
+        Args:
+            name (str): Backup name of the device
+        """
+        with self.lock:
+            self.devices[name] = self.main_progress_bar.add_task(name, total=None)
+            self.panel_total += 1
+
+    def update_device(self, name: str, stage: str, completed: int, total: int) -> None:
+        """Function that updates the progress row of a device with a report of its worker
+
+        Args:
+            name (str): Backup name of the device
+            stage (str): Current stage of the device
+            completed (int): Bytes handled by the backup session
+            total (int): Total bytes of the backup session, 0 until the session starts
+        """
+        self.main_progress_bar.update(self.devices[name], description=f"{name} [{stage}]", completed=completed, total=total or None)
+        if self.stages.get(name) != stage:
+            self.stages[name] = stage
+            self.insert_into_files_panel(f"{name}: {stage}", "")
+
+    def event(self) -> dict[str, Any]:
+        """Function that describes the progress of every device as a headless event
+
+        Returns:
+            dict[str, Any]: Event fields
+        """
+        tasks = {task.id: task for task in self.main_progress_bar.tasks}
+        return {
+            "devices": {name: {"stage": self.stages.get(name, ""), "bytes": int(tasks[task].completed), "bytes_total": int(tasks[task].total or 0)} for name, task in self.devices.items()},
+            "done": self.panel_processed,
+        }
@@ -0,0 +1,203 @@
+from pathlib import Path, PurePosixPath
+from time import monotonic
+from typing import NamedTuple, cast
+
+from pandas import DataFrame
+
+from app import manifest, metadata, snapshot
+from app.catalog import Catalog
+from app.delta import DeltaNamedTuple
+from app.render import Render
+from app.scheduler import Scheduler, Tuning
+from app.transfer import push_batch
+from app.vars import (
+    BACKUP_DIR,
+    DATAFRAME,
+    DEVICE_DATAFRAME,
+    DEVICE_ROOT,
+    PROGRESS_INTERVAL,
+    PUSH_WORKERS,
+)
+from utils import log
+from utils.thread import ExceptionalThread, join_all
+
+
+# Columns of the restore frame, `Local` is the file holding the content to be pushed
+RESTORE_COLUMNS = ["Path", "Size", "Date", "Local", "Kind"]
+
+
+class RestoreNamedTuple(NamedTuple):
+    """Named tuple for typehinting Restore frame itertuples
+    """
+    Index: int
+    Path: str
+    Size: int
+    Date: int
+    Local: str
+    Kind: str
+
+
+def source(timestamp: str | None = None) -> DataFrame:
+    """Function that loads the files to be restored, either from the stored device manifest (merged backup) or from a snapshot of the catalog
+
+    Args:
+        timestamp (str | None, optional): Snapshot timestamp, None for the device manifest. Defaults to None.
+
+    Returns:
+        DataFrame: Path, Size, Date & Local file of every file
+    """
+    if timestamp is None:
+        source_df = manifest.load(DEVICE_DATAFRAME, columns=["Path", "Size", "Date"])
+        source_df["Local"] = [str(BACKUP_DIR/PurePosixPath(path).relative_to(DEVICE_ROOT)) for path in source_df["Path"]]
+        return source_df
+    with Catalog() as catalog:
+        versions = catalog.versions_at(timestamp)
+    return DataFrame(
+        [(path, size, mtime, str(snapshot.stored_file(location, stored))) for path, size, mtime, location, stored in versions],
+        columns=["Path", "Size", "Date", "Local"],
+    )
+
+
+def calculate(timestamp: str | None = None) -> DataFrame:
+    """Function that scans the target device and calculates the reverse delta: files of the source that are missing on device (`add`) or differ in size or mtime (`modify`). Files present only on device are left untouched.
+
+    Args:
+        timestamp (str | None, optional): Snapshot timestamp, None for the device manifest. Defaults to None.
+
+    Returns:
+        DataFrame: Restore frame of RESTORE_COLUMNS, ordered by path so batches mostly cover a single dir
+    """
+    source_df = source(timestamp)
+    # a restored device has nothing in common with the scan cache, so it's always scanned in full
+    metadata.fetch(full_scan=True)
+    log.stage("Restore")
+    device_df = manifest.load(DATAFRAME, columns=["Path", "Size", "Date"])
+    restore_df = source_df.merge(device_df, on="Path", how="left", suffixes=("", "_device"))
+    restore_df["Kind"] = "modify"
+    restore_df.loc[restore_df["Size_device"].isna(), "Kind"] = "add"
+    restore_df = restore_df[(restore_df["Kind"] == "add") | (restore_df["Size"] != restore_df["Size_device"]) | (restore_df["Date"] != restore_df["Date_device"])]
+    # contents missing locally (e.g. versions past retention) can't be restored
+    present = restore_df["Local"].map(lambda local: Path(local).is_file()).astype(bool)
+    if missing := int((~present).sum()):
+        log.info(f"Missing local files        > {missing} [skipped]")
+    restore_df = restore_df[present].sort_values("Path")[RESTORE_COLUMNS].reset_index(drop=True)
+    kinds = restore_df["Kind"].value_counts()
+    log.info(f"Files to be restored       > {len(restore_df)} [+{kinds.get("add", 0)}, ~{kinds.get("modify", 0)}]")
+    return restore_df
+
+
+class session(Render):
+    """Restore session with live rendering of progress. Files are pushed by a pool of workers fed by the same size aware scheduler as the backup, small files are pushed in tar batches and large ones get an alt progress bar. An interrupted restore is resumed by running it again: pushed files match the source on the next scan, so only the rest is pushed.
+    """
+    def __init__(self, restore_df: DataFrame) -> None:
+        """Initializes the parent `Render` class and the progress bar tasks
+
+        Args:
+            restore_df (DataFrame): Restore frame returned by `calculate`
+        """
+        super().__init__()
+        self.restore_df = restore_df
+        self.total_size = int(restore_df["Size"].sum())
+        self.main_progress_task = self.main_progress_bar.add_task("main", total=self.total_size)
+        self.panel_total = len(restore_df)
+        self.update_files_panel_title()
+        # Transfer tunables: files <= small_size are pushed in tar batches of batch_size, files > large_size get an alt progress bar. Defaults are kept, settings are learned from backups only.
+        self.tuning = Tuning(file=None)
+
+    def run(self, workers: int = PUSH_WORKERS) -> None:
+        """Start the restore session.
+
+        Args:
+            workers (int, optional): Number of streams pushed at the same time. Defaults to PUSH_WORKERS.
+        """
+        rows = [cast(RestoreNamedTuple, row) for row in self.restore_df.itertuples()]
+        self.scheduler = Scheduler(cast(list[DeltaNamedTuple], rows), self.tuning, workers)
+        threads = [ExceptionalThread(target=self.worker, args=(lane,)) for lane in self.scheduler.lanes_for(workers)]
+        [thread.start() for thread in threads]
+        join_all(threads)
+
+    def worker(self, lane: str) -> None:
+        """Function that runs on each push worker thread. Keeps pushing rows from the scheduler until it's drained.
+
+        Args:
+            lane (str): Scheduler lane this worker is bound to
+        """
+        try:
+            while (job := self.scheduler.next(lane)) is not None:
+                start = monotonic()
+                if isinstance(job, list):
+                    self.push_files(cast(list[RestoreNamedTuple], job))
+                else:
+                    self.push_file_streamed(cast(RestoreNamedTuple, job))
+                self.scheduler.done(job, monotonic() - start, lane)
+        except BaseException:
+            # stop the other workers too, the exception is raised on join
+            self.scheduler.stop()
+            raise
+
+    def push_files(self, rows: list[RestoreNamedTuple]) -> None:
+        """Function that pushes the files of given rows as a single tar stream
+
+        Args:
+            rows (list[RestoreNamedTuple]): Rows from Restore frame itertuple
+        """
+        pending = {row.Path: row for row in rows}
+        files = [(Path(row.Local), row.Path, int(row.Date)) for row in rows]
+        for path, size in push_batch(files):
+            row = pending[path]
+            self.insert_into_files_panel(row.Path, row.Kind)
+            self.main_progress_bar.update(self.main_progress_task, advance=size)
+            self.advance_files_panel_title()
+
+    def push_file_streamed(self, row: RestoreNamedTuple) -> None:
+        """Function that pushes a single file, files whose size > large_size [100MB] get an alt progress bar
+
+        Args:
+            row (RestoreNamedTuple): Row from Restore frame itertuple
+        """
+        if row.Size <= self.tuning.large_size:
+            self.push_files([row])
+            return
+        self.insert_into_files_panel(row.Path, row.Kind)
+        # Add alt title and create a task for alt_progress bar
+        self.add_alt_file(row.Path)
+        alt_task = self.alt_progress_bar.add_task(row.Path, total=row.Size)
+        # Main progress bar is advanced by deltas, as other workers are updating it too
+        alt_total = 0
+
+        def update(current: int) -> None:
+            """Helper function that is called by the stream with the bytes sent so far
+
+            Args:
+                current (int): total bytes sent
+            """
+            nonlocal alt_total
+            self.alt_progress_bar.update(alt_task, completed=current)
+            self.main_progress_bar.update(self.main_progress_task, advance=(current-alt_total))
+            alt_total = current
+
+        try:
+            for _ in push_batch([(Path(row.Local), row.Path, int(row.Date))], update, PROGRESS_INTERVAL):
+                pass
+        finally:
+            # Reset alt_progress bar and title
+            self.alt_progress_bar.remove_task(alt_task)
+            self.remove_alt_file(row.Path)
+        self.main_progress_bar.update(self.main_progress_task, advance=(row.Size-alt_total))
+        self.advance_files_panel_title()
+
+
+def restore(timestamp: str | None = None, workers: int = PUSH_WORKERS) -> None:
+    """Wrapper function to calculate the reverse delta against the connected device & push it in one go
+
+    Args:
+        timestamp (str | None, optional): Snapshot timestamp, None for the device manifest. Defaults to None.
+        workers (int, optional): Number of streams pushed at the same time. Defaults to PUSH_WORKERS.
+    """
+    restore_df = calculate(timestamp)
+    if restore_df.empty:
+        log.info("Device is up to date, nothing to restore")
+        return
+    with session(restore_df) as rst:
+        rst.run(workers)
+    log.info(f"Restore complete! [{len(restore_df)} files]")
@@ -0,0 +1,286 @@
+import json
+import re
+from itertools import islice
+from os import replace
+from pathlib import Path
+from shlex import quote
+from typing import BinaryIO, Iterator
+
+from pandas import DataFrame
+
+from app import manifest
+from app.transfer import split_batch
+from app.vars import DEVICE_ROOT, SCAN_CACHE_DIR
+from utils import UTF_8, log
+from utils.android import exec_out, shell
+
+
+# Backends in the order of preference
+FIND = "find"
+STAT = "stat"
+LS = "ls"
+# Commands that list every regular file as `size mtime path` records, `{root}` is the device root dir. `stat` ends each record with a newline, a NUL is printed after it so names with newlines stay whole.
+COMMANDS = {
+    FIND: "find {root}/ -type f -printf '%s %T@ %p\\0'",
+    STAT: "find {root}/ -type f -print0 | xargs -0 sh -c 'for f; do stat -c \"%s %Y %n\" \"$f\" && printf \"\\0\"; done' sh",
+    LS: "ls -llR {root}/",
+}
+# Record separator of each backend output
+SEPARATORS = {
+    FIND: b"\0",
+    STAT: b"\0",
+    LS: b"\n",
+}
+# Probes that are run on device root itself to detect whether a backend is supported
+PROBES = {
+    FIND: ("find {root}/ -maxdepth 0 -printf '%s %T@ %p\\0'", re.compile(r"^\d+ \d+(\.\d+)? \S+\x00$")),
+    STAT: ("stat -c '%s %Y %n' {root}/ && printf '\\0'", re.compile(r"^\d+ \d+ \S+\n\x00$")),
+}
+# Chunk size used to read the backend output stream
+READ_SIZE = 1 << 20
+# Incremental scan commands: stamps of all dirs, files of given dirs only & files changed within given minutes
+DIRS_COMMAND = "find {root}/ -type d -printf '%T@ %p\\0'"
+DIR_FILES_COMMAND = "find {dirs} -maxdepth 1 -type f -printf '%s %T@ %p\\0'"
+MODIFIED_COMMAND = "find {root}/ -type f -cmin -{minutes} -printf '%s %T@ %p\\0'"
+# Scan cache columns & chunk size used while writing it
+CACHE_COLUMNS = ["File", "Size", "Date", "Path"]
+CACHE_CHUNK_SIZE = 100_000
+
+
+def detect() -> str:
+    """Function that detects the best listing backend the device supports. Falls back to `ls -llR` text parsing.
+
+    Returns:
+        str: Backend name, one of `find`, `stat` or `ls`
+    """
+    for backend, (command, pattern) in PROBES.items():
+        output = shell(command.format(root=DEVICE_ROOT))
+        if pattern.match(output):
+            return backend
+    return LS
+
+
+def scan(backend: str, full_scan: bool = False) -> Iterator[tuple[str, str, int, int | str]]:
+    """Function that lists all regular files on the device using the given `backend`. With `find` backend the scan is incremental: only directories whose stamp changed since the previous scan are listed again, rest are reused from the scan cache. Change detection relies on the dir mtime, which changes whenever an entry is added, removed or renamed.
+
+    Args:
+        backend (str): Backend name returned by `detect()`
+        full_scan (bool, optional): Ignore the scan cache and list everything. Defaults to False.
+
+    Yields:
+        Iterator[tuple[str, str, int, int | str]]: Directory name (with trailing `/`), file name, size & mtime in epoch seconds (ISO 8601 string for `ls`)
+    """
+    if backend != FIND:
+        yield from listing(COMMANDS[backend].format(root=DEVICE_ROOT), backend)
+        return
+    cache = ScanCache()
+    # device time & dir stamps are taken before listing, so changes made during the scan are caught next time
+    started = device_time()
+    dirs = scan_dirs()
+    if full_scan or not cache.exists():
+        entries = listing(COMMANDS[FIND].format(root=DEVICE_ROOT), FIND)
+    else:
+        entries = scan_incremental(cache, dirs, started)
+    yield from cache.save(entries, dirs, started)
+
+
+def listing(command: str, backend: str) -> Iterator[tuple[str, str, int, int | str]]:
+    """Function that executes a listing `command` on device and parses its output with `backend` parser
+
+    Args:
+        command (str): Listing command
+        backend (str): Backend name
+
+    Yields:
+        Iterator[tuple[str, str, int, int | str]]: Directory name, file name, size & mtime
+    """
+    log.info(f"Executing: {command}")
+    with exec_out(command) as stream:
+        records = iter_records(stream.conn.makefile("rb"), SEPARATORS[backend])
+        if backend == LS:
+            yield from parse_ls(records)
+        elif backend == STAT:
+            yield from parse_records(record.removesuffix("\n") for record in records)
+        else:
+            yield from parse_records(records)
+
+
+def device_time() -> int:
+    """Function that returns current time of the device clock
+
+    Returns:
+        int: Epoch seconds
+    """
+    return int(shell("date +%s"))
+
+
+def scan_dirs() -> DataFrame:
+    """Function that lists all directories of the device with their stamps
+
+    Returns:
+        DataFrame: `Dir` (with trailing `/`) & `Stamp` (mtime) of each directory
+    """
+    dirs = []
+    command = DIRS_COMMAND.format(root=DEVICE_ROOT)
+    log.info(f"Executing: {command}")
+    with exec_out(command) as stream:
+        for record in iter_records(stream.conn.makefile("rb"), SEPARATORS[FIND]):
+            if record:
+                mtime, path = record.split(" ", 1)
+                dirs.append((path.replace("//", "/").rstrip("/") + "/", mtime))
+    return DataFrame(dirs, columns=["Dir", "Stamp"])
+
+
+def scan_incremental(cache: "ScanCache", dirs: DataFrame, started: int) -> Iterator[tuple[str, str, int, int]]:
+    """Function that lists only changed directories and reuses cached entries of unchanged ones. Files modified in place don't change the stamp of their directory, so they are found by their ctime instead.
+
+    Args:
+        cache (ScanCache): Cache of previous scan
+        dirs (DataFrame): Current directory stamps
+        started (int): Device time at the start of current scan
+
+    Yields:
+        Iterator[tuple[str, str, int, int]]: Directory name, file name, size & mtime in epoch seconds
+    """
+    cached_dirs, cached_files, last_started = cache.load()
+    stamps = dict(zip(cached_dirs["Dir"], cached_dirs["Stamp"]))
+    changed = [dir_name for dir_name, stamp in zip(dirs["Dir"], dirs["Stamp"]) if stamps.get(dir_name) != stamp]
+    log.info(f"Incremental scan: {len(changed)} of {len(dirs)} dirs changed")
+    # files changed since the previous scan started, in any dir
+    minutes = (started - last_started) // 60 + 2
+    modified = {f"{entry[0]}{entry[1]}": entry for entry in listing(MODIFIED_COMMAND.format(root=DEVICE_ROOT, minutes=minutes), FIND)}
+    # list files of changed dirs again
+    for batch in split_batch(changed) if changed else []:
+        for entry in listing(DIR_FILES_COMMAND.format(dirs=" ".join(map(quote, batch))), FIND):
+            modified.pop(f"{entry[0]}{entry[1]}", None)
+            yield entry
+    # reuse cached files of unchanged dirs
+    unchanged = set(dirs["Dir"]) - set(changed)
+    reused = cached_files[cached_files["Dir"].isin(unchanged)]
+    for dir_name, name, size, mtime in zip(reused["Dir"], reused["File"], reused["Size"], reused["Date"]):
+        yield modified.pop(f"{dir_name}{name}", (dir_name, name, int(size), int(mtime)))
+    # files modified in unchanged dirs that were not in cache
+    for entry in modified.values():
+        if entry[0] in unchanged:
+            yield entry
+
+
+class ScanCache:
+    """Cache of the previous `find` scan of a device: stamps of every directory, every scanned entry & device time at the start of the scan.
+    """
+    def __init__(self, directory: Path = SCAN_CACHE_DIR) -> None:
+        """Initializes cache file paths within `directory`
+
+        Args:
+            directory (Path, optional): Cache directory. Defaults to SCAN_CACHE_DIR.
+        """
+        self.directory = directory
+        self.dirs_file = directory/"dirs.parquet"
+        self.files_file = directory/"files.parquet"
+        self.state_file = directory/"state.json"
+
+    def exists(self) -> bool:
+        """Function that checks whether a complete cache exists
+
+        Returns:
+            bool: True if exists
+        """
+        return self.dirs_file.exists() and self.files_file.exists() and self.state_file.exists()
+
+    def load(self) -> tuple[DataFrame, DataFrame, int]:
+        """Function that loads the cache
+
+        Returns:
+            tuple[DataFrame, DataFrame, int]: Directory stamps, entries (with `Dir` column) & device time of previous scan
+        """
+        dirs = manifest.load(self.dirs_file)
+        files = manifest.load(self.files_file)
+        files["Dir"] = files["Path"].str.rpartition("/")[0] + "/"
+        with open(self.state_file, "r", encoding=UTF_8) as fr:
+            started = json.load(fr)["started"]
+        return dirs, files, started
+
+    def save(self, entries: Iterator[tuple[str, str, int, int | str]], dirs: DataFrame, started: int) -> Iterator[tuple[str, str, int, int | str]]:
+        """Function that passes the `entries` through while recording them as the new cache. Cache is replaced only once all entries are consumed, so an interrupted scan keeps the previous cache.
+
+        Args:
+            entries (Iterator[tuple[str, str, int, int | str]]): Scanned entries
+            dirs (DataFrame): Directory stamps of the scan
+            started (int): Device time at the start of the scan
+
+        Yields:
+            Iterator[tuple[str, str, int, int | str]]: Same entries
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        files_file = self.files_file.with_suffix(".tmp")
+        with manifest.Writer(files_file) as writer:
+            writer.write(DataFrame(columns=CACHE_COLUMNS))
+            while chunk := list(islice(entries, CACHE_CHUNK_SIZE)):
+                writer.write(DataFrame([(name, size, mtime, f"{dir_name}{name}") for dir_name, name, size, mtime in chunk], columns=CACHE_COLUMNS))
+                yield from chunk
+        manifest.save(dirs, self.dirs_file)
+        replace(files_file, self.files_file)
+        with open(self.state_file, "w", encoding=UTF_8) as fw:
+            json.dump({"started": started}, fw)
+
+
+def iter_records(stream: BinaryIO, separator: bytes) -> Iterator[str]:
+    """Function that splits a binary `stream` into records on `separator` while it's read
+
+    Args:
+        stream (BinaryIO): Binary output stream of device command
+        separator (bytes): Record separator
+
+    Yields:
+        Iterator[str]: Decoded records
+    """
+    pending = b""
+    while chunk := stream.read(READ_SIZE):
+        records = (pending + chunk).split(separator)
+        pending = records.pop()
+        for record in records:
+            yield record.decode(UTF_8, errors="replace")
+    if pending:
+        yield pending.decode(UTF_8, errors="replace")
+
+
+def parse_records(records: Iterator[str]) -> Iterator[tuple[str, str, int, int]]:
+    """Function that parses machine readable `size mtime path` records of `find` & `stat` backends
+
+    Args:
+        records (Iterator[str]): Records of the listing
+
+    Yields:
+        Iterator[tuple[str, str, int, int]]: Directory name, file name, size & mtime in epoch seconds
+    """
+    for record in records:
+        if not record:
+            continue
+        size, mtime, path = record.split(" ", 2)
+        dir_name, _, name = path.replace("//", "/").rpartition("/")
+        yield f"{dir_name}/", name, int(size), int(mtime.partition(".")[0])
+
+
+def parse_ls(lines: Iterator[str]) -> Iterator[tuple[str, str, int, str]]:
+    """Function that parses `ls -llR` text listing. Used for devices whose toybox lacks both `find -printf` & `stat -c`.
+
+    Args:
+        lines (Iterator[str]): Lines of the listing
+
+    Yields:
+        Iterator[tuple[str, str, int, str]]: Directory name, file name, size & mtime as ISO 8601 string
+    """
+    dir_name = ""
+    header = True
+    for line in lines:
+        if not line:
+            # a blank line separates two directory blocks, next line is a dir header
+            header = True
+        elif header:
+            dir_name = line.removesuffix(":").rstrip("/") + "/"
+            header = False
+        elif line.startswith("-r"):
+            # permissions, links, owner, group, size, date, time, timezone & name, name can contain spaces
+            parts = line.split(None, 8)
+            # date is kept as an ISO 8601 string, dates of a whole chunk are parsed at once by `metadata.to_frame`
+            yield dir_name, parts[8], int(parts[4]), f"{parts[5]}T{parts[6]}{parts[7]}"
@@ -0,0 +1,321 @@
+import json
+import os
+from collections import deque
+from pathlib import Path, PurePosixPath
+from threading import Condition, Event, Lock
+from time import monotonic
+from typing import Callable, Iterable
+
+from app.delta import DeltaNamedTuple
+from app.transfer import part_of
+from app.vars import (
+    BACKUP_NAME,
+    BATCH_SIZE,
+    LARGE_FILE_SIZE,
+    LARGE_FILE_TIME,
+    PULL_WORKERS,
+    RANGED_FILE_SIZE,
+    SMALL_FILE_SIZE,
+    TUNE_INTERVAL,
+    TUNE_MARGIN,
+    TUNE_WINDOW,
+    TUNING,
+)
+from utils import UTF_8
+
+
+# A job is either a single row or a batch of small rows pulled as one stream
+Job = DeltaNamedTuple | list[DeltaNamedTuple]
+
+# Stats keys of batched & of all single file transfers, single files are also measured per size class
+BATCH = "batch"
+SINGLE = "single"
+# Transfer seconds a stat needs before its rate is trusted
+MIN_SECONDS = 1.0
+
+
+class Tuning:
+    """Transfer settings of a device, learned from the throughput of its sessions. Throughput is measured for batches of small files and for single files of each size class, the settings are adjusted while a session runs & persisted per device model, so the next session starts tuned.
+    """
+    def __init__(self, file: Path | None = TUNING, name: str = BACKUP_NAME) -> None:
+        """Loads the settings learned for `name` from `file`, defaults are used for a new device
+
+        Args:
+            file (Path | None, optional): Tuning file, None keeps the defaults & never persists. Defaults to TUNING.
+            name (str, optional): Device model the settings are learned for. Defaults to BACKUP_NAME.
+        """
+        self.file = file
+        self.name = name
+        # Active small lane workers, files <= small_size are batched by batch_size, files > large_size get a lane & an alt progress bar. batch_size is never tuned, so it's not persisted.
+        self.workers = PULL_WORKERS
+        self.small_size = SMALL_FILE_SIZE
+        self.batch_size = BATCH_SIZE
+        self.large_size = LARGE_FILE_SIZE
+        # Transferred bytes & seconds of each stats key
+        self.stats: dict[str, list[float]] = {}
+        if file is not None and file.exists():
+            with open(file, "r", encoding=UTF_8) as fr:
+                learned = json.load(fr).get(name, {})
+            self.workers = learned.get("workers", self.workers)
+            self.small_size = learned.get("small_size", self.small_size)
+            self.large_size = learned.get("large_size", self.large_size)
+            self.stats = learned.get("stats", {})
+        self.lock = Lock()
+
+    @staticmethod
+    def size_class(size: int) -> str:
+        """Function that returns the size class of a file, each class holds the sizes from 2^(n-1) upto 2^n bytes
+
+        Args:
+            size (int): File size in bytes
+
+        Returns:
+            str: Stats key of the class
+        """
+        return str(max(size, 1).bit_length())
+
+    def measured(self, key: str, size: int, seconds: float) -> None:
+        """Function that adds a transfer to the stats of `key`. Stats are halved once they exceed TUNE_WINDOW bytes, so recent transfers outweigh old ones.
+
+        Args:
+            key (str): Stats key
+            size (int): Bytes transferred
+            seconds (float): Time taken
+        """
+        with self.lock:
+            stats = self.stats.setdefault(key, [0, 0.0])
+            stats[0] += size
+            stats[1] += seconds
+            if stats[0] > TUNE_WINDOW:
+                stats[0] //= 2
+                stats[1] /= 2
+
+    def rate(self, key: str) -> float | None:
+        """Function that returns the measured throughput of `key`
+
+        Args:
+            key (str): Stats key
+
+        Returns:
+            float | None: Bytes per second or None if not measured long enough
+        """
+        size, seconds = self.stats.get(key, (0, 0.0))
+        return size / seconds if seconds >= MIN_SECONDS else None
+
+    def adjust(self) -> None:
+        """Function that adjusts the size thresholds to the measured throughput. Small files are batched upto the size where single files transfer as fast as batches, and files that take longer than LARGE_FILE_TIME at the single file rate are large.
+        """
+        with self.lock:
+            batch, above, single = self.rate(BATCH), self.rate(self.size_class(self.small_size * 2)), self.rate(SINGLE)
+            if batch is not None and above is not None:
+                if batch > above * (1 + TUNE_MARGIN):
+                    # files just above the threshold still pay per file overhead
+                    self.small_size = min(self.small_size * 2, self.large_size // 4)
+                elif above > batch * (1 + TUNE_MARGIN):
+                    self.small_size = max(self.small_size // 2, SMALL_FILE_SIZE // 16)
+            if single is not None:
+                # files above ranged size must stay large, only large files are pulled in ranges
+                self.large_size = min(max(int(single * LARGE_FILE_TIME), self.small_size * 4), RANGED_FILE_SIZE)
+
+    def save(self) -> None:
+        """Function that persists the learned settings alongside those of other devices. The file is written under a temp name and renamed into place, so an interrupted save keeps the previous settings.
+        """
+        if self.file is None:
+            return
+        learned = {}
+        if self.file.exists():
+            with open(self.file, "r", encoding=UTF_8) as fr:
+                learned = json.load(fr)
+        with self.lock:
+            learned[self.name] = {"workers": self.workers, "small_size": self.small_size, "large_size": self.large_size, "stats": self.stats}
+        self.file.parent.mkdir(parents=True, exist_ok=True)
+        part_file = part_of(self.file)
+        with open(part_file, "w", encoding=UTF_8) as fw:
+            json.dump(learned, fw, indent=2, sort_keys=True)
+        os.replace(part_file, self.file)
+
+
+class Scheduler:
+    """Size aware work queue that hands out deltaframe rows to the pull workers.
+
+    Rows are split into two lanes, `small` and `large`. Each worker is bound to a lane and only steals from the other lane once its own lane runs dry, so a few huge videos can never block thousands of small files behind them. The small lane is ordered by dir and rows up to `small_size` are grouped into batches of `batch_size` rows as they are handed out, the large lane is ordered by size so the longest pulls start first.
+
+    An adaptive scheduler keeps only `tuning.workers` of its small lane workers active, the worker reserved for the large lane always runs. Every TUNE_INTERVAL seconds it compares the throughput of the link with that of the previous interval & climbs towards the worker count that moves the most bytes, then adjusts the size thresholds of `tuning` and re-splits the lanes if the large file cutoff moved.
+    """
+    SMALL = "small"
+    LARGE = "large"
+
+    def __init__(self, rows: Iterable[DeltaNamedTuple], tuning: Tuning, workers: int, progress: Callable[[], float] | None = None, adaptive: bool = False) -> None:
+        """Initializes the lanes from the given `rows`
+
+        Args:
+            rows (Iterable[DeltaNamedTuple]): Deltaframe rows that needs to be pulled from device
+            tuning (Tuning): Size thresholds & worker count
+            workers (int): Total number of workers
+            progress (Callable[[], float] | None, optional): Returns the total bytes transferred so far, counted from finished jobs if not given. Defaults to None.
+            adaptive (bool, optional): Tune the worker count & thresholds while running. Defaults to False.
+        """
+        self.tuning = tuning
+        self.workers = max(1, workers)
+        self.adaptive = adaptive
+        self.progress = progress
+        self.lanes: dict[str, deque[DeltaNamedTuple]] = {self.SMALL: deque(), self.LARGE: deque()}
+        self.condition = Condition()
+        self.stopped = Event()
+        self.split(rows)
+        # Small lane workers running a job & max of them allowed to
+        self.active = 0
+        self.limit = min(max(1, tuning.workers), self.workers) if adaptive else self.workers
+        # Bytes of finished jobs, state of the last interval & the direction the worker count is moving in
+        self.completed = 0
+        self.tuned = monotonic()
+        self.total = self.transferred()
+        self.rate = 0.0
+        self.best = 0.0
+        self.direction = 1
+
+    def split(self, rows: Iterable[DeltaNamedTuple]) -> None:
+        """Function that orders `rows` into the lanes
+
+        Args:
+            rows (Iterable[DeltaNamedTuple]): Rows to be scheduled
+        """
+        small, large = [], []
+        for row in rows:
+            (large if row.Size > self.tuning.large_size else small).append(row)
+        # stable sort keeps deltaframe order within a dir, so each batch mostly covers a single dir
+        small.sort(key=lambda row: str(PurePosixPath(row.Path).parent))
+        large.sort(key=lambda row: row.Size, reverse=True)
+        self.lanes = {self.SMALL: deque(small), self.LARGE: deque(large)}
+
+    def lane_of(self, size: int) -> str:
+        """Function that returns the lane name for a given file `size`
+
+        Args:
+            size (int): File size in bytes
+
+        Returns:
+            str: `small` or `large`
+        """
+        return self.LARGE if size > self.tuning.large_size else self.SMALL
+
+    def lanes_for(self, workers: int) -> list[str]:
+        """Function that assigns a lane to each of the `workers`. One worker is reserved for large files when there are any, rest are for small files.
+
+        Args:
+            workers (int): Total number of workers
+
+        Returns:
+            list[str]: Lane name per worker
+        """
+        workers = max(1, workers)
+        if workers == 1 or not self.lanes[self.LARGE]:
+            return [self.SMALL] * workers
+        return [self.LARGE] + [self.SMALL] * (workers - 1)
+
+    def take(self, lane: str, steal: bool = False) -> Job | None:
+        """Function that pops the next job of `lane`, consecutive small rows are batched
+
+        Args:
+            lane (str): Lane name
+            steal (bool, optional): Job is taken by a worker of the other lane. Defaults to False.
+
+        Returns:
+            Job | None: Next row/batch or None if the lane is empty
+        """
+        queue = self.lanes[lane]
+        if not queue:
+            return None
+        if lane == self.LARGE:
+            # steal large files from the back so the large lane keeps its head
+            return queue.pop() if steal else queue.popleft()
+        row = queue.popleft()
+        if row.Size > self.tuning.small_size or self.tuning.batch_size <= 1:
+            return row
+        batch = [row]
+        while queue and len(batch) < self.tuning.batch_size and queue[0].Size <= self.tuning.small_size:
+            batch.append(queue.popleft())
+        return batch
+
+    def next(self, lane: str) -> Job | None:
+        """Function that pops the next job for a worker bound to `lane`. Falls back to the other lane once the given one is empty. Workers of the small lane wait while the active ones are at the limit, the worker reserved for the large lane is never held back, so a big file can't take the only slot of the small files.
+
+        Args:
+            lane (str): Lane of the worker
+
+        Returns:
+            Job | None: Next row/batch to pull or None if the queue is drained/stopped
+        """
+        other = self.LARGE if lane == self.SMALL else self.SMALL
+        with self.condition:
+            while lane == self.SMALL and self.active >= self.limit and len(self) and not self.stopped.is_set():
+                self.condition.wait(TUNE_INTERVAL)
+            if self.stopped.is_set():
+                return None
+            job = self.take(lane)
+            if job is None:
+                job = self.take(other, steal=True)
+            if job is not None and lane == self.SMALL:
+                self.active += 1
+            return job
+
+    def done(self, job: Job, seconds: float, lane: str) -> None:
+        """Function that reports a finished job & the seconds it took, tunes the scheduler once TUNE_INTERVAL has passed
+
+        Args:
+            job (Job): Finished row/batch
+            seconds (float): Time taken by the transfer
+            lane (str): Lane of the worker that ran the job
+        """
+        size = sum(int(row.Size) for row in job) if isinstance(job, list) else int(job.Size)
+        if isinstance(job, list):
+            self.tuning.measured(BATCH, size, seconds)
+        else:
+            self.tuning.measured(self.tuning.size_class(size), size, seconds)
+            self.tuning.measured(SINGLE, size, seconds)
+        with self.condition:
+            if lane == self.SMALL:
+                self.active -= 1
+            self.completed += size
+            if self.adaptive and monotonic() - self.tuned >= TUNE_INTERVAL:
+                self.tune()
+            self.condition.notify_all()
+
+    def transferred(self) -> float:
+        """Function that returns the total bytes transferred so far
+
+        Returns:
+            float: Bytes
+        """
+        return self.progress() if self.progress is not None else self.completed
+
+    def tune(self) -> None:
+        """Function that moves the worker limit one step per interval, the direction is reversed when the throughput drops or a bound is reached. Worker count of the best interval is kept in `tuning`. Called with the condition held.
+        """
+        now = monotonic()
+        total = self.transferred()
+        rate = (total - self.total) / (now - self.tuned)
+        if rate < self.rate * (1 - TUNE_MARGIN):
+            # last step made the link slower, step back
+            self.direction = -self.direction
+        if rate >= self.best:
+            self.best = rate
+            self.tuning.workers = self.limit
+        if not 1 <= self.limit + self.direction <= self.workers:
+            self.direction = -self.direction
+        self.limit = min(max(self.limit + self.direction, 1), self.workers)
+        self.tuned, self.total, self.rate = now, total, rate
+        large_size = self.tuning.large_size
+        self.tuning.adjust()
+        if self.tuning.large_size != large_size:
+            self.split([*self.lanes[self.SMALL], *self.lanes[self.LARGE]])
+
+    def stop(self) -> None:
+        """Function that stops handing out rows, used when any of the workers fail
+        """
+        self.stopped.set()
+        with self.condition:
+            self.condition.notify_all()
+
+    def __len__(self) -> int:
+        return sum(len(lane) for lane in self.lanes.values())
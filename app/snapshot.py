@@ -0,0 +1,126 @@
+import os
+from contextlib import suppress
+from datetime import datetime, timedelta
+from pathlib import Path, PurePosixPath
+from shutil import copy2
+
+from rich.filesize import decimal
+
+from app.catalog import BACKUP, DELTA, VERSION, Catalog
+from app.transfer import part_of
+from app.vars import BACKUP_DIR, DELTA_DIR, DEVICE_ROOT, RETENTION_DAYS, TIMESTAMP, VERSIONS_DIR
+from utils import log
+
+
+# Format of snapshot timestamps, same as TIMESTAMP
+TIMESTAMP_FORMAT = "%Y%m%d%H%M%S"
+
+
+def stored_file(location: str, stored: str) -> Path:
+    """Function that returns the local file holding the content of a version
+
+    Args:
+        location (str): Catalog location of the version
+        stored (str): Stored path of the version, a device path for backup & delta, a path within versions dir otherwise
+
+    Returns:
+        Path: Local file path
+    """
+    if location == VERSION:
+        return VERSIONS_DIR/stored
+    return (DELTA_DIR if location == DELTA else BACKUP_DIR)/PurePosixPath(stored).relative_to(DEVICE_ROOT)
+
+
+def keep(catalog: Catalog, path: str) -> bool:
+    """Function that keeps the backed up copy of a device path before it's removed or replaced, by moving it into the versions dir of this session. Copies no closed version refers to are not kept.
+
+    Args:
+        catalog (Catalog): Catalog of the device
+        path (str): Device path
+
+    Returns:
+        bool: True if kept
+    """
+    src_file = stored_file(BACKUP, path)
+    if not src_file.exists() or not catalog.superseded(path):
+        return False
+    stored = f"{TIMESTAMP}/{PurePosixPath(path).relative_to(DEVICE_ROOT)}"
+    dst_file = VERSIONS_DIR/stored
+    dst_file.parent.mkdir(parents=True, exist_ok=True)
+    os.replace(src_file, dst_file)
+    catalog.relocate(BACKUP, path, VERSION, stored)
+    return True
+
+
+def listing() -> None:
+    """Function that logs the recorded snapshots of the device
+    """
+    with Catalog() as catalog:
+        snapshots = catalog.snapshots()
+    for timestamp, files, size in snapshots:
+        log.info(f"Snapshot {datetime.strptime(timestamp, TIMESTAMP_FORMAT)}  > {files} files [{decimal(size)}]")
+    if not snapshots:
+        log.info("No snapshots recorded")
+
+
+def materialize(timestamp: str, dst_dir: Path, link: bool = False) -> int:
+    """Function that rebuilds the device tree as it was at `timestamp` into `dst_dir`. Versions are looked up in the catalog, neither the backup dir nor the versions dir is walked.
+
+    Args:
+        timestamp (str): Point in time, in TIMESTAMP format
+        dst_dir (Path): Destination dir
+        link (bool, optional): Hardlink files instead of copying, files must then never be written in place. Defaults to False.
+
+    Returns:
+        int: Files materialized
+    """
+    datetime.strptime(timestamp, TIMESTAMP_FORMAT)
+    with Catalog() as catalog:
+        versions = catalog.versions_at(timestamp)
+    total = 0
+    missing = 0
+    for path, _, _, location, stored in versions:
+        src_file = stored_file(location, stored)
+        dst_file = dst_dir/PurePosixPath(path).relative_to(DEVICE_ROOT)
+        if not src_file.exists():
+            missing += 1
+            continue
+        dst_file.parent.mkdir(parents=True, exist_ok=True)
+        part_file = part_of(dst_file)
+        part_file.unlink(missing_ok=True)
+        linked = False
+        if link:
+            # linking isn't possible across volumes, those files are copied
+            with suppress(OSError):
+                os.link(src_file, part_file)
+                linked = True
+        if not linked:
+            copy2(src_file, part_file)
+        os.replace(part_file, dst_file)
+        total += 1
+    log.info(f"Snapshot {timestamp} materialized > {dst_dir} [{total} files]")
+    if missing:
+        log.info(f"Snapshot {timestamp} is missing {missing} files")
+    return total
+
+
+def gc(days: int = RETENTION_DAYS) -> int:
+    """Function that applies the retention policy. Versions that ended & snapshots taken more than `days` ago are dropped, and their files are deleted from the versions dir.
+
+    Args:
+        days (int, optional): Retention in days. Defaults to RETENTION_DAYS.
+
+    Returns:
+        int: Files deleted
+    """
+    cutoff = (datetime.strptime(TIMESTAMP, TIMESTAMP_FORMAT) - timedelta(days=days)).strftime(TIMESTAMP_FORMAT)
+    with Catalog() as catalog:
+        orphans = catalog.expire(cutoff)
+    for stored in orphans:
+        (VERSIONS_DIR/stored).unlink(missing_ok=True)
+    # prune the dirs emptied by the deletes, deepest first
+    for dir_path in sorted({(VERSIONS_DIR/stored).parent for stored in orphans}, key=lambda dir_path: len(dir_path.parts), reverse=True):
+        while dir_path != VERSIONS_DIR and dir_path.is_dir() and not any(dir_path.iterdir()):
+            dir_path.rmdir()
+            dir_path = dir_path.parent
+    return len(orphans)
@@ -0,0 +1,127 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import file_digest
+from pathlib import Path
+from typing import Iterable
+
+from rich.filesize import decimal
+
+from app.catalog import Catalog
+from app.transfer import part_of
+from app.vars import BACKUP_DIR, CATALOG, MERGE_WORKERS, OBJECT_STORE
+from utils import log
+
+
+# Hash algorithm of the object names
+HASH = "sha256"
+
+
+class ObjectStore:
+    """Content addressed store of the backup dir. Every distinct content is kept once as an object named by its hash, files of the visible backup tree (and versions dir) are hardlinks to these objects. Objects are never written in place: backup files are only ever replaced by a rename, which leaves the object intact.
+    """
+    def __init__(self, catalog: Catalog, directory: Path = OBJECT_STORE, root: Path = BACKUP_DIR) -> None:
+        """Initializes the store
+
+        Args:
+            catalog (Catalog): Catalog that caches the hashes of files
+            directory (Path, optional): Objects directory. Defaults to OBJECT_STORE.
+            root (Path, optional): Backup dir the store belongs to, must be on the same volume. Defaults to BACKUP_DIR.
+        """
+        self.catalog = catalog
+        self.directory = directory
+        self.root = root
+
+    def object_of(self, digest: str) -> Path:
+        """Function that returns the object path of a content hash
+
+        Args:
+            digest (str): Hex digest
+
+        Returns:
+            Path: Object path, fanned out by the first 2 hex digits
+        """
+        return self.directory/digest[:2]/digest
+
+    def digest(self, file: Path) -> str:
+        """Function that hashes a file, the hash is cached by size & mtime so unchanged files are never read again
+
+        Args:
+            file (Path): File within backup dir
+
+        Returns:
+            str: Hex digest
+        """
+        stat = file.stat()
+        key = file.relative_to(self.root).as_posix()
+        if (digest := self.catalog.digest(key, stat.st_size, stat.st_mtime_ns)) is None:
+            with open(file, "rb") as fr:
+                digest = file_digest(fr, HASH).hexdigest()
+            self.catalog.record_digest(key, stat.st_size, stat.st_mtime_ns, digest)
+        return digest
+
+    def add(self, file: Path) -> int:
+        """Function that adds a file to the store. If its content is already stored, the file is replaced by a hardlink to the object, else the file itself becomes the object.
+
+        Args:
+            file (Path): File within backup dir
+
+        Returns:
+            int: Bytes deduplicated, 0 if the content is new or the file is already linked
+        """
+        digest = self.digest(file)
+        object_file = self.object_of(digest)
+        if not object_file.exists():
+            object_file.parent.mkdir(parents=True, exist_ok=True)
+            os.link(file, object_file)
+            return 0
+        if os.path.samefile(object_file, file):
+            return 0
+        # link into a temp name first, so the file is replaced atomically
+        part_file = part_of(file)
+        os.link(object_file, part_file)
+        os.replace(part_file, file)
+        # the file now shares the mtime of the object, cache the hash under its new stat
+        stat = file.stat()
+        self.catalog.record_digest(file.relative_to(self.root).as_posix(), stat.st_size, stat.st_mtime_ns, digest)
+        return stat.st_size
+
+    def add_all(self, files: Iterable[Path], workers: int = MERGE_WORKERS) -> int:
+        """Function that adds `files` to the store, hashing them with a pool of `workers`
+
+        Args:
+            files (Iterable[Path]): Files within backup dir, missing files are skipped
+            workers (int, optional): Files hashed at the same time. Defaults to MERGE_WORKERS.
+
+        Returns:
+            int: Bytes deduplicated
+        """
+        files = list(files)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            digests = dict(zip(files, pool.map(lambda file: self.digest(file) if file.is_file() else None, files)))
+        # linking is cheap & must not race on the same object, so it's done in order
+        return sum(self.add(file) for file, digest in digests.items() if digest is not None)
+
+    def gc(self) -> int:
+        """Function that deletes the objects no file links to anymore
+
+        Returns:
+            int: Objects deleted
+        """
+        deleted = 0
+        for object_file in self.directory.glob("*/*"):
+            if object_file.stat().st_nlink == 1:
+                object_file.unlink()
+                deleted += 1
+        return deleted
+
+
+def dedup() -> None:
+    """Function that converts the whole backup dir (including versions dir) into the deduplicated layout. Hashes are cached, so running it again only reads new or changed files. Catalog is written in place, so it's never linked.
+    """
+    log.info(f"Deduplicating backup dir   > {BACKUP_DIR}")
+    with Catalog() as catalog:
+        store = ObjectStore(catalog)
+        files = [file for file in BACKUP_DIR.rglob("*") if file.is_file() and not file.is_relative_to(OBJECT_STORE) and not file.name.startswith(CATALOG.name)]
+        saved = store.add_all(files)
+        deleted = store.gc()
+    log.info(f"Backup dir deduplicated    > {decimal(saved)} saved [{deleted} objects deleted]")
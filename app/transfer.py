@@ -0,0 +1,504 @@
+import os
+import socket
+import tarfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import md5
+from math import ceil
+from os import replace
+from pathlib import Path, PurePosixPath
+from re import fullmatch
+from shlex import quote
+from shutil import copyfileobj
+from threading import Lock
+from time import monotonic
+from typing import Any, BinaryIO, Callable, Iterator, cast
+
+from app.compression import COMPRESS_COMMAND, GZIP_WBITS
+from utils.android import exec_out, iter_content, shell
+
+
+# Files are pulled into a temp name with this suffix and renamed into place once complete
+PART_SUFFIX = ".part"
+# Chunk size used to read a resumed stream
+READ_SIZE = 1 << 20
+# Block size of device side `dd`, range sizes are a multiple of it
+RANGE_BLOCK = 1 << 20
+# Output of device side `md5sum`, one digest per range
+MD5_PATTERN = r"[0-9a-f]{32}"
+# Device side extractor of pushed tar streams, its exit status is printed last
+PUSH_COMMAND = "cd / && tar -xf - 2>&1; echo $?"
+# Max length of a single exec command, long batches are split to stay within adb payload limits
+MAX_COMMAND_LENGTH = 32_768
+
+
+def batch_command(files: list[str], compress: bool = False) -> str:
+    """Function that generates the device command which streams all `files` as a single tar archive over stdout
+
+    Args:
+        files (list[str]): Device file paths relative to `/`
+        compress (bool, optional): Compress the archive on device. Defaults to False.
+
+    Returns:
+        str: Shell command to be used with `exec_out`
+    """
+    command = f"cd / && tar -cf - {" ".join(map(quote, files))} 2>/dev/null"
+    return f"{command} | {COMPRESS_COMMAND}" if compress else command
+
+
+class CountingReader:
+    """Binary reader that counts the bytes read from the wrapped `stream`
+    """
+    def __init__(self, stream: BinaryIO) -> None:
+        self.stream = stream
+        self.count = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.stream.read(size)
+        self.count += len(data)
+        return data
+
+
+class ProgressReader(CountingReader):
+    """Binary reader that reports the bytes read from the wrapped `stream` to `callback`, at most once per `interval` seconds
+    """
+    def __init__(self, stream: BinaryIO, callback: Callable[[int], None], interval: float) -> None:
+        super().__init__(stream)
+        self.callback = callback
+        self.interval = interval
+        self.last_update = monotonic()
+
+    def read(self, size: int = -1) -> bytes:
+        data = super().read(size)
+        if (now := monotonic()) - self.last_update >= self.interval:
+            self.callback(self.count)
+            self.last_update = now
+        return data
+
+
+class FsyncBatch:
+    """Batched fsync of pulled files. Files are flushed to disk `size` at a time, one sync per file instead of a sync after every write, and each file is reported to `callback` only once it's durable. A crash therefore never loses a file that a restarted session would skip.
+    """
+    def __init__(self, callback: Callable[[Any], None], size: int) -> None:
+        """Initializes the empty batch
+
+        Args:
+            callback (Callable[[Any], None]): Called with the item of each file once it's on disk
+            size (int): Files per batch
+        """
+        self.callback = callback
+        self.size = size
+        self.pending: list[tuple[Path, Any]] = []
+        self.lock = Lock()
+
+    def add(self, file: Path, item: Any) -> None:
+        """Function that adds a completely written `file` to the batch, the batch is flushed once it's full
+
+        Args:
+            file (Path): Local file path
+            item (Any): Passed to the callback once the file is on disk
+        """
+        with self.lock:
+            self.pending.append((file, item))
+            if len(self.pending) < self.size:
+                return
+        self.flush()
+
+    def flush(self) -> None:
+        """Function that syncs every pending file to disk and reports them to the callback
+        """
+        with self.lock:
+            pending, self.pending = self.pending, []
+        for file, _ in pending:
+            # a writable handle is needed to flush buffers on every platform
+            with open(file, "r+b") as fw:
+                os.fsync(fw.fileno())
+        for _, item in pending:
+            self.callback(item)
+
+
+def part_of(file: Path) -> Path:
+    """Function that returns the temp file a pull of `file` is written to
+
+    Args:
+        file (Path): Local destination file path
+
+    Returns:
+        Path: Temp file path next to `file`
+    """
+    return file.with_name(file.name + PART_SUFFIX)
+
+
+def split_batch(files: list[str]) -> list[list[str]]:
+    """Function that splits a batch of `files` so that each batch command stays within MAX_COMMAND_LENGTH
+
+    Args:
+        files (list[str]): Device file paths relative to `/`
+
+    Returns:
+        list[list[str]]: Batches of file paths
+    """
+    batches: list[list[str]] = [[]]
+    length = len(batch_command([]))
+    for file in files:
+        file_length = len(quote(file)) + 1
+        if batches[-1] and length + file_length > MAX_COMMAND_LENGTH:
+            batches.append([])
+            length = len(batch_command([]))
+        batches[-1].append(file)
+        length += file_length
+    return batches
+
+
+def pull_batch(files: list[str], dst_root: Path, src_root: PurePosixPath, compress: bool = False, on_wire: Callable[[int], None] | None = None) -> Iterator[tuple[str, int]]:
+    """Function that pulls a batch of small `files` as one tar stream using `exec-out` and unpacks it into `dst_root` while it arrives. No temp archive is written on either side.
+
+    Args:
+        files (list[str]): Device file paths relative to `/`
+        dst_root (Path): Local destination root directory
+        src_root (PurePosixPath): Device root that maps to `dst_root`
+        compress (bool, optional): Stream is gzip compressed on device and decompressed while it arrives. Defaults to False.
+        on_wire (Callable[[int], None] | None, optional): Callback that receives the bytes on the wire of each tar stream. Defaults to None.
+
+    Yields:
+        Iterator[tuple[str, int]]: Device path and size of each file as soon as it's unpacked
+    """
+    for batch in split_batch(files):
+        requested = set(batch)
+        with exec_out(batch_command(batch, compress)) as stream:
+            reader = CountingReader(stream.conn.makefile("rb"))
+            with tarfile.open(fileobj=reader, mode="r|gz" if compress else "r|") as tar:
+                for member in tar:
+                    if not member.isfile() or member.name not in requested:
+                        continue
+                    # member names are the device paths relative to `/`, resolve them against dst_root manually
+                    src_file = PurePosixPath(member.name)
+                    dst_file = dst_root/src_file.relative_to(src_root)
+                    dst_file.parent.mkdir(parents=True, exist_ok=True)
+                    part_file = part_of(dst_file)
+                    with open(part_file, "wb") as fw:
+                        copyfileobj(cast(BinaryIO, tar.extractfile(member)), fw)
+                    replace(part_file, dst_file)
+                    yield member.name, member.size
+            if on_wire is not None:
+                on_wire(reader.count)
+
+
+def push_batch(files: list[tuple[Path, str, int]], callback: Callable[[int], None] | None = None, interval: float = 0) -> Iterator[tuple[str, int]]:
+    """Function that pushes a batch of local `files` as one tar stream into `tar -x` on device, the reverse of `pull_batch`. Device mtimes are carried by the tar headers, so pushed files match their manifest on the next scan.
+
+    Args:
+        files (list[tuple[Path, str, int]]): Local file, device path relative to `/` & mtime of each file
+        callback (Callable[[int], None] | None, optional): Progress callback that receives the bytes of the current file sent so far. Defaults to None.
+        interval (float, optional): Minimum seconds between two callbacks. Defaults to 0.
+
+    Raises:
+        OSError: If device tar fails to extract the stream
+
+    Yields:
+        Iterator[tuple[str, int]]: Device path and size of each file as soon as it's sent
+    """
+    with exec_out(PUSH_COMMAND) as stream:
+        writer = stream.conn.makefile("wb")
+        with tarfile.open(fileobj=writer, mode="w|") as tar:
+            for local_file, path, mtime in files:
+                info = tar.gettarinfo(local_file, arcname=path)
+                # device owns the files, only the mtime is restored
+                info.mtime = mtime
+                info.mode = 0o660
+                info.uid = info.gid = 0
+                info.uname = info.gname = ""
+                with open(local_file, "rb") as fr:
+                    tar.addfile(info, ProgressReader(fr, callback, interval) if callback is not None else fr)
+                yield path, info.size
+        writer.flush()
+        # end of stdin lets device tar finish, its output ends with the exit status
+        stream.conn.shutdown(socket.SHUT_WR)
+        output = cast(str, stream.read_until_close()).strip()
+    *errors, status = output.splitlines() or [""]
+    if status != "0":
+        raise OSError(f"device tar failed with status {status or None}: {" ".join(errors)}")
+
+
+def pull_stream(src_file: str, dst_file: Path, callback: Callable[[int], None], interval: float, offset: int = 0) -> int:
+    """Function that pulls a single file by streaming it through a byte counting sink. The `callback` is invoked with the bytes received so far at most once per `interval` seconds and once more at the end, so progress costs nothing between updates. With an `offset` the pull resumes: only bytes after `offset` are streamed (`tail -c`) and appended to `dst_file`.
+
+    Args:
+        src_file (str): Device file path
+        dst_file (Path): Local destination file path
+        callback (Callable[[int], None]): Progress callback that receives total bytes written
+        interval (float): Minimum seconds between two callbacks
+        offset (int, optional): Bytes already present in `dst_file`. Defaults to 0.
+
+    Returns:
+        int: Total bytes in `dst_file`
+    """
+    total = offset
+    last_update = monotonic()
+    with open(dst_file, "ab" if offset else "wb") as fw:
+        for chunk in iter_content(src_file) if not offset else iter_tail(src_file, offset):
+            fw.write(chunk)
+            total += len(chunk)
+            if (now := monotonic()) - last_update >= interval:
+                callback(total)
+                last_update = now
+    callback(total)
+    return total
+
+
+def pull_compressed(src_file: str, dst_file: Path) -> tuple[int, int]:
+    """Function that pulls a single file gzip compressed on device and decompresses it as a stream
+
+    Args:
+        src_file (str): Device file path relative to `/`
+        dst_file (Path): Local destination file path
+
+    Raises:
+        OSError: If the compressed stream is truncated
+
+    Returns:
+        tuple[int, int]: Decompressed bytes & bytes on the wire
+    """
+    decompressor = zlib.decompressobj(wbits=GZIP_WBITS)
+    raw = 0
+    wire = 0
+    with open(dst_file, "wb") as fw:
+        with exec_out(f"cd / && {COMPRESS_COMMAND} {quote(src_file)}") as stream:
+            reader = stream.conn.makefile("rb")
+            while chunk := reader.read(READ_SIZE):
+                wire += len(chunk)
+                raw += fw.write(decompressor.decompress(chunk))
+        raw += fw.write(decompressor.flush())
+    if not decompressor.eof:
+        raise OSError(f"{src_file}: compressed stream truncated after {wire} bytes")
+    return raw, wire
+
+
+def iter_tail(src_file: str, offset: int) -> Iterator[bytes]:
+    """Function that streams the content of a device file after the first `offset` bytes
+
+    Args:
+        src_file (str): Device file path relative to `/`
+        offset (int): Bytes to be skipped
+
+    Yields:
+        Iterator[bytes]: Chunks of the file
+    """
+    with exec_out(f"cd / && tail -c +{offset+1} {quote(src_file)}") as stream:
+        reader = stream.conn.makefile("rb")
+        while chunk := reader.read(READ_SIZE):
+            yield chunk
+
+
+def range_command(src_file: str, index: int, range_size: int, count: int = 1) -> str:
+    """Function that generates the device command which streams `count` consecutive ranges of a file, starting at the `index`th range, over stdout
+
+    Args:
+        src_file (str): Device file path relative to `/`
+        index (int): Range index
+        range_size (int): Range size, a multiple of RANGE_BLOCK
+        count (int, optional): Consecutive ranges streamed. Defaults to 1.
+
+    Returns:
+        str: Shell command to be used with `exec_out`
+    """
+    blocks = range_size // RANGE_BLOCK
+    return f"cd / && dd if={quote(src_file)} bs={RANGE_BLOCK} skip={index*blocks} count={blocks*count} 2>/dev/null"
+
+
+def range_md5s(src_file: str, size: int, range_size: int) -> list[str] | None:
+    """Function that calculates md5 of every range of a file on the device, with a single shell command
+
+    Args:
+        src_file (str): Device file path relative to `/`
+        size (int): File size
+        range_size (int): Range size, a multiple of RANGE_BLOCK
+
+    Returns:
+        list[str] | None: md5 hex digest of each range, None if the output doesn't hold exactly one digest per range (a failed `dd` or `md5sum`)
+    """
+    blocks = range_size // RANGE_BLOCK
+    command = f"cd / && for i in $(seq 0 {ceil(size/range_size)-1}); do dd if={quote(src_file)} bs={RANGE_BLOCK} skip=$((i*{blocks})) count={blocks} 2>/dev/null | md5sum; done"
+    digests = [line.split()[0] for line in shell(command).splitlines() if line.strip()]
+    if len(digests) != ceil(size / range_size) or not all(fullmatch(MD5_PATTERN, digest) for digest in digests):
+        return None
+    return digests
+
+
+def runs_of(indices: list[int], count: int) -> list[tuple[int, int]]:
+    """Function that groups sorted range indices into runs of consecutive ranges, so each run is pulled by a single stream
+
+    Args:
+        indices (list[int]): Sorted range indices
+        count (int): Max ranges in a run
+
+    Returns:
+        list[tuple[int, int]]: First index & number of ranges of each run
+    """
+    runs: list[tuple[int, int]] = []
+    for index in indices:
+        if runs and sum(runs[-1]) == index and runs[-1][1] < count:
+            runs[-1] = (runs[-1][0], runs[-1][1] + 1)
+        else:
+            runs.append((index, 1))
+    return runs
+
+
+def local_md5(dst_file: Path, offset: int, length: int) -> str:
+    """Function that calculates md5 of a range of a local file
+
+    Args:
+        dst_file (Path): Local file path
+        offset (int): Range offset
+        length (int): Range length
+
+    Returns:
+        str: md5 hex digest of the range
+    """
+    digest = md5()
+    with open(dst_file, "rb") as fr:
+        fr.seek(offset)
+        while length > 0 and (chunk := fr.read(min(READ_SIZE, length))):
+            digest.update(chunk)
+            length -= len(chunk)
+    return digest.hexdigest()
+
+
+def pull_range(src_file: str, dst_file: Path, index: int, range_size: int, size: int, progress: Callable[[int], None], count: int = 1) -> list[str]:
+    """Function that pulls `count` consecutive ranges of a file, starting at the `index`th range, with a single device side `dd` and writes them in place into the preallocated `dst_file`. Each run of ranges is written through its own file handle, so runs never share a file position.
+
+    Args:
+        src_file (str): Device file path relative to `/`
+        dst_file (Path): Local destination file path, preallocated to `size`
+        index (int): Range index
+        range_size (int): Range size, a multiple of RANGE_BLOCK
+        size (int): File size
+        progress (Callable[[int], None]): Callback that receives the bytes of each chunk written
+        count (int, optional): Consecutive ranges pulled. Defaults to 1.
+
+    Raises:
+        OSError: If the stream ends before all ranges are received
+
+    Returns:
+        list[str]: md5 hex digest of each received range
+    """
+    offset = index * range_size
+    length = min(range_size * count, size - offset)
+    digests = []
+    digest = md5()
+    # bytes of the current range hashed so far
+    filled = 0
+    received = 0
+    try:
+        with open(dst_file, "r+b") as fw:
+            fw.seek(offset)
+            with exec_out(range_command(src_file, index, range_size, count)) as stream:
+                reader = stream.conn.makefile("rb")
+                while chunk := reader.read(READ_SIZE):
+                    fw.write(chunk)
+                    received += len(chunk)
+                    progress(len(chunk))
+                    view = memoryview(chunk)
+                    while view:
+                        part = view[:range_size-filled]
+                        digest.update(part)
+                        filled += len(part)
+                        view = view[len(part):]
+                        if filled == range_size:
+                            digests.append(digest.hexdigest())
+                            digest, filled = md5(), 0
+        if received != length:
+            raise OSError(f"Ranges {index}-{index+count-1} of {src_file}: received {received} of {length} bytes")
+    except BaseException:
+        # discard the progress of a failed run
+        progress(-received)
+        raise
+    if filled:
+        # last range of the file is shorter
+        digests.append(digest.hexdigest())
+    return digests
+
+
+def pull_ranged(src_file: str, dst_file: Path, size: int, callback: Callable[[int], None], interval: float, streams: int, range_size: int, retries: int, check: bool = True, resume: bool = False, merge: int = 1) -> int:
+    """Function that pulls a very large file as byte ranges over `streams` parallel `exec-out` streams, written with positioned writes into a preallocated `dst_file`. Every range is checked by its length and, with `check`, by its md5 against the device. Only failed ranges are pulled again. With `resume` the same md5 comparison turns it into a block level delta transfer: `dst_file` can be an older copy of the file and only the ranges that differ are pulled, consecutive ones by a single stream. If the device fails to hash every range, the whole file is pulled & checked by length only.
+
+    Args:
+        src_file (str): Device file path relative to `/`
+        dst_file (Path): Local destination file path
+        size (int): File size
+        callback (Callable[[int], None]): Progress callback that receives total bytes written across all ranges
+        interval (float): Minimum seconds between two callbacks
+        streams (int): Ranges pulled at the same time
+        range_size (int): Range size, rounded up to a multiple of RANGE_BLOCK
+        retries (int): Times a failed range is pulled again
+        check (bool, optional): Verify each range by md5. Defaults to True.
+        resume (bool, optional): `dst_file` holds a previous attempt, ranges whose md5 already match are kept (requires `check`). Defaults to False.
+        merge (int, optional): Max consecutive ranges pulled by a single stream. Defaults to 1.
+
+    Raises:
+        OSError: If a range still fails after all retries
+
+    Returns:
+        int: Bytes pulled from the device, less than `size` if ranges were kept
+    """
+    range_size = max(1, ceil(range_size / RANGE_BLOCK)) * RANGE_BLOCK
+    ranges = list(range(ceil(size / range_size)))
+    lengths = {index: min(range_size, size - index * range_size) for index in ranges}
+    lock = Lock()
+    total = 0
+    pulled = 0
+    last_update = monotonic()
+
+    def progress(advance: int) -> None:
+        """Helper function that sums up the progress of all ranges and invokes the callback at most once per `interval`
+
+        Args:
+            advance (int): bytes written (negative when a failed range is discarded)
+        """
+        nonlocal total, last_update
+        with lock:
+            total += advance
+            if (now := monotonic()) - last_update >= interval:
+                callback(total)
+                last_update = now
+
+    def attempt(run: tuple[int, int]) -> list[str] | None:
+        """Helper function that pulls a run of consecutive ranges, failures are returned as None so they can be retried
+
+        Args:
+            run (tuple[int, int]): First range index & number of ranges
+
+        Returns:
+            list[str] | None: md5 hex digest of each range or None if failed
+        """
+        try:
+            return pull_range(src_file, dst_file, run[0], range_size, size, progress, run[1])
+        except Exception:
+            return None
+
+    # preallocate, an existing partial file keeps its content
+    with open(dst_file, "ab") as fw:
+        fw.truncate(size)
+    with ThreadPoolExecutor(max_workers=streams + 1) as pool:
+        # device hashes are calculated while ranges are being pulled
+        expected = pool.submit(range_md5s, src_file, size, range_size) if check else None
+        pending = ranges
+        if resume and expected is not None and (hashes := expected.result()) is not None:
+            pending = [index for index in ranges if local_md5(dst_file, index * range_size, lengths[index]) != hashes[index]]
+            progress(sum(lengths[index] for index in ranges if index not in pending))
+        for _ in range(retries + 1):
+            runs = runs_of(pending, merge)
+            digests: dict[int, str | None] = {}
+            for (start, count), received in zip(runs, pool.map(attempt, runs)):
+                digests.update({start + offset: received[offset] if received is not None else None for offset in range(count)})
+            pulled += sum(lengths[index] for index, digest in digests.items() if digest is not None)
+            hashes = expected.result() if expected is not None else None
+            failed = [index for index, digest in digests.items() if digest is None or (hashes is not None and digest != hashes[index])]
+            # discard progress of ranges that failed the md5 check only, stream failures are discarded by pull_range itself
+            progress(-sum(lengths[index] for index in failed if digests[index] is not None))
+            if not (pending := failed):
+                break
+    if pending:
+        raise OSError(f"{src_file}: ranges {pending} failed after {retries} retries")
+    callback(size)
+    return pulled
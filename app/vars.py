@@ -2,9 +2,9 @@ from base64 import b64decode
 from datetime import datetime
 from os import environ
 from pathlib import Path, PurePosixPath
+from typing import Any, Callable
 
-from utils import load_set
-from utils.android import DEVICE_MODEL
+from utils import load_set, log
 
 
 DATA_DIR          = Path("data")
@@ -13,19 +13,108 @@ BACKUP_ROOT       = Path("D:/Backup")
 
 ANDROID_DIR       = DEVICE_ROOT/"Android"
 ANDROID_MEDIA_DIR = ANDROID_DIR/"media"
-BACKUP_DIR        = BACKUP_ROOT/DEVICE_MODEL
-CLEANED_METADATA  = DATA_DIR/"cleaned_metadata.bin"
-DATAFRAME         = DATA_DIR/"dataframe.csv"
+ARCHIVE           = True
+ARCHIVE_DIR       = BACKUP_ROOT
+ARCHIVE_WORKERS   = 4
+BATCH_SIZE        = 256
+BLOCK_DIFF_SIZE   = 16_000_000
+BLOCK_SIZE        = 1_048_576
+COMPRESSION       = True
+COMPRESS_RATIO    = 1.2
+COMPRESS_SAMPLE   = 65_536
+COMPRESS_WINDOW   = 16_000_000
 DATAFRAME_COLUMNS = ["File", "Type", "Size", "Date", "Path"]
-DELTA_COLUMNS     = ["File", "Type", "Size", "Size_old", "Date", "Date_old", "Path", "Kind"]
-DELTA_DATAFRAME   = DATA_DIR/"deltaframe.csv"
-DELTA_DIR         = BACKUP_ROOT/"Delta"/DEVICE_MODEL
-DEVICE_DATAFRAME  = BACKUP_DIR/DATAFRAME.name
+DEDUP             = False
+DELTA_COLUMNS     = ["File", "Type", "Size", "Size_old", "Date", "Date_old", "Path", "Path_old", "Kind"]
+FSYNC_FILES       = 256
+HOST_WRITERS      = 8
 IGNORE_DIRS       = load_set("./data/dirs.ignore")
 IGNORE_TYPES      = load_set("./data/types.ignore")
-RAR_EXECUTABLE    = Path("C:/Program Files/WinRAR/WinRAR.exe")
-RAW_METADATA      = Path("raw_metadata.bin")
-RECYCLE_BIN       = BACKUP_DIR/"Recycle Bin"
+LARGE_FILE_SIZE   = 100_000_000
+LARGE_FILE_TIME   = 10
+MERGE_SIZE        = 1_000_000_000
+MERGE_WORKERS     = 8
+MOVE_HASH_CHECK   = False
+PROGRESS_INTERVAL = 0.1
+PULL_WORKERS      = 4
+PULL_WORKERS_MAX  = 8
+PUSH_WORKERS      = 4
+RANGED_FILE_SIZE  = 1_000_000_000
+RANGE_HASH_CHECK  = True
+RANGE_RETRIES     = 3
+RANGE_SIZE        = 67_108_864
+RANGE_STREAMS     = 4
 REQUIRED_PACKAGES = load_set("./data/required_packages.txt")
-MYPASS            = b64decode(str(environ.get("MYPASS")).encode("utf-8")).decode("utf-8")
+RETENTION_DAYS    = 90
+SMALL_FILE_SIZE   = 1_000_000
+TUNE_INTERVAL     = 5.0
+TUNE_MARGIN       = 0.05
+TUNE_WINDOW       = 1_000_000_000
+VOLUME_SIZE       = 1_073_741_824
 TIMESTAMP         = datetime.now().strftime("%Y%m%d%H%M%S")
+
+
+# Constants of the device, resolved on first use from the connected or the last recorded device, so importing this module never needs a device
+DEVICE_VARS: dict[str, Callable[[], Any]] = {
+    "BACKUP_NAME":       lambda: environ.get("BACKUP_NAME") or device()["model"],
+    "STATE_DIR":         lambda: DATA_DIR/"devices"/var("BACKUP_NAME") if "BACKUP_NAME" in environ else DATA_DIR,
+    "BACKUP_DIR":        lambda: BACKUP_ROOT/var("BACKUP_NAME"),
+    "CATALOG":           lambda: var("BACKUP_DIR")/"catalog.db",
+    "COMPRESS_STATS":    lambda: var("STATE_DIR")/"compression.json",
+    "DATAFRAME":         lambda: var("STATE_DIR")/"dataframe.parquet",
+    "DELTA_DATAFRAME":   lambda: var("STATE_DIR")/"deltaframe.parquet",
+    "DELTA_DIR":         lambda: BACKUP_ROOT/"Delta"/var("BACKUP_NAME"),
+    "DELTA_TOTALS":      lambda: var("STATE_DIR")/"deltatotals.json",
+    "DEVICE_DATAFRAME":  lambda: var("BACKUP_DIR")/var("DATAFRAME").name,
+    "JOURNAL":           lambda: var("STATE_DIR")/"journal.jsonl",
+    "OBJECT_STORE":      lambda: var("BACKUP_DIR")/"Objects",
+    "SCAN_CACHE_DIR":    lambda: DATA_DIR/"cache"/device()["serial"],
+    "TUNING":            lambda: var("STATE_DIR")/"tuning.json",
+    "VERSIONS_DIR":      lambda: var("BACKUP_DIR")/"Versions",
+}
+
+
+def device() -> dict[str, str]:
+    """Function that returns the model & serial of the connected device, or of the last recorded one. Offline commands never connect, they fail if no device was ever backed up.
+
+    Returns:
+        dict[str, str]: Model & serial
+    """
+    from utils import android
+    record = android.current()
+    if record is None:
+        log.error("No device recorded, run backup first")
+    return record
+
+
+def var(name: str) -> Any:
+    """Function that resolves a constant of DEVICE_VARS once, later lookups find it in module globals
+
+    Args:
+        name (str): Constant name
+
+    Returns:
+        Any: Constant value
+    """
+    if name not in globals():
+        globals()[name] = DEVICE_VARS[name]()
+    return globals()[name]
+
+
+def __getattr__(name: str) -> Any:
+    """Module attributes resolved on first use. Constants of DEVICE_VARS are resolved for the device, `MYPASS` is decoded only when an archive is written, so commands that never archive run without it.
+
+    Args:
+        name (str): Attribute name
+
+    Raises:
+        AttributeError: If the attribute doesn't exist
+
+    Returns:
+        Any: Attribute value
+    """
+    if name in DEVICE_VARS:
+        return var(name)
+    if name == "MYPASS":
+        return b64decode(str(environ.get("MYPASS")).encode("utf-8")).decode("utf-8")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
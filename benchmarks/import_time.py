@@ -0,0 +1,69 @@
+"""Import time benchmark of the offline commands. Each command is run in a scratch working dir without any device recorded, as on a fresh checkout, and fails if it's slower than its budget or loads the device stack, i.e. tries to connect.
+
+Usage: python benchmarks/import_time.py
+"""
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from shutil import copytree
+from time import perf_counter
+
+
+ROOT = Path(__file__).resolve().parent.parent
+# Offline commands and their budget in seconds
+COMMANDS = {
+    "--help": 0.5,
+    "snapshots": 0.5,
+    "materialize 20000101000000 restored": 0.5,
+}
+# Modules that must never be imported by an offline command
+DEVICE_MODULES = ["adbutils", "uiautomator2"]
+# Runs of each command, the fastest one is reported
+RUNS = 3
+
+
+def measure(command: str, cwd: Path) -> tuple[float, set[str]]:
+    """Function that runs a command of main.py with `-X importtime`
+
+    Args:
+        command (str): Command & its arguments
+        cwd (Path): Working dir
+
+    Returns:
+        tuple[float, set[str]]: Fastest wall time in seconds & top level packages imported
+    """
+    best = float("inf")
+    packages: set[str] = set()
+    for _ in range(RUNS):
+        start = perf_counter()
+        result = subprocess.run([sys.executable, "-X", "importtime", str(ROOT/"main.py"), *command.split()], cwd=cwd, capture_output=True, text=True, env=dict(os.environ, PYTHONPATH=str(ROOT)))
+        best = min(best, perf_counter() - start)
+        if result.returncode != 0:
+            raise RuntimeError(f"{command}: {result.stderr.strip().splitlines()[-1]}")
+        packages = {line.split("|")[-1].strip().split(".")[0] for line in result.stderr.splitlines() if line.startswith("import time:")}
+    return best, packages
+
+
+def main() -> int:
+    """Runs every offline command & reports its time against the budget
+
+    Returns:
+        int: Exit code, 1 if any command is over budget or loads the device stack
+    """
+    failures = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        cwd = Path(tmp)
+        copytree(ROOT/"data", cwd/"data", dirs_exist_ok=True)
+        for command, budget in COMMANDS.items():
+            elapsed, packages = measure(command, cwd)
+            loaded = [module for module in DEVICE_MODULES if module in packages]
+            ok = elapsed <= budget and not loaded
+            failures += not ok
+            print(f"{"ok  " if ok else "FAIL"} {command:40} {elapsed:6.3f}s / {budget:.1f}s{f"  loads {", ".join(loaded)}" if loaded else ""}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
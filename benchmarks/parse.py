@@ -0,0 +1,92 @@
+"""Benchmark of metadata parsing: per-directory `to_frame` + `concat` (previous path) vs chunked columnar `metadata.to_frame`.
+
+Usage:
+    python -m benchmarks.parse [files]
+"""
+from datetime import datetime
+from pathlib import PurePosixPath
+from sys import argv
+from time import perf_counter
+
+from pandas import DataFrame, concat
+
+from app import metadata, scanner
+from app.vars import DATAFRAME_COLUMNS, IGNORE_TYPES
+
+
+FILES_PER_DIR = 100
+
+
+def listing(files: int) -> list[str]:
+    """Function that generates a synthetic `ls -llR` listing of `files` files
+
+    Args:
+        files (int): Total files in the listing
+
+    Returns:
+        list[str]: Lines of the listing
+    """
+    lines = []
+    for dir_index in range(files // FILES_PER_DIR):
+        lines += [f"sdcard/DCIM/Album {dir_index}:", f"total {FILES_PER_DIR}"]
+        for index in range(FILES_PER_DIR):
+            lines.append(f"-rw-rw---- 1 u0_a1 media_rw {index*1000} 2024-01-05 10:{index%60:02}:45.123456789 +0530 IMG {index}.jpg")
+        lines.append("")
+    return lines
+
+
+def previous_path(lines: list[str]) -> DataFrame:
+    """Function that parses the listing with the per directory dataframes used before columnar parsing
+
+    Args:
+        lines (list[str]): Lines of the listing
+
+    Returns:
+        DataFrame: Parsed dataframe
+    """
+    def to_frame(dir_data: str) -> DataFrame:
+        lines = dir_data.splitlines()
+        dir_name = lines[0].replace(":", "/")
+        records = []
+        for line in lines[2:]:
+            parts = line.split()
+            records.append({
+                "File": " ".join(parts[8:]),
+                "Type": PurePosixPath(parts[-1]).suffix,
+                "Size": int(parts[4]),
+                "Date": datetime.fromisoformat(" ".join(parts[5:7])),
+                "Path": PurePosixPath(f"{dir_name}/{line[line.index(parts[8]):]}")
+            })
+        return DataFrame(records, columns=DATAFRAME_COLUMNS)
+
+    data = "\n".join(lines).split("\n\n")
+    dataframe = concat(map(to_frame, filter(None, data)), ignore_index=True)
+    ignore_mask = dataframe["Type"].apply(lambda x: str(x).removeprefix(".").upper() in IGNORE_TYPES)
+    return dataframe[~ignore_mask]
+
+
+def columnar_path(lines: list[str]) -> DataFrame:
+    """Function that parses the listing with `scanner.parse_ls` & chunked `metadata.to_frame`
+
+    Args:
+        lines (list[str]): Lines of the listing
+
+    Returns:
+        DataFrame: Parsed dataframe
+    """
+    return concat(metadata.parse(scanner.parse_ls(iter(lines))), ignore_index=True)
+
+
+def main() -> None:
+    """Run both parse paths on a synthetic listing and print the timings
+    """
+    files = int(argv[1]) if len(argv) > 1 else 1_000_000
+    lines = listing(files)
+    for name, function in (("previous", previous_path), ("columnar", columnar_path)):
+        start = perf_counter()
+        dataframe = function(lines)
+        print(f"{name:<10}: {perf_counter()-start:8.2f}s for {len(dataframe)} files")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,136 @@
-from app import backup, delta, metadata
+from argparse import ArgumentParser, Namespace
+from pathlib import Path
+
+from utils.terminal import clear_screen
+
+
+# Modules of app are imported by each command on first use, so offline commands never load the device stack or unused heavy libraries
+
+
+def backup(args: Namespace) -> None:
+    """Command that scans, calculates delta, pulls & merges the connected device, or every connected device with `--all-devices`
+    """
+    if args.headless:
+        # stdout carries only the JSON lines of progress
+        from utils import log
+        log.headless()
+    else:
+        clear_screen()
+    if args.all_devices:
+        # Back up every connected device at the same time
+        from app import devices
+        devices.backup_all(full_scan=args.full_scan, verify=args.verify, headless=args.headless)
+        return
+    # Connect before app modules are imported, so the paths of the backup always belong to the connected device
+    from utils import android
+    android.connect()
+    from app import devices
+    devices.run(full_scan=args.full_scan, verify=args.verify, headless=args.headless)
+
+
+def restore(args: Namespace) -> None:
+    """Command that pushes only the files that are missing or different on device
+    """
+    clear_screen()
+    from utils import android
+    android.connect()
+    from app import restore
+    restore.restore(args.timestamp)
+
+
+def snapshots(args: Namespace) -> None:
+    """Command that lists the recorded snapshots of the device
+    """
+    from app import snapshot
+    snapshot.listing()
+
+
+def materialize(args: Namespace) -> None:
+    """Command that rebuilds a snapshot from the catalog, without a device
+    """
+    from app import snapshot
+    snapshot.materialize(args.timestamp, Path(args.dst), link=args.link)
+
+
+def dedup(args: Namespace) -> None:
+    """Command that links every file of backup dir to the content addressed object store
+    """
+    from app import store
+    store.dedup()
+
+
+def delta(args: Namespace) -> None:
+    """Command that recalculates the delta of the last scan
+    """
+    from app import delta
+    delta.calculate()
+
+
+def archive(args: Namespace) -> None:
+    """Command that completes the archive of the last session
+    """
+    from app import delta
+    delta.archive()
+
+
+def merge(args: Namespace) -> None:
+    """Command that merges the delta dir into the device backup
+    """
+    from app import delta
+    delta.merge()
+
+
+def manifest(args: Namespace) -> None:
+    """Command that prints the summary & first rows of a manifest
+    """
+    from app import manifest
+    from utils import log
+    dataframe = manifest.load(Path(args.file))
+    log.info(f"Manifest {args.file} > {len(dataframe)} rows [{", ".join(dataframe.columns)}]")
+    if "Kind" in dataframe.columns:
+        log.info(f"Kinds                      > {dataframe["Kind"].value_counts().to_dict()}")
+    if "Size" in dataframe.columns:
+        log.info(f"Total size                 > {int(dataframe["Size"].sum())} bytes")
+    print(dataframe.head(args.rows).to_string())
 
 
 def main() -> None:
     """Run Android device backup using USB Debugging.
     """
-    # Fetch raw metadata from device & create a datatframe
-    metadata.fetch()
-    # Calculate delta dataframe for minimal operations
-    delta.calculate()
-    # Backup session context to handle live render enter and exit
-    with backup.session() as bkp:
-        # Run the backup
-        bkp.run(mock=False)
-    # Check if delta size exceed 1.0 GB
-    if delta.size() >= 1_000_000_000:
-        # if yes, create archive for online backup and merge delta with main backup dir
-        delta.archive()
-        delta.merge()
-    else:
-        # else simply clean up the data dir of the repository
-        delta.cleanup(delete_df=True)
+    parser = ArgumentParser(description="Android device backup using USB Debugging")
+    parser.set_defaults(command=backup, full_scan=False, verify=False, all_devices=False, headless=False)
+    commands = parser.add_subparsers(title="commands", description="without a command the connected device is backed up")
+    command = commands.add_parser("backup", help="back up the connected device")
+    command.add_argument("--full-scan", action="store_true", help="ignore the scan cache and list every directory of the device")
+    command.add_argument("--verify", action="store_true", help="cross check the delta totals against the files on disk")
+    command.add_argument("--all-devices", action="store_true", help="back up every connected device at the same time")
+    command.add_argument("--headless", action="store_true", help="print JSON lines of progress instead of the live render, for cron & CI runs")
+    command.set_defaults(command=backup)
+    command = commands.add_parser("restore", help="push the backup (or the snapshot at TIMESTAMP) back to the device")
+    command.add_argument("timestamp", nargs="?", metavar="TIMESTAMP", help="snapshot timestamp, the device manifest if omitted")
+    command.set_defaults(command=restore)
+    command = commands.add_parser("snapshots", help="list the recorded snapshots of the device [offline]")
+    command.set_defaults(command=snapshots)
+    command = commands.add_parser("materialize", help="rebuild the device tree as it was at TIMESTAMP into DST [offline]")
+    command.add_argument("timestamp", metavar="TIMESTAMP")
+    command.add_argument("dst", metavar="DST")
+    command.add_argument("--link", action="store_true", help="hardlink materialized files instead of copying them")
+    command.set_defaults(command=materialize)
+    command = commands.add_parser("dedup", help="convert the whole backup dir into the deduplicated layout [offline]")
+    command.set_defaults(command=dedup)
+    command = commands.add_parser("delta", help="recalculate the delta of the last scan [offline]")
+    command.set_defaults(command=delta)
+    command = commands.add_parser("archive", help="complete the archive of the last session [offline]")
+    command.set_defaults(command=archive)
+    command = commands.add_parser("merge", help="merge the delta dir into the device backup [offline]")
+    command.set_defaults(command=merge)
+    command = commands.add_parser("manifest", help="print the summary & first rows of a manifest [offline]")
+    command.add_argument("file", metavar="FILE")
+    command.add_argument("--rows", type=int, default=10, help="rows to be printed")
+    command.set_defaults(command=manifest)
+    args = parser.parse_args()
+    args.command(args)
 
 
 if __name__ == "__main__":
     main()
-    
\ No newline at end of file
@@ -0,0 +1,55 @@
+import json
+from pathlib import Path
+from shutil import copytree
+from typing import Any, Iterator
+
+import pytest
+
+
+ROOT = Path(__file__).resolve().parent.parent
+# Device every test runs against, paths of the backup are resolved from its record
+MODEL = "Test"
+SERIAL = "test"
+
+
+@pytest.fixture
+def workdir(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    """Scratch working dir with the data dir of the repo & a recorded device, paths of the backup are relative so they all land in it
+
+    Returns:
+        Path: Working dir
+    """
+    copytree(ROOT/"data", tmp_path/"data", ignore=lambda src, names: [name for name in names if name == "device.json"])
+    (tmp_path/"data"/"device.json").write_text(json.dumps({"model": MODEL, "serial": SERIAL}))
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.delenv("BACKUP_NAME", raising=False)
+    monkeypatch.delenv("ANDROID_SERIAL", raising=False)
+    return tmp_path
+
+
+@pytest.fixture
+def session(workdir: Path) -> Iterator[Any]:
+    """Backup session that's never rendered live & has no device, compression & archive, for the steps that don't transfer files
+
+    Yields:
+        Iterator[Any]: Backup session
+    """
+    from app import backup
+    from app.catalog import Catalog
+    from app.compression import Policy
+    from app.journal import Journal
+    from app.render import Render
+    from app.scheduler import Tuning
+    from app.transfer import FsyncBatch
+    bkp = backup.session.__new__(backup.session)
+    Render.__init__(bkp, live=False)
+    bkp.main_progress_task = bkp.main_progress_bar.add_task("main", total=0)
+    bkp.catalog = Catalog()
+    bkp.journal = Journal()
+    bkp.durable = FsyncBatch(bkp.journal.complete, 1)
+    bkp.compression = Policy(enabled=False)
+    bkp.tuning = Tuning()
+    bkp.archiver = None
+    bkp.bytes_saved = 0
+    bkp.kinds = {kind: [0, 0] for kind in ("add", "modify", "remove", "move")}
+    yield bkp
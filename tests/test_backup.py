@@ -0,0 +1,80 @@
+from typing import Any
+
+import pytest
+
+
+# Modules of app resolve the paths of the device on import, so they are imported within the working dir of each test
+
+
+def test_failed_session_records_no_snapshot(session: Any) -> None:
+    from app.catalog import Catalog
+
+    # render logs the error & exits
+    with pytest.raises(SystemExit):
+        with session:
+            raise RuntimeError("pull failed")
+
+    with Catalog() as catalog:
+        assert catalog.snapshots() == []
+
+
+def test_completed_session_records_snapshot(session: Any) -> None:
+    from app.catalog import Catalog
+
+    with session:
+        pass
+
+    with Catalog() as catalog:
+        assert len(catalog.snapshots()) == 1
+
+
+def test_failing_close_still_stops_render(session: Any) -> None:
+    from app.vars import TUNING
+
+    stopped = []
+    session.live_enabled = True
+    session.live.stop = lambda: stopped.append(True)
+
+    def fail() -> None:
+        raise OSError("disk full")
+
+    session.compression.save = fail
+    with pytest.raises(OSError):
+        session.__exit__(None, None, None)
+
+    assert stopped == [True]
+    # steps after the failing one still ran
+    assert TUNING.exists()
+
+
+def test_small_delta_is_not_archived(session: Any) -> None:
+    import pandas as pd
+
+    from app.vars import DELTA_COLUMNS
+
+    session.deltaframe = pd.DataFrame([("a.jpg", ".jpg", 5, 0, 1, 0, "sdcard/DCIM/a.jpg", "", "add")], columns=DELTA_COLUMNS)
+
+    assert session.start_archive() is None
+
+
+def test_large_delta_archives_earlier_sessions(session: Any, monkeypatch: pytest.MonkeyPatch) -> None:
+    import pandas as pd
+
+    from app import manifest
+    from app.catalog import DELTA
+    from app.vars import DELTA_COLUMNS, DELTA_DIR, MERGE_SIZE
+
+    monkeypatch.setenv("MYPASS", "c2VjcmV0")
+    saved = []
+    monkeypatch.setattr(manifest, "save", lambda dataframe, file: saved.append(list(dataframe["Member"])))
+    # pulled by an earlier session that stayed below the merge size
+    earlier = DELTA_DIR/"DCIM"/"a.jpg"
+    earlier.parent.mkdir(parents=True)
+    earlier.write_bytes(b"photo")
+    session.catalog.record("sdcard/DCIM/a.jpg", "a.jpg", ".jpg", MERGE_SIZE - 5, 1, DELTA, "pull")
+    session.deltaframe = pd.DataFrame([("b.jpg", ".jpg", 5, 0, 1, 0, "sdcard/DCIM/b.jpg", "", "add")], columns=DELTA_COLUMNS)
+
+    archiver = session.start_archive()
+    assert archiver is not None
+    archiver.close()
+    assert saved == [["DCIM/a.jpg"]]
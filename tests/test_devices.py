@@ -0,0 +1,38 @@
+import json
+from pathlib import Path
+from types import SimpleNamespace
+
+
+def pipeline(*args: object, **kwargs: object) -> None:
+    # importing the pipeline resolves the paths of the device, nothing is pulled
+    from importlib import import_module
+    [import_module(f"app.{module}") for module in ("backup", "delta", "metadata")]
+
+
+def spawned(name: str, serial: str, queue: object, gate: object) -> None:
+    from app import devices
+    from utils import android
+    device = SimpleNamespace(serial=serial, prop=SimpleNamespace(model=name))
+    android.connect_device = lambda: device
+    devices.run = pipeline
+    devices.worker(name, serial, queue, gate, False, False)
+
+
+def test_worker_of_new_device(workdir: Path) -> None:
+    from multiprocessing import get_context
+
+    from app.devices import DONE
+    (workdir/"data"/"device.json").unlink()
+    context = get_context("spawn")
+    queue, gate = context.Queue(), context.BoundedSemaphore(1)
+    process = context.Process(target=spawned, args=("Pixel", "abc", queue, gate))
+    process.start()
+    process.join(timeout=60)
+    stages = []
+    while not queue.empty():
+        stages.append(queue.get()[1])
+    assert process.exitcode == 0, (workdir/"data"/"devices"/"Pixel"/"backup.log").read_text()
+    assert stages == [DONE]
+    assert json.loads((workdir/"data"/"devices"/"Pixel"/"device.json").read_text()) == {"model": "Pixel", "serial": "abc"}
+    assert not (workdir/"data"/"device.json").exists()
+
@@ -0,0 +1,36 @@
+import json
+from time import sleep
+from typing import Any
+
+import pytest
+
+
+def test_headless_stdout_is_json_lines(session: Any, capsys: pytest.CaptureFixture[str], monkeypatch: pytest.MonkeyPatch) -> None:
+    from app import render
+    from utils import log
+
+    monkeypatch.setattr(log, "stream", None)
+    monkeypatch.setattr(render, "EVENT_INTERVAL", 0.05)
+    log.headless()
+    session.live_enabled = False
+    session.headless = True
+
+    log.stage("Backup")
+    log.info("Connecting to a device")
+    log.update("Device connected")
+    with session:
+        session.insert_into_files_panel("sdcard/DCIM/a.jpg", "add")
+        session.advance_files_panel_title()
+        sleep(0.2)
+    log.info("Backup complete!")
+
+    out, err = capsys.readouterr()
+    events = [json.loads(line) for line in out.splitlines()]
+    assert [event["event"] for event in events][0] == "start"
+    assert "progress" in [event["event"] for event in events]
+    assert events[-1]["event"] == "done"
+    assert events[-1]["files"] == 1
+    # logs, their colors & cursor codes stay out of stdout
+    assert "Device connected" in err
+    assert "Transfer tuning" in err
+    assert "\033[F" not in out + err
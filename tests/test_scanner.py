@@ -0,0 +1,24 @@
+from contextlib import contextmanager
+from io import BytesIO
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Iterator
+
+import pytest
+
+
+def test_stat_listing_keeps_names_with_newlines(workdir: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    from app import scanner
+
+    output = b"2 1700000000 sdcard/DCIM/c d.jpg\n\x001 1700000000 sdcard/DCIM/a\nb.jpg\n\x00"
+
+    @contextmanager
+    def exec_out(command: str) -> Iterator[Any]:
+        yield SimpleNamespace(conn=SimpleNamespace(makefile=lambda mode: BytesIO(output)))
+
+    monkeypatch.setattr(scanner, "exec_out", exec_out)
+
+    assert list(scanner.listing(scanner.COMMANDS[scanner.STAT], scanner.STAT)) == [
+        ("sdcard/DCIM/", "c d.jpg", 2, 1700000000),
+        ("sdcard/DCIM/", "a\nb.jpg", 1, 1700000000),
+    ]
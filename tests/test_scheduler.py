@@ -0,0 +1,57 @@
+import json
+from collections import namedtuple
+from threading import Thread
+from typing import Any
+
+import pytest
+
+
+# Modules of app resolve the paths of the device on import, so they are imported within the working dir of each test
+Row = namedtuple("Row", ["Path", "Size"])
+
+
+def test_large_worker_never_takes_the_only_small_slot(workdir: Any) -> None:
+    from app.scheduler import Scheduler, Tuning
+
+    tuning = Tuning(file=None)
+    tuning.workers = 1
+    rows = [Row("sdcard/DCIM/video.mp4", tuning.large_size * 4), Row("sdcard/DCIM/a.jpg", 10), Row("sdcard/DCIM/b.jpg", 10)]
+    scheduler = Scheduler(rows, tuning, 2, adaptive=True)
+    assert scheduler.limit == 1
+    large, small = scheduler.lanes_for(2)
+
+    # the large worker holds the video while the small worker still gets its batch
+    video = scheduler.next(large)
+    jobs: list[Any] = []
+    worker = Thread(target=lambda: jobs.append(scheduler.next(small)), daemon=True)
+    worker.start()
+    worker.join(2)
+    assert not worker.is_alive()
+    batch = jobs[0]
+    assert video == rows[0]
+    assert batch == rows[1:]
+    scheduler.done(batch, 0.1, small)
+    scheduler.done(video, 1.0, large)
+    assert scheduler.active == 0
+    assert scheduler.next(small) is None
+
+
+def test_interrupted_save_keeps_previous_tuning(workdir: Any, monkeypatch: pytest.MonkeyPatch) -> None:
+    from app import scheduler
+    from app.scheduler import Tuning
+
+    tuning = Tuning(workdir/"tuning.json", "Test")
+    tuning.small_size = 123
+    tuning.save()
+
+    def dump(learned: Any, fw: Any, **kwargs: Any) -> None:
+        fw.write("{")
+        raise OSError("disk full")
+
+    tuning.small_size = 456
+    with monkeypatch.context() as patched, pytest.raises(OSError):
+        patched.setattr(scheduler.json, "dump", dump)
+        tuning.save()
+
+    assert Tuning(workdir/"tuning.json", "Test").small_size == 123
+    assert "batch_size" not in json.loads((workdir/"tuning.json").read_text())["Test"]
@@ -0,0 +1,34 @@
+from pathlib import PurePosixPath
+from typing import Any
+
+import pandas as pd
+
+
+# Modules of app resolve the paths of the device on import, so they are imported within the working dir of each test
+
+
+def test_move_then_merge_keeps_moved_file(session: Any) -> None:
+    from app import delta, manifest
+    from app.catalog import BACKUP
+    from app.delta import DeltaNamedTuple
+    from app.vars import BACKUP_DIR, DELTA_COLUMNS, DELTA_DATAFRAME, DEVICE_ROOT, VERSIONS_DIR
+
+    old, new = "sdcard/DCIM/a.jpg", "sdcard/Pictures/a.jpg"
+    old_file = BACKUP_DIR/PurePosixPath(old).relative_to(DEVICE_ROOT)
+    new_file = BACKUP_DIR/PurePosixPath(new).relative_to(DEVICE_ROOT)
+    old_file.parent.mkdir(parents=True)
+    old_file.write_bytes(b"photo")
+    session.catalog.record(old, "a.jpg", "jpg", 5, 1, BACKUP, "pull")
+    session.catalog.snapshot()
+
+    # handle the move like a backup session does, without any device transfer
+    row = DeltaNamedTuple(0, "a.jpg", "jpg", 5, 5, 1, 1, new, old, "move")
+    with session:
+        session.move_file(row)
+    manifest.save(pd.DataFrame([row[1:]], columns=DELTA_COLUMNS), DELTA_DATAFRAME)
+
+    delta.merge()
+
+    assert new_file.read_bytes() == b"photo"
+    assert not old_file.exists()
+    assert not any(path.is_file() for path in VERSIONS_DIR.rglob("*"))
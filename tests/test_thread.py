@@ -0,0 +1,26 @@
+from threading import Event
+
+import pytest
+
+from utils.thread import ExceptionalThread, join_all
+
+
+def test_join_all_waits_for_every_thread_before_raising() -> None:
+    release = Event()
+    finished = []
+
+    def fail() -> None:
+        raise OSError("pull failed")
+
+    def work() -> None:
+        release.wait(5)
+        finished.append(True)
+
+    threads = [ExceptionalThread(target=fail), ExceptionalThread(target=work), ExceptionalThread(target=fail)]
+    [thread.start() for thread in threads]
+    release.set()
+    with pytest.raises(OSError, match="pull failed"):
+        join_all(threads)
+
+    assert finished == [True]
+    assert not any(thread.is_alive() for thread in threads)
@@ -0,0 +1,74 @@
+import re
+from contextlib import contextmanager
+from hashlib import md5
+from io import BytesIO
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Iterator
+
+import pytest
+
+
+BLOCK = 1 << 20
+
+
+@pytest.fixture
+def device(monkeypatch: pytest.MonkeyPatch) -> SimpleNamespace:
+    """Device side of `dd` & `md5sum` over the bytes of a single file, every `dd` stream opened is recorded
+
+    Returns:
+        SimpleNamespace: File content, md5 output & streams opened
+    """
+    from app import transfer
+
+    device = SimpleNamespace(content=b"", md5s=None, streams=[])
+
+    @contextmanager
+    def exec_out(command: str) -> Iterator[Any]:
+        skip, count = (int(value) for value in re.search(r"skip=(\d+) count=(\d+)", command).groups())
+        device.streams.append((skip, count))
+        data = device.content[skip*BLOCK:(skip+count)*BLOCK]
+        yield SimpleNamespace(conn=SimpleNamespace(makefile=lambda mode: BytesIO(data)))
+
+    def shell(command: str) -> str:
+        if device.md5s is not None:
+            return device.md5s
+        blocks = range(0, len(device.content), BLOCK)
+        return "".join(f"{md5(device.content[offset:offset+BLOCK]).hexdigest()}  -\n" for offset in blocks)
+
+    monkeypatch.setattr(transfer, "exec_out", exec_out)
+    monkeypatch.setattr(transfer, "shell", shell)
+    return device
+
+
+def patch(device: SimpleNamespace, base: bytes, file: Path) -> int:
+    from app.transfer import pull_ranged
+
+    file.write_bytes(base)
+    return pull_ranged("sdcard/a.mp4", file, len(device.content), lambda total: None, 0, 4, BLOCK, 1, True, True, 64)
+
+
+def test_patch_pulls_consecutive_blocks_at_once(device: SimpleNamespace, tmp_path: Path) -> None:
+    base = bytes(range(256)) * (8 * BLOCK // 256) + b"tail"
+    content = bytearray(base)
+    for block in (2, 3, 6):
+        content[block*BLOCK] ^= 0xFF
+    device.content = bytes(content)
+
+    pulled = patch(device, base, tmp_path/"a.mp4")
+
+    assert (tmp_path/"a.mp4").read_bytes() == device.content
+    assert pulled == 3 * BLOCK
+    assert sorted(device.streams) == [(2, 2), (6, 1)]
+
+
+def test_patch_pulls_whole_file_if_device_hashes_fail(device: SimpleNamespace, tmp_path: Path) -> None:
+    base = bytes(3 * BLOCK)
+    device.content = b"\x01" + base[1:]
+    # a block whose `dd` failed is missing from the output
+    device.md5s = f"{md5(device.content[:BLOCK]).hexdigest()}  -\nmd5sum: read error\n"
+
+    pulled = patch(device, base, tmp_path/"a.mp4")
+
+    assert (tmp_path/"a.mp4").read_bytes() == device.content
+    assert pulled == len(device.content)
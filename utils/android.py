@@ -1,38 +1,359 @@
-from typing import cast
+import json
+import os
+import struct
+from contextlib import contextmanager
+from functools import cache
+from os import environ
+from pathlib import Path
+from threading import Lock
+from typing import TYPE_CHECKING, Any, Iterator, cast
 
-from adbutils import AdbError, adb
 from colorama import Fore
-from uiautomator2 import Device
-from uiautomator2 import connect as adb_connect
 
-from utils import log
+from utils import UTF_8, log
 from utils.terminal import colorize
 
+if TYPE_CHECKING:
+    from adbutils import AdbConnection, AdbDevice
 
-def connect_device() -> Device:
-    """Function that tries to connect to an ADB device if exists.
+
+# Model & serial of the connected device, if connected
+connected: dict[str, str] | None = None
+# Serial of the record that device paths were resolved from before connecting, if any
+recorded_serial: str | None = None
+# Sync connections kept open per device
+POOL_SIZE = 8
+# Size of the reusable buffer of each sync connection, DATA chunks are gathered in it and written to disk in one call
+SYNC_BUFFER = 1 << 20
+
+
+def device_serials() -> list[str]:
+    """Function that lists the serials of all connected ADB devices, emulators excluded.
 
     Returns:
-        Device: uiautomator2 Device
+        list[str]: Device serials
     """
-    serial = ""
-    for connected_device in adb.iter_device():
-        if "emulator" in connected_device.serial:
-            pass
-        else:
-            serial = connected_device.serial
-            break
+    from adbutils import adb
+    return [connected_device.serial for connected_device in adb.iter_device() if "emulator" not in connected_device.serial]
+
+
+def connect_device() -> "AdbDevice":
+    """Function that tries to connect to an ADB device if exists. Device given by `ANDROID_SERIAL` env variable is preferred, like adb itself does.
+
+    Returns:
+        AdbDevice: adbutils device
+    """
+    from adbutils import AdbError, adb
+    serial = environ.get("ANDROID_SERIAL") or next(iter(device_serials()), "")
     log.info("Connecting to a device")
-    device = cast(Device, None)
+    device = cast("AdbDevice", None)
     try:
-        device = adb_connect(serial)
-        log.update(f"Device connected: {device.device_info.get("model", "Unknown")} ({colorize(device.serial, Fore.CYAN)})")
+        device = adb.device(serial)
+        log.update(f"Device connected: {device.prop.model or "Unknown"} ({colorize(device.serial, Fore.CYAN)})")
     except AdbError as exception:
         log.update(exception, task_success=False)
     return device
 
 
-# Device instance
-device        = connect_device()
-DEVICE_MODEL  = str(device.device_info.get("model", "Unknown"))
-DEVICE_SERIAL = device.serial
+class SyncConnection:
+    """Long-lived connection to the sync service of a device. Unlike adbutils sync, which opens a new connection for every request, requests are sent one after another over the same connection.
+    """
+    def __init__(self, device: "AdbDevice") -> None:
+        """Opens the connection
+
+        Args:
+            device (AdbDevice): adbutils device
+        """
+        self.connection = device.open_transport(timeout=None)
+        self.connection.send_command("sync:")
+        self.connection.check_okay()
+        self.buffer = bytearray(SYNC_BUFFER)
+        self.view = memoryview(self.buffer)
+
+    def recv_into(self, view: memoryview) -> None:
+        """Function that fills `view` from the connection
+
+        Args:
+            view (memoryview): Destination of the bytes
+
+        Raises:
+            ConnectionError: If the device closes the connection
+        """
+        while view:
+            received = self.connection.conn.recv_into(view)
+            if received == 0:
+                raise ConnectionError("sync connection closed by device")
+            view = view[received:]
+
+    def header(self) -> tuple[bytes, int]:
+        """Function that reads the id & length of the next response
+
+        Returns:
+            tuple[bytes, int]: Response id & length
+        """
+        self.recv_into(self.view[:8])
+        return bytes(self.view[:4]), struct.unpack("<I", self.view[4:8])[0]
+
+    def iter_chunks(self, path: str) -> Iterator[memoryview]:
+        """Function that requests a device file and yields its content as views of the connection buffer. Each view holds up to SYNC_BUFFER bytes and is only valid until the next one is yielded.
+
+        Args:
+            path (str): Device file path, relative paths are resolved against `/`
+
+        Raises:
+            OSError: If the device fails to send the file
+
+        Yields:
+            Iterator[memoryview]: Chunks of the file
+        """
+        data = ("/" + path.lstrip("/")).encode(UTF_8)
+        self.connection.conn.sendall(b"RECV" + struct.pack("<I", len(data)) + data)
+        # DATA payloads are gathered after the header area, the header of each response is read into the first 8 bytes
+        filled = 8
+        while True:
+            kind, length = self.header()
+            if kind == b"DATA":
+                if filled + length > SYNC_BUFFER:
+                    yield self.view[8:filled]
+                    filled = 8
+                self.recv_into(self.view[filled:filled+length])
+                filled += length
+            elif kind == b"DONE":
+                break
+            elif kind == b"FAIL":
+                self.recv_into(self.view[8:8+length])
+                raise OSError(f"{path}: {bytes(self.view[8:8+length]).decode(UTF_8, errors="replace")}")
+            else:
+                raise ConnectionError(f"{path}: invalid sync response {kind!r}")
+        if filled > 8:
+            yield self.view[8:filled]
+
+    def pull(self, path: str, dst_file: Path, size: int = 0) -> int:
+        """Function that pulls a device file into `dst_file`. With a known `size` the file is preallocated, so it's written without growing.
+
+        Args:
+            path (str): Device file path
+            dst_file (Path): Local destination file path
+            size (int, optional): Expected size of the file. Defaults to 0.
+
+        Returns:
+            int: Total bytes written
+        """
+        total = 0
+        with open(dst_file, "wb") as fw:
+            if size > 0:
+                preallocate(fw.fileno(), size)
+            for chunk in self.iter_chunks(path):
+                total += fw.write(chunk)
+            if total != size:
+                # file changed on device since it was scanned
+                fw.truncate(total)
+        return total
+
+    def close(self) -> None:
+        """Function that ends the sync session and closes the connection
+        """
+        try:
+            self.connection.conn.sendall(b"QUIT" + struct.pack("<I", 0))
+        except OSError:
+            pass
+        self.connection.close()
+
+
+def preallocate(fd: int, size: int) -> None:
+    """Function that reserves `size` bytes for a file being written, so the file system can lay it out in one piece
+
+    Args:
+        fd (int): File descriptor
+        size (int): File size
+    """
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError:
+            # file system without fallocate support
+            pass
+    os.truncate(fd, size)
+
+
+class Transport:
+    """Transport layer of a device. Keeps a pool of up to POOL_SIZE long-lived sync connections for pulls, shell & exec services share the same device handle but are one-shot by protocol, so they are never pooled.
+    """
+    def __init__(self, device: "AdbDevice", size: int = POOL_SIZE) -> None:
+        """Initializes the empty pool
+
+        Args:
+            device (AdbDevice): adbutils device
+            size (int, optional): Max idle sync connections kept open. Defaults to POOL_SIZE.
+        """
+        self.device = device
+        self.size = size
+        self.idle: list[SyncConnection] = []
+        self.lock = Lock()
+
+    @contextmanager
+    def sync(self) -> Iterator[SyncConnection]:
+        """Context manager that lends a sync connection from the pool. A connection is returned to the pool only if the request completed, so a half read response never leaks into the next one.
+
+        Yields:
+            Iterator[SyncConnection]: Sync connection
+        """
+        with self.lock:
+            connection = self.idle.pop() if self.idle else None
+        if connection is None:
+            connection = SyncConnection(self.device)
+        try:
+            yield connection
+        except BaseException:
+            connection.close()
+            raise
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(connection)
+                return
+        connection.close()
+
+    def close(self) -> None:
+        """Function that closes all idle sync connections
+        """
+        with self.lock:
+            idle, self.idle = self.idle, []
+        [connection.close() for connection in idle]
+
+
+def record_file() -> Path:
+    """Function that returns the file holding the model & serial of the last connected device, it lets offline commands resolve the backup of a device without connecting to it. A device worker of the multi-device mode gets the file of its own state dir.
+
+    Returns:
+        Path: Device record path
+    """
+    if "BACKUP_NAME" in environ:
+        return Path("data")/"devices"/environ["BACKUP_NAME"]/"device.json"
+    return Path("data")/"device.json"
+
+
+@cache
+def connect() -> Transport:
+    """Function that connects to the device on first use and remembers its model & serial in the device record. Every later call returns the same transport.
+
+    Returns:
+        Transport: Transport of the device
+    """
+    global connected
+    device = connect_device()
+    if device is not None and recorded_serial not in (None, device.serial):
+        # paths of the backup were already resolved for another device
+        raise RuntimeError(f"Connected device {device.serial} is not the last connected device {recorded_serial}, set ANDROID_SERIAL to choose the device")
+    if device is not None:
+        connected = {"model": str(device.prop.model or "Unknown"), "serial": device.serial}
+        file = record_file()
+        file.parent.mkdir(parents=True, exist_ok=True)
+        part_file = file.with_name(file.name + ".part")
+        with open(part_file, "w", encoding=UTF_8) as fw:
+            json.dump(connected, fw)
+        part_file.replace(file)
+    return Transport(device)
+
+
+def remembered() -> dict[str, str] | None:
+    """Function that reads the model & serial of the last connected device, unless `ANDROID_SERIAL` asks for another device
+
+    Returns:
+        dict[str, str] | None: Model & serial or None if there's no usable record
+    """
+    file = record_file()
+    if not file.exists():
+        return None
+    with open(file, "r", encoding=UTF_8) as fr:
+        record = json.load(fr)
+    if environ.get("ANDROID_SERIAL", record["serial"]) != record["serial"]:
+        return None
+    return record
+
+
+def current() -> dict[str, str] | None:
+    """Function that returns the model & serial of the connected device, or of the last connected device if none is connected yet. Never connects.
+
+    Returns:
+        dict[str, str] | None: Model & serial or None if no device is connected or recorded
+    """
+    global recorded_serial
+    if connected is not None:
+        return connected
+    record = remembered()
+    if record is not None:
+        recorded_serial = record["serial"]
+    return record
+
+
+def __getattr__(name: str) -> Any:
+    """Module attributes resolved on first use. `device` connects to the device & returns its adbutils handle, so importing this module never connects.
+
+    Args:
+        name (str): Attribute name
+
+    Raises:
+        AttributeError: If the attribute doesn't exist
+
+    Returns:
+        Any: Attribute value
+    """
+    if name == "device":
+        return connect().device
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def shell(command: str) -> str:
+    """Function that runs a shell `command` on device and returns its output
+
+    Args:
+        command (str): Shell command to execute on device
+
+    Returns:
+        str: Output of the command
+    """
+    return connect().device.shell(command)
+
+
+def exec_out(command: str) -> "AdbConnection":
+    """Function that runs a `command` on device using `exec` service, equivalent of `adb exec-out`. Unlike shell, the stdout is a raw binary stream without any line ending conversions.
+
+    Args:
+        command (str): Shell command to execute on device
+
+    Returns:
+        AdbConnection: Connection whose socket streams the stdout of command
+    """
+    connection = connect().device.open_transport(timeout=None)
+    connection.send_command(f"exec:{command}")
+    connection.check_okay()
+    return connection
+
+
+def iter_content(path: str) -> Iterator[memoryview]:
+    """Function that streams the content of a device file at `path` through a pooled sync connection.
+
+    Args:
+        path (str): Device file path
+
+    Yields:
+        Iterator[memoryview]: Chunks of the file as they arrive, each valid until the next one
+    """
+    with connect().sync() as connection:
+        yield from connection.iter_chunks(path)
+
+
+def pull(path: str, dst_file: Path, size: int = 0) -> int:
+    """Function that pulls a device file at `path` into `dst_file` through a pooled sync connection
+
+    Args:
+        path (str): Device file path
+        dst_file (Path): Local destination file path
+        size (int, optional): Expected size, the file is preallocated. Defaults to 0.
+
+    Returns:
+        int: Total bytes written
+    """
+    with connect().sync() as connection:
+        return connection.pull(path, dst_file, size)
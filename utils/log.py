@@ -1,8 +1,15 @@
+import sys
+from typing import TextIO
+
 from colorama import Fore, Style
 
 from utils import terminal
 
 
+# Stream of the log messages, None for stdout. Headless runs log to stderr, so stdout only carries their JSON lines of progress.
+stream: TextIO | None = None
+
+
 def log(prefix: str, suffix: str, prefix_color: str, prefix_bold: bool, end: str) -> None:
     """Funtion that prints a log message
 
@@ -13,7 +20,7 @@ def log(prefix: str, suffix: str, prefix_color: str, prefix_bold: bool, end: str
         prefix_bold (bool): Bool that sets the prefix to be BRIGHT
         end (str): Line ending for print function
     """
-    print(f"{prefix_color}{Style.BRIGHT if prefix_bold else ''}{prefix}{Style.RESET_ALL}: {suffix}", end=end, flush=True)
+    print(f"{prefix_color}{Style.BRIGHT if prefix_bold else ''}{prefix}{Style.RESET_ALL}: {suffix}", end=end, flush=True, file=stream)
 
 
 def info(message: str, success_log: bool = False) -> None:
@@ -60,7 +67,9 @@ def update(message: str | Exception, task_success: bool = True) -> None:
         message (str): Log message or Exception
         task_success (bool): Bool that decides to call INFO or ERROR based on task status
     """
-    terminal.clear_previous_lines(1)
+    if stream is None:
+        # the previous line can only be cleared on the terminal
+        terminal.clear_previous_lines(1)
     info(str(message), success_log=True) if task_success else error(message)
 
 
@@ -70,5 +79,12 @@ def stage(title: str) -> None:
     Args:
         title (str): Stage title
     """
-    print()
+    print(file=stream)
     info(f"STAGE: {title}")
+
+
+def headless() -> None:
+    """Function that moves the log messages to stderr for a headless run
+    """
+    global stream
+    stream = sys.stderr
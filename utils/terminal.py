@@ -59,6 +59,6 @@ def clear_screen() -> None:
 
 try:
     terminal_width = get_terminal_size().columns
-    clear_screen()
 except OSError:
-    ...
\ No newline at end of file
+    # stdout is not a terminal, e.g. a device worker logging into a file
+    terminal_width = 120
\ No newline at end of file
@@ -1,5 +1,5 @@
 from threading import Thread
-from typing import Callable
+from typing import Callable, Iterable
 
 
 class ExceptionalThread(Thread):
@@ -42,3 +42,22 @@ class ExceptionalThread(Thread):
         super().join(timeout)
         if self._exception:
             raise self._exception
+
+
+def join_all(threads: Iterable[ExceptionalThread]) -> None:
+    """Function that joins every thread before raising the first exception handled by any of them, so no thread is left running once the caller unwinds
+
+    Args:
+        threads (Iterable[ExceptionalThread]): Started threads
+
+    Raises:
+        Exception: First exception handled during the execution of the threads
+    """
+    exceptions = []
+    for thread in threads:
+        try:
+            thread.join()
+        except Exception as exception:
+            exceptions.append(exception)
+    if exceptions:
+        raise exceptions[0]